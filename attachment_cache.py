@@ -0,0 +1,187 @@
+"""Content addressed cache of downloaded pack attachments
+
+Attachments are fetched over HTTP by a bounded pool of workers and streamed
+to disk while being hashed. Files are stored under their SHA-256 digest, so
+the same pack uploaded several times is only stored once. An index maps
+attachment IDs to digests, attachments already in the index are not fetched
+again.
+"""
+
+import asyncio
+import hashlib
+import io
+import json
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+
+__author__ = '4shockblast'
+
+INDEX_FILE_NAME = 'index.jsonl'
+CHUNK_SIZE = 1 << 16
+
+
+class FetchStats:
+    """Counts of what happened to the attachments of a fetch run"""
+
+    def __init__(self):
+        """Initialize all counts to zero"""
+        self.fetched = 0
+        self.duplicates = 0
+        self.cached = 0
+        self.failed = 0
+
+    def __str__(self):
+        return ('{} fetched, {} duplicates, {} already cached, '
+                '{} failed'.format(self.fetched, self.duplicates, self.cached,
+                                   self.failed))
+
+
+class AttachmentCache:
+    """Fetches attachments into a content addressed directory"""
+
+    def __init__(self, writer, directory='pack_cache', max_concurrent=8):
+        """Initialize the cache
+
+        At most max_concurrent attachments are fetched at once. Index updates
+        are written by the given background writer.
+        """
+        self._writer = writer
+        self._directory = directory
+        self._index_path = os.path.join(directory, INDEX_FILE_NAME)
+        self._max_concurrent = max_concurrent
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_concurrent, thread_name_prefix='pack-fetch'
+        )
+        self._index = None
+        self._in_flight = set()
+
+    def object_path(self, digest):
+        """Returns the path a file with the given digest is stored at"""
+        return os.path.join(self._directory, 'objects', digest[:2], digest)
+
+    async def _run(self, function, *args):
+        """Runs a blocking file operation on the cache's threads"""
+        return await asyncio.get_event_loop().run_in_executor(
+            self._executor, function, *args
+        )
+
+    def _load_index(self):
+        """Reads the attachment ID to digest index"""
+        index = {}
+        os.makedirs(self._directory, exist_ok=True)
+        if os.path.exists(self._index_path):
+            with io.open(self._index_path, encoding='utf8') as index_file:
+                for line in index_file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    index[entry['attach_id']] = entry['digest']
+        return index
+
+    async def fetch_all(self, records, session=None):
+        """Fetches the attachments of export records that are not cached
+
+        Records are the dicts written by the pack exporter. A session can be
+        passed in to fetch through, otherwise one is opened for the run.
+        Returns the fetch stats.
+        """
+        if self._index is None:
+            self._index = await self._run(self._load_index)
+        stats = FetchStats()
+        queue = asyncio.Queue()
+        for record in records:
+            if record['attach_id'] in self._index:
+                stats.cached += 1
+            else:
+                queue.put_nowait(record)
+
+        own_session = session is None
+        if own_session:
+            session = aiohttp.ClientSession()
+        try:
+            await asyncio.gather(*[
+                self._fetch_worker(session, queue, stats)
+                for _ in range(min(self._max_concurrent, queue.qsize()))
+            ])
+        finally:
+            if own_session:
+                await session.close()
+        return stats
+
+    async def _fetch_worker(self, session, queue, stats):
+        """Fetches queued records until the queue is empty"""
+        while not queue.empty():
+            record = queue.get_nowait()
+            attach_id = record['attach_id']
+            if attach_id in self._index or attach_id in self._in_flight:
+                # The same attachment can be listed more than once, or be
+                # fetched by another run already
+                stats.cached += 1
+                continue
+            self._in_flight.add(attach_id)
+            try:
+                digest, duplicate = await self._fetch(session, record)
+            except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as exc:
+                print('Failed to fetch {}: {}'.format(record['attach_url'],
+                                                      exc))
+                stats.failed += 1
+                continue
+            finally:
+                self._in_flight.discard(attach_id)
+            if duplicate:
+                stats.duplicates += 1
+            else:
+                stats.fetched += 1
+            self._index[attach_id] = digest
+            self._writer.append(self._index_path, json.dumps({
+                'attach_id': attach_id,
+                'attach_name': record['attach_name'],
+                'digest': digest
+            }) + '\n')
+
+    async def _fetch(self, session, record):
+        """Streams an attachment to disk while hashing it
+
+        Returns the digest of the attachment and whether a file with the
+        same contents was already stored.
+        """
+        temp_path = os.path.join(
+            self._directory, '{}.part'.format(record['attach_id'])
+        )
+        hasher = hashlib.sha256()
+        part_file = await self._run(io.open, temp_path, 'wb')
+        try:
+            async with session.get(record['attach_url']) as response:
+                response.raise_for_status()
+                async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                    hasher.update(chunk)
+                    await self._run(part_file.write, chunk)
+        except BaseException:
+            await self._run(part_file.close)
+            await self._run(os.remove, temp_path)
+            raise
+        await self._run(part_file.close)
+
+        digest = hasher.hexdigest()
+        return digest, await self._run(self._store, temp_path, digest)
+
+    def _store(self, temp_path, digest):
+        """Moves a fetched file to its object path
+
+        Returns True if a file with the same digest was already stored.
+        """
+        object_path = self.object_path(digest)
+        if os.path.exists(object_path):
+            os.remove(temp_path)
+            return True
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        os.replace(temp_path, object_path)
+        return False
+
+    def close(self):
+        """Stops the cache's file threads"""
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,109 @@
+"""Background file writing for the race bot
+
+File writes are handed to a single writer thread so a slow disk never blocks
+the event loop. Writes happen in the order they were submitted, and appends
+to the same file that pile up while the thread is busy are written together.
+"""
+
+import asyncio
+import collections
+import io
+import os
+import threading
+import traceback
+
+from concurrent.futures import ThreadPoolExecutor
+
+__author__ = '4shockblast'
+
+
+class BackgroundWriter:
+    """Runs file writes on a dedicated thread, in submission order"""
+
+    def __init__(self):
+        """Initialize the writer, the thread is started on the first write"""
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='race-writer'
+        )
+        self._lock = threading.Lock()
+        self._operations = collections.deque()
+        self._draining = False
+
+    def write(self, path, content):
+        """Replaces the contents of a file"""
+        self._submit(('write', path, content))
+
+    def replace(self, path, content):
+        """Replaces the contents of a file atomically, through a temp file"""
+        self._submit(('replace', path, content))
+
+    def append(self, path, content):
+        """Appends to a file"""
+        self._submit(('append', path, content))
+
+    def call(self, function, *args):
+        """Runs a function on the writer thread, in order with the writes"""
+        self._submit(('call', function, args))
+
+    def _submit(self, operation):
+        """Queues an operation, scheduling a drain if none is running"""
+        with self._lock:
+            self._operations.append(operation)
+            if self._draining:
+                return
+            self._draining = True
+        self._executor.submit(self._drain)
+
+    def _drain(self):
+        """Runs queued operations until there are none left"""
+        while True:
+            with self._lock:
+                if not self._operations:
+                    self._draining = False
+                    return
+                operations = list(self._operations)
+                self._operations.clear()
+
+            index = 0
+            while index < len(operations):
+                kind, target, payload = operations[index]
+                index += 1
+                if kind == 'append':
+                    # Batch consecutive appends to the same file
+                    contents = [payload]
+                    while (index < len(operations) and
+                           operations[index][:2] == ('append', target)):
+                        contents.append(operations[index][2])
+                        index += 1
+                    payload = ''.join(contents)
+                try:
+                    self._run(kind, target, payload)
+                except Exception:
+                    print('Background {} failed:'.format(kind))
+                    traceback.print_exc()
+
+    @staticmethod
+    def _run(kind, target, payload):
+        """Runs a single operation"""
+        if kind == 'call':
+            target(*payload)
+        elif kind == 'replace':
+            temp_path = target + '.tmp'
+            with io.open(temp_path, 'w', encoding='utf8') as out_file:
+                out_file.write(payload)
+            os.replace(temp_path, target)
+        else:
+            mode = 'a' if kind == 'append' else 'w'
+            with io.open(target, mode, encoding='utf8') as out_file:
+                out_file.write(payload)
+
+    async def flush(self):
+        """Waits until every write submitted so far is done"""
+        # The executor has a single thread, so this runs after pending drains
+        await asyncio.get_event_loop().run_in_executor(
+            self._executor, lambda: None
+        )
+
+    def close(self):
+        """Finishes pending writes and stops the writer thread"""
+        self._executor.shutdown(wait=True)
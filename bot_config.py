@@ -0,0 +1,64 @@
+"""Configuration of the race bot
+
+Settings are read from an optional JSON file, any setting missing from the
+file keeps its default value.
+"""
+
+import io
+import json
+import os
+
+__author__ = '4shockblast'
+
+CONFIG_FILE_NAME = 'config.json'
+
+DEFAULTS = {
+    # Request only the gateway intents the race commands need and keep no
+    # member cache, see the README
+    'low_memory': False,
+    # Names of the roles allowed to run mod commands, and of the role
+    # mentioned when a race starts, with per guild overrides keyed by
+    # guild ID
+    'roles': {
+        'mod': ['race mod'],
+        'racer': 'racer',
+        'guilds': {}
+    },
+    # Races without a command for this long are closed, 0 keeps them open
+    'idle_timeout_minutes': 360,
+    # Started races with racers still running are only closed after this
+    # long without a command, so marathons are not cut short, 0 keeps them
+    # open until everyone is done
+    'running_idle_timeout_minutes': 10080,
+    # Keep a pinned results board per race, edited as the race changes
+    'live_boards': True,
+    # Serve metrics for Prometheus at http://host:port/metrics, a port of 0
+    # turns the endpoint off
+    'metrics_host': '127.0.0.1',
+    'metrics_port': 9108,
+    # Number of bot processes started by race_cluster.py, and the total
+    # number of shards dealt out to them, 0 for one shard per process
+    'processes': 1,
+    'shard_count': 0,
+    # Sliding window limits of commands per user, per channel and per user
+    # for single commands. Mods and the race commands of racers are never
+    # throttled, commands over a limit are dropped silently
+    'throttles': {
+        'user': {'limit': 10, 'seconds': 10},
+        'channel': {'limit': 40, 'seconds': 10},
+        'commands': {
+            'time': {'limit': 2, 'seconds': 10},
+            'results': {'limit': 2, 'seconds': 10},
+            'entrants': {'limit': 2, 'seconds': 10}
+        }
+    }
+}
+
+
+def load_config(path=CONFIG_FILE_NAME):
+    """Returns the settings in the config file merged over the defaults"""
+    config = dict(DEFAULTS)
+    if os.path.exists(path):
+        with io.open(path, encoding='utf8') as config_file:
+            config.update(json.load(config_file))
+    return config
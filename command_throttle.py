@@ -0,0 +1,132 @@
+"""Sliding window throttles for bot commands
+
+Each throttle allows a number of commands per window of seconds for every
+key, such as a user or a channel. The sliding window is approximated from
+the counts of the current and previous fixed windows, so a key costs three
+numbers and a check costs a few arithmetic operations. Buckets are kept in
+least recently used order, and buckets idle for two windows are dropped as
+new commands come in.
+"""
+
+import collections
+import time
+
+__author__ = '4shockblast'
+
+DEFAULT_EXEMPT = ('join', 'unjoin', 'ready', 'unready', 'done', 'undone',
+                  'quit', 'unquit', 'comment', 'split')
+
+
+class Bucket:
+    """Command counts of a key in the current and previous windows"""
+
+    __slots__ = ('window_start', 'current', 'previous')
+
+    def __init__(self, window_start):
+        """Initialize an empty bucket"""
+        self.window_start = window_start
+        self.current = 0
+        self.previous = 0
+
+
+class Throttle:
+    """Allows limit commands per key in any window of seconds"""
+
+    def __init__(self, limit, seconds):
+        """Initialize a throttle with no buckets"""
+        self.limit = limit
+        self.seconds = seconds
+        self._buckets = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def _bucket(self, key, now):
+        """Returns the bucket of a key, rolled over to the current window"""
+        self._expire(now)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = Bucket(now)
+            return bucket
+        self._buckets.move_to_end(key)
+        elapsed = now - bucket.window_start
+        if elapsed >= self.seconds:
+            windows = int(elapsed // self.seconds)
+            bucket.previous = bucket.current if windows == 1 else 0
+            bucket.current = 0
+            bucket.window_start += windows * self.seconds
+        return bucket
+
+    def _expire(self, now):
+        """Drops the least recently used buckets idle for two windows"""
+        while self._buckets:
+            key, bucket = next(iter(self._buckets.items()))
+            if now - bucket.window_start < 2 * self.seconds:
+                break
+            del self._buckets[key]
+
+    def allows(self, key, now):
+        """Checks if a key is under the limit, without counting a command"""
+        bucket = self._bucket(key, now)
+        overlap = 1 - (now - bucket.window_start) / self.seconds
+        return bucket.previous * overlap + bucket.current < self.limit
+
+    def count(self, key):
+        """Counts a command of a key, allows must have been checked first"""
+        self._buckets[key].current += 1
+
+
+class CommandThrottles:
+    """Per user, per channel and per user and command throttles"""
+
+    def __init__(self, config=None):
+        """Initialize the throttles from the throttles config
+
+        The config holds the limit and window in seconds of commands per
+        user and per channel, and of single commands per user, and the names
+        of the commands which are never throttled, e.g.
+        {"user": {"limit": 10, "seconds": 10},
+        "commands": {"time": {"limit": 2, "seconds": 10}}, "exempt": []}.
+        A missing or zero limit turns a throttle off.
+        """
+        config = config if config is not None else {}
+        self.user = self._throttle(config.get('user'))
+        self.channel = self._throttle(config.get('channel'))
+        self.commands = {}
+        for name, command_config in config.get('commands', {}).items():
+            throttle = self._throttle(command_config)
+            if throttle is not None:
+                self.commands[name] = throttle
+        self.exempt = frozenset(config.get('exempt', DEFAULT_EXEMPT))
+
+    @staticmethod
+    def _throttle(config):
+        """Returns the throttle for a limit config, None if it is off"""
+        if not config or not config.get('limit'):
+            return None
+        return Throttle(config['limit'], config['seconds'])
+
+    def allow(self, user_id, channel_id, command, now=None):
+        """Checks a command against the throttles and counts it if allowed
+
+        Rejected commands are not counted, so a user sending commands too
+        fast gets through again once their earlier commands age out.
+        """
+        if command in self.exempt:
+            return True
+        if now is None:
+            now = time.monotonic()
+        checks = []
+        command_throttle = self.commands.get(command)
+        if command_throttle is not None:
+            checks.append((command_throttle, user_id))
+        if self.user is not None:
+            checks.append((self.user, user_id))
+        if self.channel is not None:
+            checks.append((self.channel, channel_id))
+        for throttle, key in checks:
+            if not throttle.allows(key, now):
+                return False
+        for throttle, key in checks:
+            throttle.count(key)
+        return True
@@ -0,0 +1,180 @@
+"""Live race boards edited in place
+
+Each race gets a single board message, posted and pinned once the race
+changes for the first time, which is then edited as the race changes
+instead of posting new result messages. Edits are debounced: changes that
+come in while an edit is pending are shown by that edit, and edits of a
+board are at least min_interval seconds apart, so a burst of finishes is
+shown with a handful of edits.
+"""
+
+import asyncio
+import traceback
+
+from message_scheduler import PRIORITY_REPLY
+
+__author__ = '4shockblast'
+
+
+class Board:
+    """Board message of a single race"""
+
+    __slots__ = ('channel', 'render', 'message', 'content', 'handle',
+                 'posting', 'editing', 'dirty', 'pinned', 'last_edit',
+                 'closed')
+
+    def __init__(self, channel, render):
+        """Initialize a board which has not been posted yet"""
+        self.channel = channel
+        self.render = render
+        self.message = None
+        self.content = None
+        self.handle = None
+        self.posting = False
+        self.editing = False
+        self.dirty = False
+        self.pinned = False
+        self.last_edit = None
+        self.closed = False
+
+
+class LiveBoards:
+    """Posts and edits the live boards of all races"""
+
+    def __init__(self, scheduler, delay=1.0, min_interval=5.0):
+        """Initialize with no boards
+
+        Boards are posted through the given message scheduler. An edit goes
+        out delay seconds after the first change it shows, and no sooner
+        than min_interval seconds after the previous edit of the board.
+        """
+        self._scheduler = scheduler
+        self.delay = delay
+        self.min_interval = min_interval
+        self.edits = 0
+        self.errors = 0
+        self._boards = {}
+
+    def __len__(self):
+        return len(self._boards)
+
+    def update(self, key, channel, render):
+        """Marks the board of a race as out of date
+
+        render is called without arguments when the edit goes out and
+        returns the board content, so an edit always shows the latest state.
+        The board is posted if the race has none yet.
+        """
+        board = self._boards.get(key)
+        if board is None:
+            board = self._boards[key] = Board(channel, render)
+        board.render = render
+        board.dirty = True
+        if board.message is None:
+            if not board.posting:
+                self._post(key, board)
+        else:
+            self._schedule(board)
+
+    def _schedule(self, board):
+        """Schedules an edit of a posted board unless one is pending"""
+        if board.handle is not None or board.editing:
+            return
+        loop = asyncio.get_event_loop()
+        due = loop.time() + self.delay
+        if board.last_edit is not None:
+            due = max(due, board.last_edit + self.min_interval)
+        board.handle = loop.call_at(due, self._flush, board)
+
+    def _post(self, key, board):
+        """Posts a new board message"""
+        board.posting = True
+        board.dirty = False
+        board.content = board.render()
+        posted = self._scheduler.send(board.channel, board.content,
+                                      PRIORITY_REPLY)
+        posted.add_done_callback(
+            lambda future: self._posted(key, board, future)
+        )
+
+    def _posted(self, key, board, future):
+        """Pins a posted board and catches up on changes since posting"""
+        board.posting = False
+        if future.cancelled() or future.exception() is not None:
+            # The next change of the race posts a new board
+            self.errors += 1
+            if self._boards.get(key) is board:
+                del self._boards[key]
+            return
+        board.message = future.result()
+        board.last_edit = asyncio.get_event_loop().time()
+        if board.closed:
+            asyncio.ensure_future(self._edit(board))
+            return
+        asyncio.ensure_future(self._pin(board))
+        if board.dirty:
+            self._schedule(board)
+
+    def _flush(self, board):
+        """Starts the pending edit of a board"""
+        board.handle = None
+        asyncio.ensure_future(self._edit(board))
+
+    async def _edit(self, board):
+        """Edits a board to its latest content, unpinning a closed board"""
+        board.editing = True
+        board.dirty = False
+        closed = board.closed
+        content = board.render()
+        try:
+            if content != board.content:
+                await board.message.edit(content=content)
+                board.content = content
+                self.edits += 1
+            if closed and board.pinned:
+                board.pinned = False
+                await board.message.unpin()
+        except Exception:
+            self.errors += 1
+            print('Live board edit failed:')
+            traceback.print_exc()
+        finally:
+            board.editing = False
+            board.last_edit = asyncio.get_event_loop().time()
+        if board.closed and not closed:
+            asyncio.ensure_future(self._edit(board))
+        elif board.dirty and not board.closed:
+            self._schedule(board)
+
+    async def _pin(self, board):
+        """Pins a board message, boards stay usable if pinning fails"""
+        try:
+            await board.message.pin()
+            board.pinned = True
+        except Exception as exc:
+            self.errors += 1
+            print('Could not pin live board: {}'.format(exc))
+
+    def close(self, key, render):
+        """Shows the final state of a race on its board and unpins it
+
+        The final edit is not debounced, it goes out as soon as any edit in
+        progress is done.
+        """
+        board = self._boards.pop(key, None)
+        if board is None:
+            return
+        board.render = render
+        board.closed = True
+        if board.handle is not None:
+            board.handle.cancel()
+            board.handle = None
+        if board.message is not None and not board.editing:
+            asyncio.ensure_future(self._edit(board))
+
+    def stop(self):
+        """Cancels all pending edits"""
+        for board in self._boards.values():
+            if board.handle is not None:
+                board.handle.cancel()
+                board.handle = None
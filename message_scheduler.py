@@ -0,0 +1,299 @@
+"""Outbound message scheduling for the race bot
+
+Messages are queued per channel and sent by one drain task per channel, which
+keeps under the channel rate limit with a token bucket and always sends the
+most urgent message first. Low priority chatter that comes in within a short
+window is merged into a single message.
+"""
+
+import asyncio
+import collections
+import functools
+import heapq
+import itertools
+
+__author__ = '4shockblast'
+
+MESSAGE_LIMIT = 2000
+
+PRIORITY_COUNTDOWN = 0
+PRIORITY_RESULTS = 1
+PRIORITY_REPLY = 2
+PRIORITY_CHATTER = 3
+
+
+def split_message(lines, limit=MESSAGE_LIMIT):
+    """Packs lines into as few messages as possible
+
+    Lines are joined with newlines into messages of at most limit characters.
+    A line too long for a single message is split across messages.
+    """
+    messages = []
+    chunk = []
+    chunk_size = 0
+    for line in lines:
+        while len(line) > limit:
+            if chunk:
+                messages.append('\n'.join(chunk))
+                chunk = []
+                chunk_size = 0
+            messages.append(line[:limit])
+            line = line[limit:]
+        line_size = len(line) + 1 if chunk else len(line)
+        if chunk and chunk_size + line_size > limit:
+            messages.append('\n'.join(chunk))
+            chunk = []
+            line_size = len(line)
+            chunk_size = 0
+        chunk.append(line)
+        chunk_size += line_size
+    if chunk:
+        messages.append('\n'.join(chunk))
+    return messages
+
+
+class TokenBucket:
+    """Token bucket allowing rate sends per period, in bursts up to rate"""
+
+    def __init__(self, rate, period):
+        """Initialize a full bucket"""
+        self._capacity = rate
+        self._refill_rate = rate / period
+        self._tokens = float(rate)
+        self._updated = None
+
+    def delay(self, now):
+        """Returns how long to wait before a token is available"""
+        if self._updated is not None:
+            self._tokens = min(
+                self._capacity,
+                self._tokens + (now - self._updated) * self._refill_rate
+            )
+        self._updated = now
+        if self._tokens >= 1:
+            return 0
+        return (1 - self._tokens) / self._refill_rate
+
+    def take(self):
+        """Takes a token, delay must have returned 0 beforehand"""
+        self._tokens -= 1
+
+
+class ChannelQueue:
+    """Messages waiting to be sent to a single channel
+
+    Pending messages are kept in a heap of (priority, sequence, content,
+    futures, enqueue time) entries. Chatter waits in a separate list until
+    its coalescing window is over.
+    """
+
+    def __init__(self, channel, scheduler):
+        """Initialize an empty queue for the channel"""
+        self.channel = channel
+        self._scheduler = scheduler
+        self._bucket = TokenBucket(scheduler.rate, scheduler.period)
+        self._pending = []
+        self._chatter = []
+        self._chatter_deadline = None
+        self._wakeup = asyncio.Event()
+        self._drain_task = None
+
+    def __len__(self):
+        return len(self._pending) + len(self._chatter)
+
+    def put(self, content, priority, future, now):
+        """Queues a message, starting the drain task if needed"""
+        if priority == PRIORITY_CHATTER:
+            if not self._chatter:
+                self._chatter_deadline = now + self._scheduler.coalesce_window
+            self._chatter.append((content, future, now))
+        else:
+            heapq.heappush(self._pending, (
+                priority, next(self._scheduler.sequence), content, [future],
+                now
+            ))
+        self._wakeup.set()
+        if self._drain_task is None:
+            self._drain_task = asyncio.ensure_future(self._drain())
+
+    def _flush_chatter(self):
+        """Merges the waiting chatter into as few messages as possible"""
+        contents = [content for content, _, _ in self._chatter]
+        futures = [future for _, future, _ in self._chatter]
+        enqueued = self._chatter[0][2]
+        merged = split_message(contents)
+        self._scheduler.coalesced += len(contents) - len(merged)
+        for index, content in enumerate(merged):
+            # Chatter futures resolve once the last merged message is sent
+            waiting = futures if index == len(merged) - 1 else []
+            heapq.heappush(self._pending, (
+                PRIORITY_CHATTER, next(self._scheduler.sequence), content,
+                waiting, enqueued
+            ))
+        self._chatter = []
+        self._chatter_deadline = None
+
+    async def _drain(self):
+        """Sends queued messages until the queue is empty"""
+        loop = asyncio.get_event_loop()
+        try:
+            while self._pending or self._chatter:
+                now = loop.time()
+                if self._chatter and now >= self._chatter_deadline:
+                    self._flush_chatter()
+                if not self._pending:
+                    self._wakeup.clear()
+                    await self._wait(self._chatter_deadline - now)
+                    continue
+
+                delay = self._bucket.delay(now)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    continue
+                self._bucket.take()
+                _, _, content, futures, enqueued = heapq.heappop(
+                    self._pending
+                )
+                await self._send(content, futures, enqueued)
+        finally:
+            self._drain_task = None
+            self._scheduler.release(self)
+
+    async def _wait(self, timeout):
+        """Waits for a new message or until the timeout passes"""
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _send(self, content, futures, enqueued):
+        """Sends a message and resolves the futures waiting on it"""
+        loop = asyncio.get_event_loop()
+        send_start = loop.time()
+        try:
+            message = await self.channel.send(content)
+        except Exception as exc:
+            self._scheduler.errors += 1
+            for future in futures:
+                if not future.done():
+                    future.set_exception(exc)
+        else:
+            for future in futures:
+                if not future.done():
+                    future.set_result(message)
+        finally:
+            sent = loop.time()
+            self._scheduler.record_send(sent - send_start, sent - enqueued)
+
+
+class MessageScheduler:
+    """Schedules outbound messages for all channels
+
+    Each channel gets its own token bucket allowing rate messages per period.
+    Within a channel, messages are sent in priority order, countdown ticks
+    first, chatter last. Chatter that comes in within coalesce_window seconds
+    of the first waiting chatter message is merged into one message. A
+    mergeable message identical to one waiting to be sent to the channel, or
+    sent to it less than merge_window seconds ago, is not sent again.
+    """
+
+    def __init__(self, rate=5, period=5.0, coalesce_window=0.5,
+                 merge_window=5.0):
+        """Initialize the scheduler"""
+        self.rate = rate
+        self.period = period
+        self.coalesce_window = coalesce_window
+        self.merge_window = merge_window
+        self.sequence = itertools.count()
+        self.sent = 0
+        self.coalesced = 0
+        self.merged = 0
+        self.errors = 0
+        self.send_latencies = collections.deque(maxlen=1024)
+        self.queue_latencies = collections.deque(maxlen=1024)
+        self.on_send = None
+        self._channels = {}
+        self._mergeable = {}
+        self._merge_expiry = collections.deque()
+
+    def send(self, channel, content, priority=PRIORITY_REPLY, merge=False):
+        """Queues a message for the channel
+
+        Returns a future which is set to the sent message. Merged chatter
+        resolves to the last message it was merged into, and a merged
+        mergeable message to the identical message.
+        """
+        loop = asyncio.get_event_loop()
+        if merge:
+            self._expire_mergeable(loop.time())
+            key = (channel.id, priority, content)
+            future = self._mergeable.get(key)
+            if future is not None:
+                self.merged += 1
+                return future
+        future = loop.create_future()
+        if merge:
+            self._mergeable[key] = future
+            future.add_done_callback(
+                functools.partial(self._mergeable_sent, key)
+            )
+        queue = self._channels.get(channel.id)
+        if queue is None:
+            queue = self._channels[channel.id] = ChannelQueue(channel, self)
+        queue.put(content, priority, future, loop.time())
+        return future
+
+    def _mergeable_sent(self, key, future):
+        """Keeps a sent mergeable message for the merge window"""
+        if future.cancelled() or future.exception() is not None:
+            if self._mergeable.get(key) is future:
+                del self._mergeable[key]
+            return
+        self._merge_expiry.append((
+            asyncio.get_event_loop().time() + self.merge_window, key, future
+        ))
+
+    def _expire_mergeable(self, now):
+        """Forgets the mergeable messages sent before the merge window"""
+        while self._merge_expiry and self._merge_expiry[0][0] <= now:
+            _, key, future = self._merge_expiry.popleft()
+            if self._mergeable.get(key) is future:
+                del self._mergeable[key]
+
+    def release(self, queue):
+        """Forgets a channel queue once everything in it has been sent"""
+        if not queue and self._channels.get(queue.channel.id) is queue:
+            del self._channels[queue.channel.id]
+
+    def record_send(self, send_latency, queue_latency):
+        """Records the API and total latency of a sent message
+
+        The latencies are also passed to on_send, if set.
+        """
+        self.sent += 1
+        self.send_latencies.append(send_latency)
+        self.queue_latencies.append(queue_latency)
+        if self.on_send is not None:
+            self.on_send(send_latency, queue_latency)
+
+    def queue_depth(self):
+        """Returns the number of messages waiting to be sent"""
+        return sum(len(queue) for queue in self._channels.values())
+
+    def metrics(self):
+        """Returns a snapshot of the scheduler metrics"""
+        def mean(values):
+            return sum(values) / len(values) if values else 0.0
+
+        return {
+            'queue_depth': self.queue_depth(),
+            'channels': len(self._channels),
+            'sent': self.sent,
+            'coalesced': self.coalesced,
+            'merged': self.merged,
+            'errors': self.errors,
+            'send_latency_mean': mean(self.send_latencies),
+            'send_latency_max': max(self.send_latencies, default=0.0),
+            'queue_latency_mean': mean(self.queue_latencies),
+            'queue_latency_max': max(self.queue_latencies, default=0.0),
+        }
@@ -0,0 +1,153 @@
+"""Streaming export of the pack attachments posted in a channel
+
+Attachment records are written to a JSON lines file as the channel history is
+walked, oldest message first. The ID of the last exported message is kept in
+a checkpoint file, so an interrupted export resumes where it stopped and
+later exports only fetch messages newer than the last one exported.
+"""
+
+import asyncio
+import io
+import json
+import os
+
+import discord
+
+__author__ = '4shockblast'
+
+
+class PackExporter:
+    """Exports channel attachments to per-channel JSON lines files"""
+
+    def __init__(self, writer, directory='.', checkpoint_interval=500):
+        """Initialize the exporter
+
+        Files are written by the given background writer. The checkpoint is
+        updated every checkpoint_interval messages.
+        """
+        self._writer = writer
+        self._directory = directory
+        self._checkpoint_interval = checkpoint_interval
+        self._running = set()
+
+    def export_path(self, channel):
+        """Returns the path of the export file for a channel"""
+        return os.path.join(
+            self._directory, 'pack_export_{}.jsonl'.format(channel.id)
+        )
+
+    def checkpoint_path(self, channel):
+        """Returns the path of the checkpoint file for a channel"""
+        return os.path.join(
+            self._directory, 'pack_export_{}.checkpoint'.format(channel.id)
+        )
+
+    def is_running(self, channel):
+        """Checks if an export of the channel is in progress"""
+        return channel.id in self._running
+
+    @staticmethod
+    def read_checkpoint(path):
+        """Returns the last exported message ID, None if there is none"""
+        if not os.path.exists(path):
+            return None
+        with io.open(path, encoding='utf8') as checkpoint_file:
+            return json.load(checkpoint_file)['last_message_id']
+
+    @staticmethod
+    def read_records(path):
+        """Returns the attachment records in an export file"""
+        records = []
+        if not os.path.exists(path):
+            return records
+        with io.open(path, encoding='utf8') as export_file:
+            for line in export_file:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+        return records
+
+    @staticmethod
+    def attachment_record(message, attachment):
+        """Returns the export record for an attachment of a message"""
+        return {
+            'message_id': message.id,
+            'attach_id': attachment.id,
+            'attach_name': attachment.filename,
+            'attach_url': attachment.url,
+            'time': '{} -0000'.format(
+                message.created_at.strftime('%Y-%m-%d %H:%M:%S')
+            ),
+            'author': message.author.name
+        }
+
+    async def export(self, channel, full=False):
+        """Exports the attachments of messages newer than the checkpoint
+
+        With full, the export starts over from the first message of the
+        channel. Returns the number of attachment records written.
+        """
+        self._running.add(channel.id)
+        try:
+            return await self._export(channel, full)
+        finally:
+            self._running.discard(channel.id)
+
+    async def _export(self, channel, full):
+        """Walks the channel history and streams out attachment records"""
+        export_path = self.export_path(channel)
+        checkpoint_path = self.checkpoint_path(channel)
+        last_message_id = None
+        if full:
+            # Reset the checkpoint first, an export interrupted before its
+            # first batch then starts over instead of resuming after records
+            # no longer in the file
+            self._writer.replace(checkpoint_path, json.dumps({
+                'last_message_id': None
+            }))
+            self._writer.write(export_path, '')
+        else:
+            last_message_id = await asyncio.get_event_loop().run_in_executor(
+                None, self.read_checkpoint, checkpoint_path
+            )
+
+        after = None
+        if last_message_id is not None:
+            after = discord.Object(id=last_message_id)
+        records = []
+        num_records = 0
+        num_messages = 0
+        async for message in channel.history(limit=None, after=after,
+                                             oldest_first=True):
+            for attachment in message.attachments:
+                records.append(json.dumps(
+                    self.attachment_record(message, attachment)
+                ) + '\n')
+            last_message_id = message.id
+            num_messages += 1
+            if num_messages % self._checkpoint_interval == 0:
+                num_records += self._write_batch(
+                    export_path, checkpoint_path, records, last_message_id
+                )
+                records = []
+
+        if last_message_id is not None:
+            num_records += self._write_batch(
+                export_path, checkpoint_path, records, last_message_id
+            )
+        return num_records
+
+    def _write_batch(self, export_path, checkpoint_path, records,
+                     last_message_id):
+        """Writes out records, then moves the checkpoint past them
+
+        The writer keeps submission order, so the checkpoint never gets
+        ahead of the records on disk.
+        """
+        if records:
+            self._writer.append(export_path, ''.join(records))
+        self._writer.replace(checkpoint_path, json.dumps({
+            'last_message_id': last_message_id
+        }))
+        return len(records)
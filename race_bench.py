@@ -0,0 +1,476 @@
+"""Benchmark of the race cog without a Discord connection
+
+Replays a stream of commands against the race cog's handlers, with fake
+members, guild, channel and contexts whose sends do nothing. A stream is a
+list of steps, each a dict with the command name, the index of the user
+running it, where user 0 is a mod, and optionally its keyword arguments, the
+seconds to wait before it, the phase it is reported under and whether to
+wait for it to complete before the next step. Other commands are dispatched
+without waiting for earlier ones, as they would come in from the gateway,
+and every phase waits for all of its commands to complete.
+
+Streams are either generated for a number of racers, with join storms,
+ready bursts, finish bursts and !results spam, or read from a JSON lines
+file. For every phase and command the latency percentiles, from dispatch to
+the replies being sent, and the throughput are reported, and with
+--allocations the peak traced memory and the net number of allocated memory
+blocks. Each phase also reports the state of the race after it, and a
+generated stream whose race does not start or whose racers do not all
+finish fails, so the numbers never measure error replies.
+
+With --guilds no stream is replayed, instead the memory the cog holds per
+guild is measured with a race of --racers racers in each guild.
+
+Example:
+
+    python race_bench.py --racers 500 --json bench.json
+"""
+
+import argparse
+import asyncio
+import gc
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+from datetime import datetime, timezone
+
+import race_bot
+
+__author__ = '4shockblast'
+
+PERCENTILES = (50, 90, 99)
+
+
+class FakeRole:
+    """Role with only what the race commands look at"""
+
+    def __init__(self, role_id, name):
+        """Initialize the role"""
+        self.id = role_id
+        self.name = name
+        self.mention = '<@&{}>'.format(role_id)
+
+
+class FakeGuild:
+    """Guild with a mod role and a racer role"""
+
+    def __init__(self, guild_id=1):
+        """Initialize the guild"""
+        self.id = guild_id
+        self.roles = [FakeRole(1, 'race mod'), FakeRole(2, 'racer')]
+
+
+class FakeMember:
+    """Guild member, optionally holding the mod role"""
+
+    def __init__(self, member_id, guild, mod=False):
+        """Initialize the member"""
+        self.id = member_id
+        self.name = 'racer{}'.format(member_id)
+        self.guild = guild
+        self.roles = [guild.roles[0]] if mod else []
+
+    def __str__(self):
+        return '{}#0001'.format(self.name)
+
+
+class FakeMessage:
+    """Sent or received message, editing and pinning do nothing"""
+
+    def __init__(self, channel, content, author=None):
+        """Initialize a message created now"""
+        self.channel = channel
+        self.content = content
+        self.author = author
+        self.guild = channel.guild
+        self.created_at = datetime.now(timezone.utc)
+        self.attachments = []
+
+    async def edit(self, content=None, **_):
+        """Does nothing but keep the new content"""
+        self.content = content
+
+    async def pin(self):
+        """Does nothing"""
+
+    async def unpin(self):
+        """Does nothing"""
+
+
+class FakeChannel:
+    """Channel whose sends do nothing but count"""
+
+    def __init__(self, channel_id, guild):
+        """Initialize the channel"""
+        self.id = channel_id
+        self.guild = guild
+        self.sent = 0
+
+    async def send(self, content=None, **_):
+        """Returns a message without sending it anywhere"""
+        self.sent += 1
+        return FakeMessage(self, content)
+
+
+class FakeCommand:
+    """Invoked command, as seen by the cog's before invoke hook"""
+
+    def __init__(self, name):
+        """Initialize the command"""
+        self.name = name
+        self.qualified_name = name
+
+
+class FakeContext:
+    """Context of a command sent now"""
+
+    def __init__(self, author, channel, command):
+        """Initialize the context"""
+        self.author = author
+        self.guild = channel.guild
+        self.channel = channel
+        self.command = command
+        self.message = FakeMessage(channel, '', author)
+
+    async def send(self, content=None, **kwargs):
+        """Sends to the context's channel"""
+        return await self.channel.send(content, **kwargs)
+
+
+class FakeBot:
+    """Bot knowing only the benchmark channel"""
+
+    def __init__(self, channel):
+        """Initialize the bot"""
+        self.channel = channel
+        self.latency = 0.0
+
+    def get_channel(self, channel_id):
+        """Returns the benchmark channel if the ID matches"""
+        return self.channel if channel_id == self.channel.id else None
+
+
+def synthetic_stream(num_racers, results_spam=50, countdown_wait=1.5):
+    """Returns the steps of a race with the given number of racers"""
+    racers = range(1, num_racers + 1)
+    steps = [
+        {'phase': 'setup', 'command': 'createrace', 'user': 0,
+         'await': True},
+        {'phase': 'setup', 'command': 'setgoal', 'user': 0,
+         'args': {'_goal': 'any%'}, 'await': True},
+        {'phase': 'setup', 'command': 'setgame', 'user': 0,
+         'args': {'_game': 'Doom'}, 'await': True}
+    ]
+    steps.extend({'phase': 'join storm', 'command': 'join', 'user': racer}
+                 for racer in racers)
+    steps.extend({'phase': 'ready burst', 'command': 'ready', 'user': racer}
+                 for racer in racers)
+    steps.append({'phase': 'start', 'command': 'startrace', 'user': 0})
+    steps.extend({'phase': 'finish burst', 'command': 'done', 'user': racer,
+                  'wait': countdown_wait if racer == 1 else 0}
+                 for racer in racers)
+    for index in range(results_spam):
+        steps.append({'phase': 'results spam', 'command': 'results',
+                      'user': index % num_racers + 1})
+        steps.append({'phase': 'results spam', 'command': 'entrants',
+                      'user': index % num_racers + 1})
+    steps.append({'phase': 'end', 'command': 'endrace', 'user': 0})
+    return steps
+
+
+def read_stream(path):
+    """Reads the steps of a stream from a JSON lines file"""
+    with io.open(path, encoding='utf8') as stream_file:
+        return [json.loads(line) for line in stream_file if line.strip()]
+
+
+def write_stream(path, steps):
+    """Writes the steps of a stream to a JSON lines file"""
+    with io.open(path, 'w', encoding='utf8') as stream_file:
+        for step in steps:
+            stream_file.write(json.dumps(step) + '\n')
+
+
+def percentile(ordered, percent):
+    """Returns the nearest rank percentile of sorted values"""
+    if not ordered:
+        return 0.0
+    rank = max(int(round(percent / 100 * len(ordered))), 1)
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+class Benchmark:
+    """Replays command streams against a race cog"""
+
+    def __init__(self, rate_limits=False, live_boards=True,
+                 allocations=False):
+        """Initialize a cog in a fresh guild and channel
+
+        Without rate limits the message scheduler sends everything right
+        away, so latencies measure the handlers and not the deliberate
+        waits. The countdown is skipped, a race starts a second after
+        startrace.
+        """
+        self.guild = FakeGuild()
+        self.channel = FakeChannel(10, self.guild)
+        self.cog = race_bot.Race(FakeBot(self.channel),
+                                 live_boards=live_boards)
+        self.cog.COUNTDOWN_TICKS = ()
+        if not rate_limits:
+            self.cog._scheduler.rate = 1 << 30
+            self.cog._scheduler.coalesce_window = 0.0
+        self.allocations = allocations
+        self._members = {}
+
+    def member(self, user):
+        """Returns the fake member for a user index"""
+        member = self._members.get(user)
+        if member is None:
+            member = self._members[user] = FakeMember(user, self.guild,
+                                                      mod=user == 0)
+        return member
+
+    async def run_command(self, step, latencies):
+        """Runs a single command and records its latency"""
+        name = step['command']
+        ctx = FakeContext(self.member(step['user']), self.channel,
+                          FakeCommand(name))
+        callback = getattr(type(self.cog), name)
+        # Commands are discord.py Command objects wrapping the handler
+        callback = getattr(callback, 'callback', callback)
+        start = time.perf_counter()
+        await self.cog.cog_before_invoke(ctx)
+        await callback(self.cog, ctx, **step.get('args', {}))
+        latencies.setdefault(name, []).append(time.perf_counter() - start)
+
+    def race_state(self):
+        """Returns whether the race is created and started and its counts"""
+        race = self.cog._races.find((self.guild.id, self.channel.id))
+        if race is None:
+            return {'created': False, 'started': False, 'racers': 0,
+                    'finished': 0}
+        return {'created': race.created, 'started': race.started,
+                'racers': race.num_racers or 0,
+                'finished': race.num_finished or 0}
+
+    async def run_phase(self, steps):
+        """Runs the steps of a phase, returns its report"""
+        latencies = {}
+        sent = self.channel.sent
+        if self.allocations:
+            tracemalloc.start()
+            blocks = sum(stat.count for stat in
+                         tracemalloc.take_snapshot().statistics('filename'))
+        # A wait before the first command is not part of the phase
+        if steps[0].get('wait'):
+            await asyncio.sleep(steps[0]['wait'])
+        start = time.perf_counter()
+        pending = []
+        for index, step in enumerate(steps):
+            if index and step.get('wait'):
+                await asyncio.sleep(step['wait'])
+            command = asyncio.ensure_future(self.run_command(step, latencies))
+            if step.get('await'):
+                await command
+            else:
+                pending.append(command)
+        await asyncio.gather(*pending)
+        elapsed = time.perf_counter() - start
+
+        report = {
+            'commands': len(steps),
+            'seconds': elapsed,
+            'throughput': len(steps) / elapsed if elapsed else 0.0,
+            'messages': self.channel.sent - sent,
+            'race': self.race_state(),
+            'latency': {}
+        }
+        if self.allocations:
+            report['peak_kib'] = tracemalloc.get_traced_memory()[1] / 1024
+            report['net_blocks'] = sum(
+                stat.count for stat in
+                tracemalloc.take_snapshot().statistics('filename')
+            ) - blocks
+            tracemalloc.stop()
+        for name, values in latencies.items():
+            values.sort()
+            command_report = {
+                'count': len(values),
+                'mean': sum(values) / len(values),
+                'max': values[-1]
+            }
+            for percent in PERCENTILES:
+                command_report['p{}'.format(percent)] = percentile(values,
+                                                                   percent)
+            report['latency'][name] = command_report
+        return report
+
+    async def run(self, steps):
+        """Runs a stream phase by phase, returns the report of each phase"""
+        phases = []
+        for step in steps:
+            phase = step.get('phase', 'stream')
+            if not phases or phases[-1][0] != phase:
+                phases.append((phase, []))
+            phases[-1][1].append(step)
+        reports = []
+        for phase, phase_steps in phases:
+            report = await self.run_phase(phase_steps)
+            report['phase'] = phase
+            reports.append(report)
+        await self.cog.flush()
+        return reports
+
+
+def check_synthetic(reports, num_racers):
+    """Raises RuntimeError if the generated race did not run as planned"""
+    race = {report['phase']: report['race'] for report in reports}
+    finish = race.get('finish burst')
+    if finish is None or not finish['started']:
+        raise RuntimeError('The race never started, check the setup phase')
+    if finish['finished'] != num_racers:
+        raise RuntimeError('Only {} of {} racers finished'.format(
+            finish['finished'], num_racers
+        ))
+    if race['end']['created']:
+        raise RuntimeError('The race did not end')
+
+
+async def guild_memory(num_guilds, num_racers, live_boards=True):
+    """Returns the traced bytes the race cog holds per guild
+
+    Every guild gets a channel with a created race that num_racers racers
+    joined. Only the cog's own state is measured, the fake members and
+    guilds are created before tracing starts.
+    """
+    guilds = [FakeGuild(guild_id) for guild_id in range(1, num_guilds + 1)]
+    channels = [FakeChannel(guild.id * 1000, guild) for guild in guilds]
+    members = [[FakeMember(0, guild, mod=True)] +
+               [FakeMember(racer, guild)
+                for racer in range(1, num_racers + 1)]
+               for guild in guilds]
+    cog = race_bot.Race(FakeBot(channels[0]), live_boards=live_boards)
+    cog._scheduler.rate = 1 << 30
+    cog._scheduler.coalesce_window = 0.0
+    commands = [getattr(type(cog), name) for name in ('createrace', 'join')]
+    createrace, join = [getattr(command, 'callback', command)
+                        for command in commands]
+
+    gc.collect()
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    for channel, guild_members in zip(channels, members):
+        await createrace(cog, FakeContext(guild_members[0], channel,
+                                          FakeCommand('createrace')))
+        for member in guild_members[1:]:
+            await join(cog, FakeContext(member, channel, FakeCommand('join')))
+    await asyncio.sleep(0)
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    await cog.flush()
+    return used / num_guilds
+
+
+def format_report(reports):
+    """Returns the lines of a human readable report"""
+    lines = []
+    for report in reports:
+        line = '{phase}: {commands} commands in {seconds:.3f}s, ' \
+               '{throughput:.0f}/s, {messages} messages'.format(**report)
+        if 'peak_kib' in report:
+            line += ', peak {:.0f} KiB, {:+d} blocks'.format(
+                report['peak_kib'], report['net_blocks']
+            )
+        lines.append(line)
+        lines.append('  race: created={created} started={started} '
+                     'racers={racers} finished={finished}'.format(
+                         **report['race']
+                     ))
+        for name, latency in sorted(report['latency'].items()):
+            lines.append(
+                '  {name:<10} n={count:<5} mean={mean_ms:.3f}ms '
+                'p50={p50_ms:.3f}ms p90={p90_ms:.3f}ms p99={p99_ms:.3f}ms '
+                'max={max_ms:.3f}ms'.format(
+                    name=name,
+                    count=latency['count'],
+                    mean_ms=latency['mean'] * 1000,
+                    p50_ms=latency['p50'] * 1000,
+                    p90_ms=latency['p90'] * 1000,
+                    p99_ms=latency['p99'] * 1000,
+                    max_ms=latency['max'] * 1000
+                )
+            )
+    return lines
+
+
+def main():
+    """Runs the benchmark from the command line"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--racers', type=int, default=500,
+                        help='number of racers in the generated stream')
+    parser.add_argument('--results-spam', type=int, default=50,
+                        help='number of !results and !entrants pairs')
+    parser.add_argument('--stream', help='JSON lines stream to replay')
+    parser.add_argument('--save-stream',
+                        help='write the replayed stream to this file')
+    parser.add_argument('--rate-limits', action='store_true',
+                        help='keep the message rate limits and coalescing')
+    parser.add_argument('--no-live-boards', action='store_true',
+                        help='run without live race boards')
+    parser.add_argument('--allocations', action='store_true',
+                        help='trace memory allocations, which is slower')
+    parser.add_argument('--json', help='write the report to this file')
+    parser.add_argument('--guilds', type=int,
+                        help='instead of a stream, measure the memory per '
+                             'guild with a race of --racers racers in this '
+                             'many guilds')
+    args = parser.parse_args()
+
+    if args.guilds:
+        per_guild = asyncio.get_event_loop().run_until_complete(
+            guild_memory(args.guilds, args.racers,
+                         not args.no_live_boards)
+        )
+        print('{:.1f} KiB per guild with a race of {} racers'.format(
+            per_guild / 1024, args.racers
+        ))
+        return
+
+    if args.stream:
+        steps = read_stream(args.stream)
+    else:
+        steps = synthetic_stream(args.racers, args.results_spam)
+    if args.save_stream:
+        write_stream(args.save_stream, steps)
+
+    # Race result files are written to the working directory
+    cwd = os.getcwd()
+    work_dir = tempfile.mkdtemp(prefix='race_bench')
+    os.chdir(work_dir)
+    try:
+        benchmark = Benchmark(rate_limits=args.rate_limits,
+                              live_boards=not args.no_live_boards,
+                              allocations=args.allocations)
+        reports = asyncio.get_event_loop().run_until_complete(
+            benchmark.run(steps)
+        )
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print('\n'.join(format_report(reports)))
+    if not args.stream:
+        check_synthetic(reports, args.racers)
+    if args.json:
+        with io.open(args.json, 'w', encoding='utf8') as report_file:
+            json.dump(reports, report_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
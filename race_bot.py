@@ -1,54 +1,801 @@
 """Discord bot for racing games"""
 
 import asyncio
-import io
-import operator
-
-from datetime import datetime
+import bisect
+import collections
+import functools
+import itertools
+import os
+import time
+
+from array import array
+from datetime import datetime, timedelta, timezone
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
 
 import discord
-import yaml
 
 from discord.ext import commands
 
+from attachment_cache import AttachmentCache
+from background_writer import BackgroundWriter
+from bot_config import load_config
+from command_throttle import CommandThrottles
+from live_board import LiveBoards
+from message_scheduler import MESSAGE_LIMIT, MessageScheduler, \
+    PRIORITY_CHATTER, PRIORITY_COUNTDOWN, PRIORITY_REPLY, PRIORITY_RESULTS, \
+    split_message
+from pack_export import PackExporter
+from race_history import RaceHistory, STATUS_FINISHED, STATUS_FORFEITED
+from race_journal import RaceJournal
+from race_metrics import MetricsServer, RaceMetrics
+from race_ratings import RaceRatings
+from race_timers import TIMERS_FILE_NAME, TimerService
+from racer import EPOCH, Racer, RacerStatus, timestamp_nanoseconds, \
+    to_nanoseconds, to_timedelta
+from role_index import RoleIndex
+
 __author__ = '4shockblast'
 
 
+class Replies:
+    """Replies of a command, each sent with its own priority
+
+    Mergeable replies are not sent again if the same message is waiting to be
+    sent to the channel or was sent to it shortly before. Each reply is sent
+    at least as urgently as the replies after it, so the replies of a command
+    always go out in order.
+    """
+
+    def __init__(self, merge=False):
+        """Initialize an empty list of replies"""
+        self._messages = []
+        self.merge = merge
+
+    def __iter__(self):
+        ordered = []
+        priority = None
+        for reply_priority, content in reversed(self._messages):
+            if priority is None or reply_priority < priority:
+                priority = reply_priority
+            ordered.append((priority, content))
+        return reversed(ordered)
+
+    def append(self, content, priority=PRIORITY_REPLY):
+        """Adds a reply"""
+        self._messages.append((priority, content))
+
+    def extend(self, contents, priority=PRIORITY_REPLY):
+        """Adds several replies with the same priority"""
+        for content in contents:
+            self.append(content, priority)
+
+
+class Leaderboard:
+    """Standings of a race, kept up to date as racers finish or forfeit
+
+    Finished racers are kept sorted by finish time in nanoseconds,
+    forfeited racers are kept in the order they forfeited. Reading the top
+    k finishers does not need any sorting.
+    """
+
+    def __init__(self):
+        """Initialize empty standings"""
+        self._finished = []
+        self._finish_keys = {}
+        self._forfeited = {}
+        self._sequence = itertools.count()
+
+    def __len__(self):
+        return len(self._finished) + len(self._forfeited)
+
+    def finish(self, racer, time_ns):
+        """Adds a finished racer with the given time taken in nanoseconds"""
+        key = (time_ns, next(self._sequence), racer)
+        bisect.insort(self._finished, key)
+        self._finish_keys[racer] = key
+
+    def forfeit(self, racer):
+        """Adds a forfeited racer"""
+        self._forfeited[racer] = None
+
+    def remove(self, racer):
+        """Removes a finished or forfeited racer from the standings"""
+        key = self._finish_keys.pop(racer, None)
+        if key is not None:
+            del self._finished[bisect.bisect_left(self._finished, key)]
+        self._forfeited.pop(racer, None)
+
+    def finished(self, limit=None):
+        """Yields (racer, time taken in nanoseconds), fastest first"""
+        for time_ns, _, racer in itertools.islice(self._finished, limit):
+            yield racer, time_ns
+
+    def forfeited(self):
+        """Yields forfeited racers in the order they forfeited"""
+        return iter(self._forfeited)
+
+
+class RaceState:
+    """State of a single race
+
+    A race is bound to one guild channel. A fresh race state is in a not
+    created state, createrace command must be run before the race is
+    created.
+
+    Racers are keyed by user ID. All changes to the race go through the
+    methods named in JOURNAL_EVENTS, which append the change to the race
+    journal, if the race has one, so the race can be restored by replaying
+    them. Each change bumps the race version.
+    """
+    JOURNAL_EVENTS = ('create', 'start', 'end', 'set_goal', 'set_game', 'join',
+                      'unjoin', 'ready', 'unready', 'finish', 'forfeit',
+                      'resume', 'comment', 'split')
+
+    def __init__(self, key, scheduler):
+        """Initialize race state for the given registry key
+
+        Replies to the race's commands are sent through the given message
+        scheduler.
+        """
+        self.key = key
+        self._scheduler = scheduler
+        self._clear()
+
+        self.last_activity = time.time()
+        self.version = 0
+        self.reply_cache = {}
+        self.journal = None
+        self.on_change = None
+        self.on_idle = None
+        self._commands = collections.deque()
+        self._worker = None
+
+    def _clear(self):
+        """Puts the race in a not created state with no racers"""
+        self.created = False
+        self.time_created = None
+        self.starting = False
+        self.countdown = []
+        self.started = False
+        self.time_started = None
+        self.goal = None
+        self.game = None
+        self.file_name = None
+        self.num_racers = None
+        self.num_ready = None
+        self.num_finished = None
+        self.results_printed = False
+
+        self.racers = {}
+        self.leaderboard = Leaderboard()
+        self.split_names = []
+        self.split_index = {}
+        self.split_best = array('q')
+        self.split_leaders = []
+        self.best_segments = {}
+
+    def record(self, event, **data):
+        """Bumps the race version and appends a change to the race journal"""
+        self.version += 1
+        if self.journal is not None:
+            self.journal.append(self.key, event, data)
+
+    def replay(self, event, data):
+        """Applies a journaled change to the race"""
+        if event in self.JOURNAL_EVENTS:
+            getattr(self, event)(**data)
+
+    def create(self, time_created):
+        """Creates the race"""
+        self.created = True
+        self.time_created = time_created
+        self.file_name = 'race_{}.txt'.format(time_created.timestamp())
+        self.num_racers = 0
+        self.num_ready = 0
+        self.record('create', time_created=time_created)
+
+    def start(self, time_started):
+        """Starts the race for every racer at the given time"""
+        self.starting = False
+        self.countdown = []
+        self.started = True
+        self.time_started = time_started
+        start_ns = timestamp_nanoseconds(time_started)
+        for racer in self.racers.values():
+            racer.start_ns = start_ns
+        self.num_finished = 0
+        self.record('start', time_started=time_started)
+
+    def end(self):
+        """Ends the race and clears it, so a new race can be created"""
+        self._clear()
+        self.record('end')
+
+    def set_goal(self, goal):
+        """Sets the goal of the race"""
+        self.goal = goal
+        self.record('set_goal', goal=goal)
+
+    def set_game(self, game):
+        """Sets the game of the race"""
+        self.game = game
+        self.record('set_game', game=game)
+
+    def join(self, racer, name, start_ns=None):
+        """Adds a racer to the race
+
+        Racers joining a running race pass their own start time and are
+        ready right away.
+        """
+        record = Racer(racer, name)
+        if start_ns is not None:
+            record.start_ns = start_ns
+            record.ready = True
+            self.num_ready += 1
+        self.racers[racer] = record
+        self.num_racers += 1
+        self.record('join', racer=racer, name=name, start_ns=start_ns)
+
+    def unjoin(self, racer):
+        """Removes a racer from a race that has not started"""
+        record = self.racers.pop(racer)
+        self.num_racers -= 1
+        if record.ready:
+            self.num_ready -= 1
+        self.record('unjoin', racer=racer)
+
+    def ready(self, racer):
+        """Sets a racer as ready"""
+        self.racers[racer].ready = True
+        self.num_ready += 1
+        self.record('ready', racer=racer)
+
+    def unready(self, racer):
+        """Sets a racer as not ready"""
+        self.racers[racer].ready = False
+        self.num_ready -= 1
+        self.record('unready', racer=racer)
+
+    def finish(self, racer, time_ns):
+        """Sets a racer as done with the given time taken in nanoseconds"""
+        record = self.racers[racer]
+        record.status = RacerStatus.FINISHED
+        record.time_ns = time_ns
+        record.comment = ''
+        self.leaderboard.finish(racer, time_ns)
+        self.num_finished += 1
+        self.record('finish', racer=racer, time_ns=time_ns)
+
+    def forfeit(self, racer):
+        """Sets a racer as forfeited"""
+        record = self.racers[racer]
+        record.status = RacerStatus.FORFEITED
+        record.comment = ''
+        self.leaderboard.forfeit(racer)
+        self.num_finished += 1
+        self.record('forfeit', racer=racer)
+
+    def resume(self, racer):
+        """Puts a racer who finished or forfeited back in the race"""
+        record = self.racers[racer]
+        record.status = RacerStatus.RACING
+        record.time_ns = None
+        self.leaderboard.remove(racer)
+        self.num_finished -= 1
+        self.results_printed = False
+        self.record('resume', racer=racer)
+
+    def comment(self, racer, comment):
+        """Sets the comment of a racer who finished or forfeited"""
+        self.racers[racer].comment = comment
+        self.results_printed = False
+        self.record('comment', racer=racer, comment=comment)
+
+    def split(self, racer, name, time_ns):
+        """Logs a racer's split with the given time in nanoseconds
+
+        Split names are numbered in the order they are first logged in the
+        race, and the fastest time of each split is kept.
+        """
+        index = self.split_index.get(name)
+        if index is None:
+            index = self.split_index[name] = len(self.split_names)
+            self.split_names.append(name)
+            self.split_best.append(time_ns)
+            self.split_leaders.append(racer)
+        elif (self.split_leaders[index] is None or
+              time_ns < self.split_best[index]):
+            self.split_best[index] = time_ns
+            self.split_leaders[index] = racer
+        self.racers[racer].set_split(index, time_ns)
+        self.record('split', racer=racer, name=name, time_ns=time_ns)
+
+    def standings(self):
+        """Yields the racer records in results order
+
+        Finished racers come first, fastest first, then forfeited racers in
+        the order they forfeited, then racers who did not set an end status.
+        """
+        for racer, _ in self.leaderboard.finished():
+            yield self.racers[racer]
+        for racer in self.leaderboard.forfeited():
+            yield self.racers[racer]
+        for record in self.racers.values():
+            if record.status is RacerStatus.RACING:
+                yield record
+
+    def to_history(self):
+        """Returns the race results as a record for the race history"""
+        results = []
+        for place, record in enumerate(self.standings(), 1):
+            time_taken = None
+            if record.status is RacerStatus.FINISHED:
+                time_taken = record.time_taken()
+            segments = {}
+            for index, name in enumerate(self.split_names):
+                time_ns = record.split_time(index)
+                if time_ns is not None:
+                    segments[name] = to_timedelta(
+                        time_ns - record.previous_split_time(index)
+                    )
+            results.append({
+                'racer_id': record.id,
+                'racer_name': record.name,
+                'place': place,
+                'status': record.status.value,
+                'time_taken': time_taken,
+                'comment': record.comment,
+                'segments': segments
+            })
+        return {
+            'guild_id': self.key[0],
+            'channel_id': self.key[1],
+            'game': self.game,
+            'goal': self.goal,
+            'time_started': self.time_started,
+            'results': results
+        }
+
+    def to_dict(self):
+        """Returns the race state as a dict for snapshots"""
+        return {
+            'key': list(self.key),
+            'created': self.created,
+            'time_created': self.time_created,
+            'started': self.started,
+            'time_started': self.time_started,
+            'goal': self.goal,
+            'game': self.game,
+            'num_racers': self.num_racers,
+            'num_ready': self.num_ready,
+            'num_finished': self.num_finished,
+            'racers': [racer.to_dict() for racer in self.racers.values()],
+            'forfeited': list(self.leaderboard.forfeited()),
+            'split_names': self.split_names
+        }
+
+    @classmethod
+    def from_dict(cls, data, scheduler):
+        """Restores a race state from a snapshot dict"""
+        race = cls(tuple(data['key']), scheduler)
+        race.created = data['created']
+        race.time_created = data['time_created']
+        race.started = data['started']
+        race.time_started = data['time_started']
+        race.goal = data['goal']
+        race.game = data['game']
+        race.file_name = 'race_{}.txt'.format(race.time_created.timestamp())
+        race.num_racers = data['num_racers']
+        race.num_ready = data['num_ready']
+        race.num_finished = data['num_finished']
+        for racer_data in data['racers']:
+            record = Racer.from_dict(racer_data)
+            race.racers[record.id] = record
+            if record.status is RacerStatus.FINISHED:
+                race.leaderboard.finish(record.id, record.time_ns)
+        for racer in data['forfeited']:
+            race.leaderboard.forfeit(racer)
+        for name in data.get('split_names', ()):
+            index = race.split_index[name] = len(race.split_names)
+            race.split_names.append(name)
+            race.split_best.append(0)
+            race.split_leaders.append(None)
+            for record in race.racers.values():
+                time_ns = record.split_time(index)
+                if time_ns is None:
+                    continue
+                if (race.split_leaders[index] is None or
+                        time_ns < race.split_best[index]):
+                    race.split_best[index] = time_ns
+                    race.split_leaders[index] = record.id
+        return race
+
+    def submit(self, transition, ctx, *args):
+        """Queues a command on the race
+
+        Commands on a race are processed one at a time in the order they were
+        submitted, so handlers never interleave. A transition is a plain
+        function taking the race, the command context and the command
+        arguments, which updates the race state and returns the replies to
+        send. If the transition changed the race, on_change is called with the
+        race and the command channel, and on_idle is called with the race
+        once the queue is empty. The returned future is done once the replies
+        are sent.
+        """
+        future = asyncio.get_event_loop().create_future()
+        self._commands.append((transition, ctx, args, future))
+        if self._worker is None:
+            self._worker = asyncio.ensure_future(self._process_commands())
+        return future
+
+    async def _process_commands(self):
+        """Processes queued commands until the queue is empty
+
+        Replies are handed to the message scheduler rather than sent inline,
+        so a burst of commands is never held back by message round trips.
+        """
+        try:
+            while self._commands:
+                transition, ctx, args, future = self._commands.popleft()
+                version = self.version
+                try:
+                    replies = transition(self, ctx, *args)
+                except Exception as exc:
+                    if not future.done():
+                        future.set_exception(exc)
+                    continue
+                sent = asyncio.gather(*[
+                    self._scheduler.send(ctx.channel, content, priority,
+                                         replies.merge)
+                    for priority, content in replies
+                ])
+                sent.add_done_callback(
+                    functools.partial(self._replies_sent, future)
+                )
+                # After the replies, so a board posted now goes out after them
+                if self.version != version and self.on_change is not None:
+                    self.on_change(self, ctx.channel)
+        finally:
+            self._worker = None
+            if self.on_idle is not None:
+                self.on_idle(self)
+
+    @staticmethod
+    def _replies_sent(future, sent):
+        """Completes a command future once all its replies are sent"""
+        if future.done():
+            return
+        if sent.cancelled():
+            future.cancel()
+        elif sent.exception() is not None:
+            future.set_exception(sent.exception())
+        else:
+            future.set_result(None)
+
+
+class RaceRegistry:
+    """Registry of races keyed by (guild ID, channel ID)
+
+    Only created races are stored. Looking up a channel without a race
+    returns a not created race state, which is kept while it has queued
+    commands, so commands sent right behind !createrace queue behind it on
+    the same race. Once its queue is empty it is dropped, so read-only
+    commands in random channels do not grow the registry. Registered races
+    call on_change, if set, whenever a command changes them.
+    """
+
+    def __init__(self, scheduler):
+        """Initialize an empty registry"""
+        self._scheduler = scheduler
+        self._journal = None
+        self.on_change = None
+        self._races = {}
+        self._pending = {}
+
+    def __len__(self):
+        return len(self._races)
+
+    def __iter__(self):
+        return iter(self._races.values())
+
+    @staticmethod
+    def key_for(ctx):
+        """Returns the registry key for the channel a command was sent in"""
+        guild_id = ctx.guild.id if ctx.guild is not None else None
+        return guild_id, ctx.channel.id
+
+    def get(self, ctx):
+        """Returns the race for the context's channel
+
+        Returns the pending not created race state if the channel has no
+        race, a new one if it has none either. Commands must be submitted to
+        it right away, it is only kept while it has queued commands.
+        """
+        key = self.key_for(ctx)
+        race = self._races.get(key)
+        if race is None:
+            race = self._pending.get(key)
+        if race is None:
+            race = self._pending[key] = RaceState(key, self._scheduler)
+            race.on_idle = self._release
+        return race
+
+    def _release(self, race):
+        """Drops a pending race once its queue is empty"""
+        if self._pending.get(race.key) is race:
+            del self._pending[race.key]
+
+    def register(self, race):
+        """Registers a race for its channel
+
+        Returns the race already registered for the channel if there is one,
+        otherwise the given race.
+        """
+        registered = self._races.setdefault(race.key, race)
+        if registered is race:
+            self._release(race)
+            race.journal = self._journal
+            race.on_change = self.on_change
+            race.on_idle = self._release
+        return registered
+
+    def restore(self, journal):
+        """Restores the races kept in a journal
+
+        Loads the latest snapshot, replays the events journaled after it and
+        compacts the journal into a new snapshot. From then on every change to
+        a registered race is journaled. Events of channels without a created
+        race and events that cannot be applied are logged and skipped, so a
+        bad journal entry never keeps the bot from starting.
+        """
+        snapshot, events = journal.load()
+        for data in snapshot:
+            race = RaceState.from_dict(data, self._scheduler)
+            self._races[race.key] = race
+        for key, event, data in events:
+            race = self._races.get(key)
+            if race is None:
+                if event != 'create':
+                    print('Skipping journaled {} event for {}, no race was '
+                          'created'.format(event, key))
+                    continue
+                race = self._races[key] = RaceState(key, self._scheduler)
+            try:
+                race.replay(event, data)
+            except Exception as exc:
+                print('Skipping journaled {} event for {}: {!r}'.format(
+                    event, key, exc
+                ))
+            if not race.created:
+                del self._races[key]
+
+        self._journal = journal
+        for race in self._races.values():
+            race.journal = journal
+            race.on_change = self.on_change
+            race.on_idle = self._release
+        journal.snapshot_source = self.__iter__
+        journal.snapshot(self)
+
+    def find(self, key):
+        """Returns the registered race with the given key, None if none"""
+        return self._races.get(key)
+
+    def evict(self, race):
+        """Removes a finished race from the registry
+
+        Races are evicted while running their commands, the race is kept as
+        the pending race of its channel until the rest of its queue is done.
+        """
+        if self._races.get(race.key) is race:
+            del self._races[race.key]
+            self._pending.setdefault(race.key, race)
+
+
+class TimerContext:
+    """Stands in for a command context when a timer acts on a race"""
+
+    __slots__ = ('guild', 'channel', 'author')
+
+    def __init__(self, channel):
+        """Initialize a context for the race of a channel"""
+        self.channel = channel
+        self.guild = getattr(channel, 'guild', None)
+        self.author = None
+
+
+class CommandThrottled(commands.CheckFailure):
+    """A command was dropped for going over a throttle limit"""
+
+
 class Race(commands.Cog):
     """Race object
 
     Provides functionality to create, start, end races as well as functionality
     for racers to participate in races
     """
-    RESULT_LINE_TEMPLATE = '{prev_results}{idx}. {racer} {time} {comments}\n'
-    RESULT_LINE_NO_FINISH_TEMPLATE = '{prev_results}{idx}. {racer}\n'
-    RESULT_FILE_LINE_TEMPLATE = '{prev_results}{idx}.|{racer}|{time}\n' \
-                                '{comments}\n'
-    RESULT_FILE_LINE_NO_FINISH_TEMPLATE = '{prev_results}{idx}.|{racer}\n'
+    RESULT_LINE_TEMPLATE = '{idx}. {racer} {time} {comments}'
+    RESULT_LINE_NO_FINISH_TEMPLATE = '{idx}. {racer}'
+    RESULT_FILE_LINE_TEMPLATE = '{idx}.|{racer}|{time}\n{comments}\n'
+    RESULT_FILE_LINE_NO_FINISH_TEMPLATE = '{idx}.|{racer}\n'
+    COUNTDOWN_TICKS = ('5', '4', '3', '2', '1')
+    REMINDER_MINUTES = (15, 5)
+    SCHEDULE_TIME_FORMAT = '%Y-%m-%d %H:%M'
+    MAX_SCHEDULE_AHEAD = timedelta(days=366)
+
+    def __init__(self, _bot, message_timestamps=True, journal=None,
+                 writer=None, history=None, roles=None, timers=None,
+                 idle_timeout=None, live_boards=True, metrics_address=None,
+                 throttles=None, running_idle_timeout=None):
+        """Initialize the race cog
+
+        No race is created until a createrace command is run in a channel,
+        each channel can hold its own race. With message timestamps, join and
+        finish times are taken from when the command message was sent rather
+        than from when its handler runs. If a race journal is given, races
+        kept in it are restored and all race changes are journaled to it.
+        Files are written by the given background writer, or a writer of the
+        cog's own. If a race history is given, the results of every started
+        race are written to it when the race ends, and racers are rated from
+        it. Mod and racer roles are looked up through the given role index,
+        or an index with the default role names. If a timer service is given,
+        races can be scheduled, and races without a command for idle_timeout
+        seconds are closed, or for running_idle_timeout seconds if they have
+        racers still running; without it those are kept open. With live
+        boards, each race keeps a pinned board
+        message which is edited as the race changes. Metrics are always kept,
+        and served over HTTP if a (host, port) metrics address is given. If
+        command throttles are given, they are added to the bot as a check run
+        once per command, and commands over their limits are dropped before
+        they reach a handler.
+        """
+        self.bot = _bot
+        self.message_timestamps = message_timestamps
+        self.metrics = RaceMetrics()
+        self._metrics_server = None
+        if metrics_address is not None:
+            self._metrics_server = MetricsServer(self.metrics,
+                                                 *metrics_address)
+        self._writer = writer if writer is not None else BackgroundWriter()
+        self._journal = journal
+        self._history = history
+        self._roles = roles if roles is not None else RoleIndex()
+        self._throttles = throttles
+        if throttles is not None:
+            # Checks run once are skipped by !help, so it is not counted
+            _bot.add_check(self.check_throttles, call_once=True)
+        self._ratings = None
+        if history is not None:
+            self._ratings = RaceRatings(history)
+        self._scheduler = MessageScheduler()
+        self._scheduler.on_send = self.metrics.observe_send
+        self._pack_exporter = PackExporter(self._writer)
+        self._attachment_cache = AttachmentCache(self._writer)
+        self._races = RaceRegistry(self._scheduler)
+        self._boards = None
+        if live_boards:
+            self._boards = LiveBoards(self._scheduler)
+            self._races.on_change = self.update_board
+        if journal is not None:
+            self._races.restore(journal)
+        self.idle_timeout = idle_timeout
+        self.running_idle_timeout = running_idle_timeout
+        self._timers = timers
+        if timers is not None:
+            timers.register('create', self._on_create_timer)
+            timers.register('start', self._on_start_timer)
+            timers.register('remind', self._on_remind_timer)
+            timers.register('idle', self._on_idle_timer)
+            timers.load()
+        self.register_metrics()
+
+    def register_metrics(self):
+        """Registers the values read from the bot and cog as metrics"""
+        metrics = self.metrics
+        metrics.register('gateway_latency_seconds', 'gauge',
+                         'Latency of the gateway heartbeat.',
+                         lambda: self.bot.latency)
+        metrics.register('races', 'gauge', 'Created races.',
+                         lambda: len(self._races))
+        metrics.register('message_queue_depth', 'gauge',
+                         'Messages waiting to be sent.',
+                         self._scheduler.queue_depth)
+        metrics.register('messages_sent_total', 'counter', 'Messages sent.',
+                         lambda: self._scheduler.sent)
+        metrics.register('messages_coalesced_total', 'counter',
+                         'Chatter messages merged into other messages.',
+                         lambda: self._scheduler.coalesced)
+        metrics.register('messages_merged_total', 'counter',
+                         'Replies merged with an identical recent message.',
+                         lambda: self._scheduler.merged)
+        metrics.register('message_errors_total', 'counter',
+                         'Messages that failed to send.',
+                         lambda: self._scheduler.errors)
+        if self._boards is not None:
+            metrics.register('live_board_edits_total', 'counter',
+                             'Edits of live race boards.',
+                             lambda: self._boards.edits)
+        if self._timers is not None:
+            metrics.register('timers', 'gauge', 'Pending race timers.',
+                             lambda: len(self._timers))
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        """Starts firing scheduled race timers and collecting metrics"""
+        if self._timers is not None:
+            self._timers.start()
+        for race in self._races:
+            if race.started and not race.best_segments:
+                self.load_best_segments(race, list(race.racers))
+        self.metrics.start()
+        if self._metrics_server is not None:
+            try:
+                await self._metrics_server.start()
+            except OSError as exc:
+                print('Could not serve metrics: {}'.format(exc))
+
+    def cog_unload(self):
+        """Removes the throttle check from the bot"""
+        if self._throttles is not None:
+            self.bot.remove_check(self.check_throttles, call_once=True)
+
+    async def check_throttles(self, ctx):
+        """Drops race commands over a throttle limit
+
+        Runs once for each command invoked. Mods are never throttled.
+        Dropped commands fail the check, which the bot ignores, so they get
+        no reply.
+        """
+        if (ctx.command is None or ctx.command.cog is not self or
+                self.is_mod(ctx.author) or
+                self._throttles.allow(ctx.author.id, ctx.channel.id,
+                                      ctx.command.name)):
+            return True
+        self.metrics.observe_throttled(ctx.command.name)
+        raise CommandThrottled()
+
+    async def cog_before_invoke(self, ctx):
+        """Records how long the command waited before its handler ran"""
+        ctx.handler_started = time.perf_counter()
+        lag = datetime.utcnow() - self.message_time(ctx.message)
+        self.metrics.observe_command_lag(ctx.command.name,
+                                         max(lag.total_seconds(), 0.0))
+        race = self._races.find(self._races.key_for(ctx))
+        if race is not None:
+            race.last_activity = time.time()
+
+    async def cog_after_invoke(self, ctx):
+        """Records how long the command took and whether it failed"""
+        self.metrics.observe_command(
+            ctx.command.name, time.perf_counter() - ctx.handler_started,
+            getattr(ctx, 'command_failed', False)
+        )
 
-    def __init__(self, _bot):
-        """Initialize a race
+    def command_time(self, ctx):
+        """Returns the time a command happened at
 
-        Race initialized to a not created state, createrace command must be
-        run before the race is created
+        This is the message creation time, taken from the message snowflake,
+        when message timestamps are enabled, so queueing in a backed up event
+        loop does not add to racer times. Otherwise it is the current time.
         """
-        self.bot = _bot
-        self._race_created = False
-        self._time_created = None
-        self._race_started = False
-        self._time_started = None
-        self._race_goal = None
-        self._race_game = None
-        self._race_file_name = None
-        self._num_racers = None
-        self._num_ready = None
-        self._num_finished = None
-        self._results_printed = False
-
-        self._racer_dict = {}
-        self._racer_comments_dict = {}
-        self._racer_start_times_dict = {}
-        self._racer_ready_dict = {}
+        if self.message_timestamps:
+            return self.message_time(ctx.message)
+        return datetime.utcnow()
+
+    @staticmethod
+    def message_time(message):
+        """Returns the creation time of a message as a naive UTC datetime"""
+        created_at = message.created_at
+        if created_at.tzinfo is not None:
+            created_at = created_at.astimezone(timezone.utc).replace(
+                tzinfo=None
+            )
+        return created_at
 
     @commands.command(pass_context=True)
     async def createrace(self, ctx):
@@ -56,25 +803,25 @@ class Race(commands.Cog):
 
         Only mods can run this command
         """
+        await self._races.get(ctx).submit(self._createrace, ctx)
+
+    def _createrace(self, race, ctx):
+        replies = Replies()
         if self.is_mod(ctx.author):
-            if self._race_created:
-                await ctx.send('Race already created, please end the current '
+            if self._races.register(race) is not race or race.created:
+                replies.append('Race already created, please end the current '
                                'race to create a new one.')
-            elif self._race_started:
-                await ctx.send('Race already started, please end the current '
+            elif race.started:
+                replies.append('Race already started, please end the current '
                                'race to create a new one.')
             else:
-                await ctx.send('Creating race.')
-                self._time_created = datetime.utcnow()
-                self._race_created = True
-                self._race_file_name = 'race_{}.txt'.format(
-                    self._time_created.timestamp()
-                )
-                self._num_racers = 0
-                self._num_ready = 0
+                replies.append('Creating race.')
+                race.create(datetime.utcnow())
+                self.schedule_idle_close(race)
         else:
-            await ctx.send('Only members with moderator permissions can create '
+            replies.append('Only members with moderator permissions can create '
                            'races.')
+        return replies
 
     @commands.command(pass_context=True)
     async def startrace(self, ctx):
@@ -83,61 +830,87 @@ class Race(commands.Cog):
         Only mods can run this command. Performs a number of checks to ensure
         the race is set up properly.
         """
-        mention_role = '@everyone'
-        for role in ctx.message.guild.roles:
-            # Mention only racers on start race if such a role exists
-            if str(role) == 'racer':
-                mention_role = '{}'.format(role.mention)
+        await self._races.get(ctx).submit(self._startrace, ctx)
+
+    def _startrace(self, race, ctx):
+        replies = Replies()
         if self.is_mod(ctx.author):
-            if self._race_started:
-                await ctx.send('Race currently started, please end it before '
+            if race.started:
+                replies.append('Race currently started, please end it before '
                                'starting a new one.')
-            elif not self._race_created:
-                await ctx.send('No race has been created!')
-            elif self._num_racers is None or self._num_racers == 0:
-                await ctx.send('There are no racers in the race!')
-            elif self._num_ready is None or self._num_ready == 0:
-                await ctx.send('There is no one ready in the race!')
-            elif self._num_racers != self._num_ready:
-                await ctx.send('Not everyone is ready yet!')
-            elif self._race_goal is None:
-                await ctx.send('Race goal is not set yet!')
-            elif self._race_game is None:
-                await ctx.send('Race game is not set yet!')
+            elif race.starting:
+                replies.append('Race is already starting!')
+            elif not race.created:
+                replies.append('No race has been created!')
+            elif race.num_racers is None or race.num_racers == 0:
+                replies.append('There are no racers in the race!')
+            elif race.num_ready is None or race.num_ready == 0:
+                replies.append('There is no one ready in the race!')
+            elif race.num_racers != race.num_ready:
+                replies.append('Not everyone is ready yet!')
+            elif race.goal is None:
+                replies.append('Race goal is not set yet!')
+            elif race.game is None:
+                replies.append('Race game is not set yet!')
             else:
-                await ctx.send('Starting race...')
-                await asyncio.sleep(1)
-                await ctx.send('5')
-                await asyncio.sleep(1)
-                await ctx.send('4')
-                await asyncio.sleep(1)
-                await ctx.send('3')
-                await asyncio.sleep(1)
-                await ctx.send('2')
-                await asyncio.sleep(1)
-                await ctx.send('1')
-                await asyncio.sleep(1)
-                await ctx.send('{}, start!'.format(mention_role))
-
-                self._time_started = datetime.utcnow()
-                self._race_started = True
-
-                for racer in self._racer_dict:
-                    self._racer_start_times_dict[racer] = self._time_started
-
-                race_start_file_name = 'raceStartTime_{}.txt'.format(
-                    self._time_created.timestamp()
-                )
-                with open(race_start_file_name, 'w+') as race_start_time_file:
-                    race_start_time_file.write('Race time: {}\n'.format(
-                        self._time_started
-                    ))
-                    race_start_time_file.close()
-
-                self._num_finished = 0
+                replies.append('Starting race...', PRIORITY_COUNTDOWN)
+                race.starting = True
+                self.schedule_countdown(ctx, race,
+                                        self.mention_role(ctx.guild))
         else:
-            await ctx.send('Only members with moderator permissions can start '
+            replies.append('Only members with moderator permissions can start '
                            'races.')
+        return replies
+
+    def mention_role(self, guild):
+        """Returns the mention for the racers of a guild
+
+        Mention only racers on start race if such a role exists
+        """
+        racer_role = self._roles.racer_role(guild)
+        if racer_role is not None:
+            return '{}'.format(racer_role.mention)
+        return '@everyone'
+
+    def schedule_countdown(self, ctx, race, mention_role):
+        """Schedules the countdown ticks and the race start
+
+        Ticks are scheduled at absolute deadlines one second apart on the
+        event loop's monotonic clock, so slow sends cannot stretch the
+        countdown. The race start time is the planned start instant, not the
+        time the start message goes out.
+        """
+        loop = asyncio.get_event_loop()
+        countdown_start = loop.time()
+        go_delay = len(self.COUNTDOWN_TICKS) + 1
+        race.time_started = datetime.utcnow() + timedelta(seconds=go_delay)
+        race.countdown = [
+            loop.call_at(countdown_start + delay, self._scheduler.send,
+                         ctx.channel, tick, PRIORITY_COUNTDOWN)
+            for delay, tick in enumerate(self.COUNTDOWN_TICKS, 1)
+        ]
+        race.countdown.append(loop.call_at(
+            countdown_start + go_delay, race.submit, self._go, ctx,
+            mention_role
+        ))
+
+    def _go(self, race, ctx, mention_role):
+        replies = Replies()
+        # The race may have been ended during the countdown
+        if race.created and race.starting:
+            replies.append('{}, start!'.format(mention_role),
+                           PRIORITY_COUNTDOWN)
+            race.start(race.time_started)
+            race.last_activity = time.time()
+            self.load_best_segments(race, list(race.racers))
+
+            race_start_file_name = 'raceStartTime_{}.txt'.format(
+                race.time_created.timestamp()
+            )
+            self._writer.write(race_start_file_name, 'Race time: {}\n'.format(
+                race.time_started
+            ))
+        return replies
 
     @commands.command(pass_context=True)
     async def endrace(self, ctx):
@@ -149,30 +922,300 @@ class Race(commands.Cog):
         all players completed the race (for instance, a comment was added),
         this will also print out the results.
         """
+        await self._races.get(ctx).submit(self._endrace, ctx)
+
+    def _endrace(self, race, ctx):
+        replies = Replies()
         if self.is_mod(ctx.author):
-            if not self._race_created:
-                await ctx.send('No race has been created!')
+            if not race.created:
+                replies.append('No race has been created!')
             else:
-                await ctx.send('The race has ended!')
-                if self._race_started and not self._results_printed:
-                    await self.output_results(ctx, True)
-
-                self._race_created = False
-                self._time_created = None
-                self._race_started = False
-                self._time_started = None
-                self._racer_dict = {}
-                self._racer_comments_dict = {}
-                self._racer_start_times_dict = {}
-                self._racer_ready_dict = {}
-                self._race_goal = None
-                self._race_game = None
-                self._race_file_name = None
-                self._num_racers = None
-                self._num_ready = None
+                replies.append('The race has ended!')
+                self.close_race(race, replies)
         else:
-            await ctx.send('Only members with moderator permissions can end '
+            replies.append('Only members with moderator permissions can end '
                            'races.')
+        return replies
+
+    def close_race(self, race, replies):
+        """Ends a race, adding its results to the replies if not yet output"""
+        for handle in race.countdown:
+            handle.cancel()
+        if race.started and not race.results_printed:
+            replies.extend(self.output_results(race, True), PRIORITY_RESULTS)
+        if race.started and self._history is not None:
+            history_record = race.to_history()
+            self._history.record_race(history_record)
+            self._ratings.rate_race(history_record)
+        if self._boards is not None:
+            # Ending clears the race, so the final board is rendered now
+            content = self.board_content(race, True)
+            self._boards.close(race.key, lambda: content)
+        if self._timers is not None:
+            # Starts scheduled for the next race are kept
+            created = race.time_created.timestamp()
+            for timer in self._timers.timers_for(race.key, ('start', 'remind',
+                                                            'idle')):
+                if (timer.kind == 'idle' or
+                        timer.data.get('race') == created):
+                    self._timers.cancel(timer)
+
+        race.end()
+        self._races.evict(race)
+
+    @commands.command(pass_context=True)
+    async def schedulerace(self, ctx, *, when: str):
+        """Schedules the race to be created.
+
+        Only mods can run this command. The time is in UTC, as
+        YYYY-MM-DD HH:MM, or a number of minutes from now, as +MINUTES.
+        """
+        await self.schedule_timer(ctx, 'create', when, 'Race creation')
+
+    @commands.command(pass_context=True)
+    async def schedulestart(self, ctx, *, when: str):
+        """Schedules the race to start, whether everyone is ready or not.
+
+        Only mods can run this command. The time is given like for
+        schedulerace. Racers are reminded 15 and 5 minutes before the start.
+        """
+        await self.schedule_timer(ctx, 'start', when, 'Race start')
+
+    async def schedule_timer(self, ctx, kind, when, description):
+        """Schedules a timer of a kind for the race of the context
+
+        A start scheduled while a race is created but not started is tied to
+        that race and cancelled if it ends. Otherwise it is for the next race.
+        """
+        if self._timers is None:
+            await self.send_lines(ctx.channel, ['Race scheduling is not '
+                                                'enabled!'])
+            return
+        if not self.is_mod(ctx.author):
+            await self.send_lines(ctx.channel, ['Only members with moderator '
+                                                'permissions can schedule '
+                                                'races.'])
+            return
+        scheduled_time = self.parse_schedule_time(when)
+        if scheduled_time is None:
+            await self.send_lines(ctx.channel, [
+                'Please give the time as YYYY-MM-DD HH:MM in UTC or as '
+                '+MINUTES from now, at most a year ahead.'
+            ])
+            return
+        due = (scheduled_time - EPOCH).total_seconds()
+        if due <= time.time():
+            await self.send_lines(ctx.channel, ['That time has already '
+                                                'passed!'])
+            return
+
+        key = self._races.key_for(ctx)
+        self._timers.cancel_race(key, (kind,))
+        if kind != 'start':
+            self._timers.schedule(kind, due, key)
+        else:
+            race = self._races.find(key)
+            race_data = {}
+            if race is not None and race.created and not race.started:
+                race_data['race'] = race.time_created.timestamp()
+            self._timers.schedule(kind, due, key, **race_data)
+            self._timers.cancel_race(key, ('remind',))
+            for minutes in self.REMINDER_MINUTES:
+                if due - minutes * 60 > time.time():
+                    self._timers.schedule('remind', due - minutes * 60, key,
+                                          minutes=minutes, **race_data)
+        await self.send_lines(ctx.channel, ['{} scheduled for {} UTC.'.format(
+            description, scheduled_time.strftime(self.SCHEDULE_TIME_FORMAT)
+        )])
+
+    @commands.command(pass_context=True)
+    async def schedule(self, ctx):
+        """Returns the scheduled race actions in the channel."""
+        if self._timers is None:
+            await self.send_lines(ctx.channel, ['Race scheduling is not '
+                                                'enabled!'])
+            return
+        timers = self._timers.timers_for(self._races.key_for(ctx),
+                                         ('create', 'start'))
+        if not timers:
+            await self.send_lines(ctx.channel, ['Nothing is scheduled!'])
+            return
+        lines = ['Scheduled:']
+        for timer in timers:
+            lines.append(' Race {} at {} UTC'.format(
+                'creation' if timer.kind == 'create' else 'start',
+                (EPOCH + timedelta(seconds=timer.due)).strftime(
+                    self.SCHEDULE_TIME_FORMAT
+                )
+            ))
+        await self.send_lines(ctx.channel, lines)
+
+    @commands.command(pass_context=True)
+    async def unschedule(self, ctx):
+        """Cancels the scheduled race actions in the channel.
+
+        Only mods can run this command.
+        """
+        if self._timers is None:
+            await self.send_lines(ctx.channel, ['Race scheduling is not '
+                                                'enabled!'])
+            return
+        if not self.is_mod(ctx.author):
+            await self.send_lines(ctx.channel, ['Only members with moderator '
+                                                'permissions can unschedule '
+                                                'races.'])
+            return
+        num_cancelled = self._timers.cancel_race(
+            self._races.key_for(ctx), ('create', 'start', 'remind')
+        )
+        if num_cancelled:
+            await self.send_lines(ctx.channel, ['Schedule cancelled.'])
+        else:
+            await self.send_lines(ctx.channel, ['Nothing is scheduled!'])
+
+    @classmethod
+    def parse_schedule_time(cls, when):
+        """Parses a scheduled time, returns None if it is not valid
+
+        Times more than MAX_SCHEDULE_AHEAD from now are not valid.
+        """
+        when = when.strip()
+        now = datetime.utcnow()
+        try:
+            if when.startswith('+'):
+                offset = timedelta(minutes=float(when[1:]))
+                if offset > cls.MAX_SCHEDULE_AHEAD:
+                    return None
+                return now + offset
+            scheduled_time = datetime.strptime(when, cls.SCHEDULE_TIME_FORMAT)
+        except (ValueError, OverflowError):
+            return None
+        if scheduled_time - now > cls.MAX_SCHEDULE_AHEAD:
+            return None
+        return scheduled_time
+
+    def schedule_idle_close(self, race):
+        """Schedules closing a race once it has been idle long enough"""
+        if self._timers is not None and self.idle_timeout:
+            self._timers.cancel_race(race.key, ('idle',))
+            self._timers.schedule('idle', time.time() + self.idle_timeout,
+                                  race.key)
+
+    def race_idle_timeout(self, race):
+        """Returns the idle timeout of a race, None if it is kept open"""
+        if race.started and race.num_finished < race.num_racers:
+            return self.running_idle_timeout or None
+        return self.idle_timeout
+
+    def idle_until(self, race):
+        """Returns the epoch time a race counts as idle from
+
+        A race counts as active during its start countdown. Races kept open
+        are checked again after the idle timeout.
+        """
+        idle_timeout = self.race_idle_timeout(race)
+        if idle_timeout is None:
+            return time.time() + self.idle_timeout
+        idle_until = race.last_activity + idle_timeout
+        if race.starting:
+            idle_until = max(idle_until, time.time() +
+                             len(self.COUNTDOWN_TICKS) + 1)
+        return idle_until
+
+    def timer_context(self, timer):
+        """Returns a context for the channel of a timer, None if it is gone"""
+        channel = self.bot.get_channel(timer.key[1])
+        if channel is None:
+            print('Dropping {} timer for missing channel {}'.format(
+                timer.kind, timer.key[1]
+            ))
+            return None
+        return TimerContext(channel)
+
+    def _on_create_timer(self, timer):
+        """Creates a scheduled race"""
+        ctx = self.timer_context(timer)
+        if ctx is not None:
+            self._races.get(ctx).submit(self._scheduledcreate, ctx)
+
+    def _scheduledcreate(self, race, ctx):
+        replies = Replies()
+        if self._races.register(race) is not race or race.created:
+            replies.append('Scheduled race not created, please end the '
+                           'current race first.')
+        else:
+            replies.append('Creating scheduled race.')
+            race.create(datetime.utcnow())
+            self.schedule_idle_close(race)
+        return replies
+
+    def _on_start_timer(self, timer):
+        """Starts a scheduled race"""
+        ctx = self.timer_context(timer)
+        if ctx is not None:
+            self._races.get(ctx).submit(self._scheduledstart, ctx)
+
+    def _scheduledstart(self, race, ctx):
+        replies = Replies()
+        if not race.created:
+            replies.append('No race has been created for the scheduled '
+                           'start!')
+        elif race.started or race.starting:
+            replies.append('Race already started!')
+        elif not race.num_racers:
+            replies.append('No one joined the race, the scheduled start is '
+                           'skipped.')
+        elif race.goal is None:
+            replies.append('Race goal is not set yet!')
+        elif race.game is None:
+            replies.append('Race game is not set yet!')
+        else:
+            replies.append('Starting scheduled race...', PRIORITY_COUNTDOWN)
+            race.starting = True
+            self.schedule_countdown(ctx, race, self.mention_role(ctx.guild))
+        return replies
+
+    def _on_remind_timer(self, timer):
+        """Reminds racers of a scheduled race start"""
+        # Reminders that came due while the bot was down are stale
+        if time.time() - timer.due > 60:
+            return
+        ctx = self.timer_context(timer)
+        if ctx is not None:
+            self._scheduler.send(ctx.channel, '{}, the race starts in {} '
+                                 'minutes!'.format(
+                                     self.mention_role(ctx.guild),
+                                     timer.data['minutes']
+                                 ))
+
+    def _on_idle_timer(self, timer):
+        """Closes a race that has been idle, or checks again later"""
+        race = self._races.find(timer.key)
+        if race is None or not race.created:
+            return
+        idle_until = self.idle_until(race)
+        if idle_until > time.time():
+            self._timers.schedule('idle', idle_until, race.key)
+            return
+        ctx = self.timer_context(timer)
+        if ctx is not None:
+            race.submit(self._idleclose, ctx)
+
+    def _idleclose(self, race, ctx):
+        replies = Replies()
+        if not race.created:
+            return replies
+        idle_until = self.idle_until(race)
+        if idle_until > time.time():
+            # A command came in after the idle check
+            self._timers.schedule('idle', idle_until, race.key)
+        else:
+            replies.append('Closing the race after {} minutes without '
+                           'activity.'.format(
+                               round(self.race_idle_timeout(race) / 60)
+                           ))
+            self.close_race(race, replies)
+        return replies
 
     @commands.command(pass_context=True)
     async def setgoal(self, ctx, *, _goal: str):
@@ -180,23 +1223,37 @@ class Race(commands.Cog):
 
         Only mods can run this command.
         """
+        await self._races.get(ctx).submit(self._setgoal, ctx, _goal)
+
+    def _setgoal(self, race, ctx, _goal):
+        replies = Replies()
         if self.is_mod(ctx.author):
-            if self._race_created:
-                self._race_goal = _goal
-                await ctx.send('Goal set.')
+            if race.created:
+                race.set_goal(_goal)
+                replies.append('Goal set.')
             else:
-                await ctx.send('No race currently created!')
+                replies.append('No race currently created!')
         else:
-            await ctx.send('Only members with moderator permissions can set '
+            replies.append('Only members with moderator permissions can set '
                            'goals for races.')
+        return replies
 
     @commands.command(pass_context=True)
     async def goal(self, ctx):
         """Returns the goal for the race."""
-        if self._race_created:
-            await ctx.send('Race goal: {}'.format(self._race_goal))
+        await self._races.get(ctx).submit(self._goal, ctx)
+
+    def _goal(self, race, ctx):
+        return self.cached_replies(race, self.render_goal)
+
+    def render_goal(self, race):
+        """Returns the replies of the goal command"""
+        replies = Replies(merge=True)
+        if race.created:
+            replies.append('Race goal: {}'.format(race.goal))
         else:
-            await ctx.send('No race currently created!')
+            replies.append('No race currently created!')
+        return replies
 
     @commands.command(pass_context=True)
     async def setgame(self, ctx, *, _game: str):
@@ -204,23 +1261,37 @@ class Race(commands.Cog):
 
         Only mods can run this command.
         """
+        await self._races.get(ctx).submit(self._setgame, ctx, _game)
+
+    def _setgame(self, race, ctx, _game):
+        replies = Replies()
         if self.is_mod(ctx.author):
-            if self._race_created:
-                self._race_game = _game
-                await ctx.send('Game set.')
+            if race.created:
+                race.set_game(_game)
+                replies.append('Game set.')
             else:
-                await ctx.send('No race currently created!')
+                replies.append('No race currently created!')
         else:
-            await ctx.send('Only members with moderator permissions can set '
+            replies.append('Only members with moderator permissions can set '
                            'games for races.')
+        return replies
 
     @commands.command(pass_context=True)
     async def game(self, ctx):
         """Returns the game for the race."""
-        if self._race_created:
-            await ctx.send('Race game: {}'.format(self._race_game))
+        await self._races.get(ctx).submit(self._game, ctx)
+
+    def _game(self, race, ctx):
+        return self.cached_replies(race, self.render_game)
+
+    def render_game(self, race):
+        """Returns the replies of the game command"""
+        replies = Replies(merge=True)
+        if race.created:
+            replies.append('Race game: {}'.format(race.game))
         else:
-            await ctx.send('No race currently created!')
+            replies.append('No race currently created!')
+        return replies
 
     @commands.command(pass_context=True)
     async def join(self, ctx):
@@ -230,25 +1301,35 @@ class Race(commands.Cog):
         the player start time that is set is the join time not the general
         start time.
         """
-        racer = ctx.author
-        if self._race_created:
-            if racer in self._racer_dict:
-                await ctx.send('<@{}>, you already joined the race!'.format(
-                    racer.id
+        await self._races.get(ctx).submit(
+            self._join, ctx, self.command_time(ctx)
+        )
+
+    def _join(self, race, ctx, received):
+        replies = Replies()
+        racer = ctx.author.id
+        if race.created:
+            if racer in race.racers:
+                replies.append('<@{}>, you already joined the race!'.format(
+                    racer
                 ))
             else:
-                if self._race_started:
-                    new_time_started = datetime.utcnow()
-                    self._racer_start_times_dict[racer] = new_time_started
-                    self._racer_ready_dict[racer] = None
-                    self._num_ready += 1
-                self._racer_dict[racer] = None
-                self._num_racers += 1
-                await ctx.send('{} has joined the race!'.format(
-                    self.trim_member_name('{}'.format(racer))
-                ))
+                start_ns = None
+                if race.started:
+                    start_ns = timestamp_nanoseconds(received)
+                race.join(
+                    racer,
+                    self.trim_member_name('{}'.format(ctx.author)),
+                    start_ns
+                )
+                if race.started:
+                    self.load_best_segments(race, [racer])
+                replies.append('{} has joined the race!'.format(
+                    race.racers[racer].name
+                ), PRIORITY_CHATTER)
         else:
-            await ctx.send('No race currently created!')
+            replies.append('No race currently created!')
+        return replies
 
     @commands.command(pass_context=True)
     async def unjoin(self, ctx):
@@ -256,26 +1337,27 @@ class Race(commands.Cog):
 
         Only possible if race is not running.
         """
-        racer = ctx.author
-        if self._race_started:
-            await ctx.send("<@{}>, you can't !unjoin a race that is "
-                          "running.".format(racer.id))
-            await ctx.send('Please !quit the race instead.')
-        elif self._race_created:
-            if racer in self._racer_dict:
-                self._racer_dict.pop(racer, None)
-                self._num_racers -= 1
-                if racer in self._racer_ready_dict:
-                    self._racer_ready_dict.pop(racer, None)
-                    self._num_ready -= 1
-                await ctx.send('{} has left the race!'.format(
-                    self.trim_member_name('{}'.format(racer))
-                ))
+        await self._races.get(ctx).submit(self._unjoin, ctx)
+
+    def _unjoin(self, race, ctx):
+        replies = Replies()
+        racer = ctx.author.id
+        if race.started:
+            replies.append("<@{}>, you can't !unjoin a race that is "
+                          "running.".format(racer))
+            replies.append('Please !quit the race instead.')
+        elif race.created:
+            if racer in race.racers:
+                replies.append('{} has left the race!'.format(
+                    race.racers[racer].name
+                ), PRIORITY_CHATTER)
+                race.unjoin(racer)
             else:
-                await ctx.send("<@{}>, you can't leave a race you didn't "
-                               "join.".format(racer.id))
+                replies.append("<@{}>, you can't leave a race you didn't "
+                               "join.".format(racer))
         else:
-            await ctx.send('No race currently running!')
+            replies.append('No race currently running!')
+        return replies
 
     @commands.command(pass_context=True)
     async def ready(self, ctx):
@@ -284,35 +1366,39 @@ class Race(commands.Cog):
         Only possible if race is created and not running, otherwise ready
         command is not needed.
         """
-        racer = ctx.author
-        if self._race_started:
-            if racer in self._racer_ready_dict:
-                await ctx.send('<@{}>, you already set yourself as '
-                               'ready!'.format(racer.id))
+        await self._races.get(ctx).submit(self._ready, ctx)
+
+    def _ready(self, race, ctx):
+        replies = Replies()
+        racer = ctx.author.id
+        if race.started:
+            if racer in race.racers and race.racers[racer].ready:
+                replies.append('<@{}>, you already set yourself as '
+                               'ready!'.format(racer))
             else:
-                await ctx.send("You don't need to !ready after the race has "
+                replies.append("You don't need to !ready after the race has "
                                "started.")
-                if racer not in self._racer_dict:
-                    await ctx.send("Feel free to join the currently running "
+                if racer not in race.racers:
+                    replies.append("Feel free to join the currently running "
                                    "race! Don't worry, your timer will be "
                                    "started from whenever you send the !join "
                                    "command.")
-        elif self._race_created:
-            if racer in self._racer_dict:
-                if racer in self._racer_ready_dict:
-                    await ctx.send('<@{}>, you already set yourself as '
-                                   'ready!'.format(racer.id))
+        elif race.created:
+            if racer in race.racers:
+                if race.racers[racer].ready:
+                    replies.append('<@{}>, you already set yourself as '
+                                   'ready!'.format(racer))
                 else:
-                    self._racer_ready_dict[racer] = None
-                    self._num_ready += 1
-                    await ctx.send('{} is ready!'.format(
-                        self.trim_member_name('{}'.format(racer))
-                    ))
+                    race.ready(racer)
+                    replies.append('{} is ready!'.format(
+                        race.racers[racer].name
+                    ), PRIORITY_CHATTER)
             else:
-                await ctx.send('<@{}>, please join the race before setting '
-                               'yourself as ready.'.format(racer.id))
+                replies.append('<@{}>, please join the race before setting '
+                               'yourself as ready.'.format(racer))
         else:
-            await ctx.send('No race currently created!')
+            replies.append('No race currently created!')
+        return replies
 
     @commands.command(pass_context=True)
     async def unready(self, ctx):
@@ -320,27 +1406,31 @@ class Race(commands.Cog):
 
         Only possible if race is created and not started.
         """
-        racer = ctx.author
-        if self._race_started:
-            await ctx.send("<@{}>, the race is already running, it's a bit too "
-                           "late to unready.".format(racer.id))
-        elif self._race_created:
-            if racer in self._racer_dict:
-                if racer in self._racer_ready_dict:
-                    self._racer_ready_dict.pop(racer, None)
-                    self._num_ready -= 1
-                    await ctx.send('{} is no longer ready!'.format(
-                        self.trim_member_name('{}'.format(racer))
-                    ))
+        await self._races.get(ctx).submit(self._unready, ctx)
+
+    def _unready(self, race, ctx):
+        replies = Replies()
+        racer = ctx.author.id
+        if race.started:
+            replies.append("<@{}>, the race is already running, it's a bit too "
+                           "late to unready.".format(racer))
+        elif race.created:
+            if racer in race.racers:
+                if race.racers[racer].ready:
+                    race.unready(racer)
+                    replies.append('{} is no longer ready!'.format(
+                        race.racers[racer].name
+                    ), PRIORITY_CHATTER)
                 else:
-                    await ctx.send('<@{}>, you did not set yourself as ready '
-                                   'yet!'.format(racer.id))
+                    replies.append('<@{}>, you did not set yourself as ready '
+                                   'yet!'.format(racer))
             else:
-                await ctx.send('<@{}>, you did not join the race yet.'.format(
-                    racer.id
+                replies.append('<@{}>, you did not join the race yet.'.format(
+                    racer
                 ))
         else:
-            await ctx.send('No race currently created!')
+            replies.append('No race currently created!')
+        return replies
 
     @commands.command(pass_context=True)
     async def quit(self, ctx):
@@ -354,49 +1444,50 @@ class Race(commands.Cog):
 
         If race is created, behaves the same as unjoin.
         """
-        racer = ctx.author
-        if self._race_started:
-            if racer in self._racer_dict:
-                if self._racer_dict[racer] is None:
-                    self._racer_dict[racer] = 'Forfeited'
-                    self._racer_comments_dict[racer] = ''
-                    await ctx.send('{} has quit the race!'.format(
-                        self.trim_member_name('{}'.format(racer))
-                    ))
-
-                    self._num_finished += 1
-                    if self._num_finished == self._num_racers:
-                        await ctx.send('Everyone has completed the race!')
-                        await self.output_results(ctx, True)
-                        self._results_printed = True
-                elif self._racer_dict[racer] == 'Forfeited':
-                    await ctx.send('<@{}>, you already quit the race.'.format(
-                        racer.id
+        await self._races.get(ctx).submit(self._quit, ctx)
+
+    def _quit(self, race, ctx):
+        replies = Replies()
+        racer = ctx.author.id
+        if race.created and race.started:
+            if racer in race.racers:
+                if race.racers[racer].status is RacerStatus.RACING:
+                    race.forfeit(racer)
+                    replies.append('{} has quit the race!'.format(
+                        race.racers[racer].name
+                    ), PRIORITY_RESULTS)
+
+                    if race.num_finished == race.num_racers:
+                        replies.append('Everyone has completed the race!',
+                                       PRIORITY_RESULTS)
+                        replies.extend(self.output_results(race, True),
+                                       PRIORITY_RESULTS)
+                        race.results_printed = True
+                elif race.racers[racer].status is RacerStatus.FORFEITED:
+                    replies.append('<@{}>, you already quit the race.'.format(
+                        racer
                     ))
                 else:
-                    await ctx.send('<@{}>, you have already completed the '
-                                   'race.'.format(racer.id))
-                    await ctx.send('Please !undone if you want to undo your '
+                    replies.append('<@{}>, you have already completed the '
+                                   'race.'.format(racer))
+                    replies.append('Please !undone if you want to undo your '
                                    'previous race completion.')
             else:
-                await ctx.send("<@{}>, you didn't join the race.".format(
-                    racer.id
-                ))
-        elif self._race_created:
-            if racer in self._racer_dict:
-                self._racer_dict.pop(racer, None)
-                self._num_racers -= 1
-                if racer in self._racer_ready_dict:
-                    self._racer_ready_dict.pop(racer, None)
-                    self._num_ready -= 1
-                await ctx.send('{} has left the race!'.format(
-                    self.trim_member_name('{}'.format(racer))
+                replies.append("<@{}>, you didn't join the race.".format(
+                    racer
                 ))
+        elif race.created:
+            if racer in race.racers:
+                replies.append('{} has left the race!'.format(
+                    race.racers[racer].name
+                ), PRIORITY_CHATTER)
+                race.unjoin(racer)
             else:
-                await ctx.send("<@{}>, you can't leave a race you didn't "
-                               "join.".format(racer.id))
+                replies.append("<@{}>, you can't leave a race you didn't "
+                               "join.".format(racer))
         else:
-            await ctx.send('No race has been created!')
+            replies.append('No race has been created!')
+        return replies
 
     @commands.command(pass_context=True)
     async def unquit(self, ctx):
@@ -405,29 +1496,33 @@ class Race(commands.Cog):
         Only possible if race is started and the racer has previously quit the
         race.
         """
-        racer = ctx.author
-        if self._race_started:
-            if racer in self._racer_dict:
-                if self._racer_dict[racer] is None:
-                    await ctx.send('<@{}>, you have not completed the race '
-                                   'yet.'.format(racer.id))
-                elif self._racer_dict[racer] != 'Forfeited':
-                    await ctx.send('<@{}>, you never quit the race.'.format(
-                        racer.id
+        await self._races.get(ctx).submit(self._unquit, ctx)
+
+    def _unquit(self, race, ctx):
+        replies = Replies()
+        racer = ctx.author.id
+        if race.created and race.started:
+            if racer in race.racers:
+                if race.racers[racer].status is RacerStatus.RACING:
+                    replies.append('<@{}>, you have not completed the race '
+                                   'yet.'.format(racer))
+                elif (race.racers[racer].status is not
+                      RacerStatus.FORFEITED):
+                    replies.append('<@{}>, you never quit the race.'.format(
+                        racer
                     ))
                 else:
-                    self._racer_dict[racer] = None
-                    self._num_finished -= 1
-                    self._results_printed = False
-                    await ctx.send('{} is back in the race!'.format(
-                        self.trim_member_name('{}'.format(racer))
-                    ))
+                    race.resume(racer)
+                    replies.append('{} is back in the race!'.format(
+                        race.racers[racer].name
+                    ), PRIORITY_CHATTER)
             else:
-                await ctx.send("<@{}>, you didn't join the race.".format(
-                    racer.id
+                replies.append("<@{}>, you didn't join the race.".format(
+                    racer
                 ))
         else:
-            await ctx.send('No race currently running!')
+            replies.append('No race currently running!')
+        return replies
 
     @commands.command(pass_context=True)
     async def done(self, ctx):
@@ -439,41 +1534,146 @@ class Race(commands.Cog):
 
         Outputs results if everyone has completed the race.
         """
-        racer = ctx.author
-        if self._race_started:
-            if racer in self._racer_dict:
-                if self._racer_dict[racer] is None:
-                    finish_time = datetime.utcnow()
-                    racer_start_time = self._racer_start_times_dict[racer]
-                    time_taken = finish_time - racer_start_time
-                    finish_msg = '{racer} has finished the race in {time}!'
-                    await ctx.send(finish_msg.format(
-                        racer=self.trim_member_name('{}'.format(racer)),
-                        time=self.round_time(time_taken)
-                    ))
+        await self._races.get(ctx).submit(
+            self._done, ctx, self.command_time(ctx)
+        )
 
-                    self._racer_dict[racer] = str(time_taken)
-                    self._racer_comments_dict[racer] = ''
-                    self._num_finished += 1
-                    if self._num_finished == self._num_racers:
-                        await ctx.send('Everyone has completed the race!')
-                        await self.output_results(ctx, True)
-                        self._results_printed = True
-                elif self._racer_dict[racer] == 'Forfeited':
-                    await ctx.send('<@{}>, you have already left the '
-                                   'race.'.format(racer.id))
-                    await ctx.send('Please !undone or !unquit if you want to '
+    def _done(self, race, ctx, received):
+        replies = Replies()
+        racer = ctx.author.id
+        if race.created and race.started:
+            if racer in race.racers:
+                record = race.racers[racer]
+                time_ns = timestamp_nanoseconds(received) - record.start_ns
+                if record.status is RacerStatus.RACING and time_ns < 0:
+                    # Sent during the countdown, but handled after the start
+                    replies.append('<@{}>, you sent !done before the race '
+                                   'started.'.format(racer))
+                elif record.status is RacerStatus.RACING:
+                    race.finish(racer, time_ns)
+                    finish_msg = '{racer} has finished the race in {time}!'
+                    replies.append(finish_msg.format(
+                        racer=record.name,
+                        time=self.round_time(record.time_taken())
+                    ), PRIORITY_RESULTS)
+
+                    if race.num_finished == race.num_racers:
+                        replies.append('Everyone has completed the race!',
+                                       PRIORITY_RESULTS)
+                        replies.extend(self.output_results(race, True),
+                                       PRIORITY_RESULTS)
+                        race.results_printed = True
+                elif record.status is RacerStatus.FORFEITED:
+                    replies.append('<@{}>, you have already left the '
+                                   'race.'.format(racer))
+                    replies.append('Please !undone or !unquit if you want to '
                                    'rejoin the race.')
                 else:
-                    await ctx.send('<@{}>, you have already completed the '
-                                   'race.'.format(racer.id))
-                    await ctx.send('Please !undone if you want to undo your '
+                    replies.append('<@{}>, you have already completed the '
+                                   'race.'.format(racer))
+                    replies.append('Please !undone if you want to undo your '
                                    'previous race completion.')
             else:
-                await ctx.send("<@{}>, you didn't join the "
-                               "race.".format(racer.id))
+                replies.append("<@{}>, you didn't join the "
+                               "race.".format(racer))
         else:
-            await ctx.send('No race currently running!')
+            replies.append('No race currently running!')
+        return replies
+
+    @commands.command(pass_context=True)
+    async def split(self, ctx, *, name: str):
+        """Logs a split of the race.
+
+        Only possible if race is started and you are still racing. Shows how
+        far behind the fastest racer to the split you are, and how your
+        segment compares to your best segment for the split in past races of
+        the same game and goal.
+        """
+        await self._races.get(ctx).submit(self._split, ctx,
+                                          self.command_time(ctx),
+                                          name.strip())
+
+    def load_best_segments(self, race, racer_ids):
+        """Loads racers' best segments from the history onto a race
+
+        Splits are compared against them once loaded, so !split never waits
+        on the history. Segments loaded after the race ended are dropped.
+        """
+        if self._history is None or not racer_ids:
+            return
+        loading = asyncio.ensure_future(self._history.best_segments(
+            race.game, race.goal, racer_ids
+        ))
+        loading.add_done_callback(functools.partial(
+            self._best_segments_loaded, race, race.time_created
+        ))
+
+    @staticmethod
+    def _best_segments_loaded(race, time_created, loading):
+        if loading.cancelled():
+            return
+        if loading.exception() is not None:
+            print('Could not load best segments: {}'.format(
+                loading.exception()
+            ))
+            return
+        if race.created and race.time_created == time_created:
+            race.best_segments.update(loading.result())
+
+    def _split(self, race, ctx, received, name):
+        replies = Replies()
+        racer = ctx.author.id
+        if race.created and race.started:
+            if racer in race.racers:
+                record = race.racers[racer]
+                time_ns = timestamp_nanoseconds(received) - record.start_ns
+                index = race.split_index.get(name)
+                if record.status is not RacerStatus.RACING:
+                    replies.append('<@{}>, you are not in the race '
+                                   'anymore.'.format(racer))
+                elif time_ns < 0:
+                    replies.append('<@{}>, you sent !split before the race '
+                                   'started.'.format(racer))
+                elif (index is not None and
+                      record.split_time(index) is not None):
+                    replies.append('<@{}>, you already logged split '
+                                   '{}.'.format(racer, name))
+                else:
+                    race.split(racer, name, time_ns)
+                    replies.append(self.split_summary(
+                        race, record, name,
+                        race.best_segments.get(racer, {}).get(name)
+                    ))
+            else:
+                replies.append("<@{}>, you didn't join the race.".format(
+                    racer
+                ))
+        else:
+            replies.append('No race currently running!')
+        return replies
+
+    def split_summary(self, race, record, name, best_segment):
+        """Formats a logged split with its live comparisons"""
+        index = race.split_index[name]
+        time_ns = record.split_time(index)
+        parts = ['{} reached {} in {}'.format(
+            record.name, name, self.round_time(to_timedelta(time_ns))
+        )]
+        leader = race.split_leaders[index]
+        if leader == record.id:
+            parts.append('leading the split')
+        else:
+            parts.append('{} behind {}'.format(
+                self.format_delta(time_ns - race.split_best[index]),
+                race.racers[leader].name
+            ))
+        segment = to_timedelta(time_ns - record.previous_split_time(index))
+        if best_segment is not None:
+            parts.append('segment {} ({} against best)'.format(
+                self.round_time(segment),
+                self.format_delta(to_nanoseconds(segment - best_segment))
+            ))
+        return ', '.join(parts) + '.'
 
     @commands.command(pass_context=True)
     async def undone(self, ctx):
@@ -482,21 +1682,24 @@ class Race(commands.Cog):
         Only possible if race is started. If the racer has previously quit
         the race, this behaves equivalently to unquit.
         """
-        racer = ctx.author
-        if self._race_started:
-            if racer in self._racer_dict:
-                if self._racer_dict[racer] is None:
-                    await ctx.send('<@{}>, you have not completed the race '
-                                   'yet.'.format(racer.id))
+        await self._races.get(ctx).submit(self._undone, ctx)
+
+    def _undone(self, race, ctx):
+        replies = Replies()
+        racer = ctx.author.id
+        if race.created and race.started:
+            if racer in race.racers:
+                if race.racers[racer].status is RacerStatus.RACING:
+                    replies.append('<@{}>, you have not completed the race '
+                                   'yet.'.format(racer))
                 else:
-                    self._racer_dict[racer] = None
-                    self._num_finished -= 1
-                    self._results_printed = False
-                    await ctx.send('{} is back in the race!'.format(
-                        self.trim_member_name('{}'.format(racer))
-                    ))
+                    race.resume(racer)
+                    replies.append('{} is back in the race!'.format(
+                        race.racers[racer].name
+                    ), PRIORITY_CHATTER)
         else:
-            await ctx.send('No race currently running!')
+            replies.append('No race currently running!')
+        return replies
 
     @commands.command(pass_context=True)
     async def comment(self, ctx, *, comment_string: str):
@@ -505,23 +1708,27 @@ class Race(commands.Cog):
         Only possible if race is started. Comments are only accepted if a
         person had finished or forfeited a race.
         """
-        racer = ctx.author
-        if self._race_started:
-            if racer in self._racer_dict:
-                if self._racer_dict[racer] is None:
-                    await ctx.send("<@{}>, you didn't complete the race "
-                                   "yet.".format(racer.id))
-                    await ctx.send('Either !done if you finished or !quit if '
+        await self._races.get(ctx).submit(self._comment, ctx, comment_string)
+
+    def _comment(self, race, ctx, comment_string):
+        replies = Replies()
+        racer = ctx.author.id
+        if race.created and race.started:
+            if racer in race.racers:
+                if race.racers[racer].status is RacerStatus.RACING:
+                    replies.append("<@{}>, you didn't complete the race "
+                                   "yet.".format(racer))
+                    replies.append('Either !done if you finished or !quit if '
                                    'you wish to forfeit before commenting.')
                 else:
-                    self._racer_comments_dict[racer] = comment_string
-                    self._results_printed = False
+                    race.comment(racer, comment_string)
             else:
-                await ctx.send("<@{}>, you didn't join the race.".format(
-                    racer.id
+                replies.append("<@{}>, you didn't join the race.".format(
+                    racer
                 ))
         else:
-            await ctx.send('No race currently running!')
+            replies.append('No race currently running!')
+        return replies
 
     @commands.command(pass_context=True)
     async def time(self, ctx):
@@ -529,14 +1736,19 @@ class Race(commands.Cog):
 
         Only possible if race is started.
         """
-        if self._race_started:
+        await self._races.get(ctx).submit(self._time, ctx)
+
+    def _time(self, race, ctx):
+        replies = Replies()
+        if race.created and race.started:
             current_time = datetime.utcnow()
-            time_taken = current_time - self._time_started
-            await ctx.send('Race has been running for {}'.format(
+            time_taken = current_time - race.time_started
+            replies.append('Race has been running for {}'.format(
                 self.round_time(time_taken)
             ))
         else:
-            await ctx.send('No race currently running!')
+            replies.append('No race currently running!')
+        return replies
 
     @commands.command(pass_context=True)
     async def entrants(self, ctx):
@@ -544,23 +1756,31 @@ class Race(commands.Cog):
 
         Only possible if race has been started. Does not mention the players.
         """
-        if self._race_created:
-            racer_list = 'Race entrants:\n'
-            for racer in self._racer_dict:
+        await self._races.get(ctx).submit(self._entrants, ctx)
+
+    def _entrants(self, race, ctx):
+        return self.cached_replies(race, self.render_entrants)
+
+    def render_entrants(self, race):
+        """Returns the replies of the entrants command"""
+        replies = Replies(merge=True)
+        if race.created:
+            racer_lines = ['Race entrants:']
+            for record in race.racers.values():
                 ready_status = ''
-                if racer in self._racer_ready_dict:
+                if record.ready:
                     ready_status = ' (ready)'
-                racer_list = '{prev_racers} {racer}{status}\n'.format(
-                    prev_racers=racer_list,
-                    racer=self.trim_member_name('{}'.format(racer)),
+                racer_lines.append(' {racer}{status}'.format(
+                    racer=record.name,
                     status=ready_status
-                )
-            if racer_list == 'Race entrants:\n':
-                racer_list = 'No entrants yet!'
-
-            await ctx.send(racer_list)
+                ))
+            if len(racer_lines) == 1:
+                replies.append('No entrants yet!')
+            else:
+                replies.extend(split_message(racer_lines))
         else:
-            await ctx.send('No race currently running!')
+            replies.append('No race currently running!')
+        return replies
 
     @commands.command(pass_context=True)
     async def results(self, ctx):
@@ -568,111 +1788,364 @@ class Race(commands.Cog):
 
         Only possible if race is created.
         """
-        if self._race_started:
-            await self.output_results(ctx, False)
+        await self._races.get(ctx).submit(self._results, ctx)
+
+    def _results(self, race, ctx):
+        return self.cached_replies(race, self.render_results)
+
+    def render_results(self, race):
+        """Returns the replies of the results command"""
+        replies = Replies(merge=True)
+        if race.started:
+            replies.extend(self.results_messages(race, False),
+                           PRIORITY_RESULTS)
         else:
-            if self._race_created:
-                await ctx.send('No race has been started!')
+            if race.created:
+                replies.append('No race has been started!')
             else:
-                await ctx.send('No race has been created!')
+                replies.append('No race has been created!')
+        return replies
+
+    @commands.command(pass_context=True)
+    async def download(self, ctx, mode: str = None):
+        """Exports the pack attachments posted in the channel.
+
+        Only messages newer than the last export are fetched, !download full
+        starts the export over from the first message of the channel.
+        !download fetch also downloads the exported attachments that are not
+        in the local pack cache yet.
+        """
+        channel = ctx.message.channel
+        if self._pack_exporter.is_running(channel):
+            await self._scheduler.send(
+                channel, 'An export of this channel is already running!'
+            )
+            return
+        num_records = await self._pack_exporter.export(
+            channel, full=mode == 'full'
+        )
+        await self._scheduler.send(channel, 'Exported {} attachments.'.format(
+            num_records
+        ))
+        if mode != 'fetch':
+            return
+
+        # The export file has to be on disk before it can be read back
+        await self._writer.flush()
+        records = await asyncio.get_event_loop().run_in_executor(
+            None,
+            self._pack_exporter.read_records,
+            self._pack_exporter.export_path(channel)
+        )
+        stats = await self._attachment_cache.fetch_all(records)
+        await self._scheduler.send(channel, 'Attachments: {}.'.format(stats))
+
+    @commands.command(pass_context=True)
+    async def pb(self, ctx, *, game_and_goal: str = None):
+        """Returns your personal best times.
+
+        Bests can be narrowed down to a game, or a game and goal, e.g.
+        !pb Doom II | UV Max
+        """
+        if self._history is None:
+            await self.send_lines(ctx.channel, ['No race history is kept!'])
+            return
+        game, goal = self.split_game_goal(game_and_goal)
+        bests = await self._history.personal_bests(ctx.author.id, game, goal)
+        if not bests:
+            await self.send_lines(ctx.channel, ['No finished races found!'])
+            return
+        lines = ['Personal bests for {}:'.format(
+            self.trim_member_name(ctx.author.name)
+        )]
+        for best_game, best_goal, time_taken in bests:
+            lines.append(' {} - {}: {}'.format(
+                best_game, best_goal, self.round_time(time_taken)
+            ))
+        await self.send_lines(ctx.channel, lines)
 
     @commands.command(pass_context=True)
-    async def download(self, ctx):
-        """Test downloading all relevant pack info"""
-        all_info = {'attachments': []}
-        print(ctx.message.channel)
-        async for msg in ctx.message.channel.history(limit=10000):
-            if msg.attachments:
-                for attachment in msg.attachments:
-                    all_info['attachments'].append({
-                        'attach_name': attachment.filename,
-                        'attach_url': attachment.url,
-                        'time': msg.created_at.strftime('%Y-%m-%d %H:%M:%S') + ' -0000',
-                        'author': msg.author.name
-                    })
-        with open('demopack_download.yaml', 'w') as out_stream:
-            yaml.dump(all_info, out_stream)
-
-    async def output_results(self, ctx, mention_players):
+    async def leaderboard(self, ctx, *, game_and_goal: str):
+        """Returns the fastest racers of a game.
+
+        The leaderboard can be narrowed down to a goal of the game, e.g.
+        !leaderboard Doom II | UV Max
+        """
+        if self._history is None:
+            await self.send_lines(ctx.channel, ['No race history is kept!'])
+            return
+        game, goal = self.split_game_goal(game_and_goal)
+        rows = await self._history.leaderboard(game, goal)
+        if not rows:
+            await self.send_lines(ctx.channel, ['No finished races found!'])
+            return
+        lines = ['Leaderboard for {}:'.format(game)]
+        for index, (racer_name, row_goal, time_taken) in enumerate(rows, 1):
+            lines.append('{}. {} {} ({})'.format(
+                index, racer_name, self.round_time(time_taken), row_goal
+            ))
+        await self.send_lines(ctx.channel, lines)
+
+    @commands.command(pass_context=True)
+    async def history(self, ctx):
+        """Returns your most recent race results."""
+        if self._history is None:
+            await self.send_lines(ctx.channel, ['No race history is kept!'])
+            return
+        rows = await self._history.history(ctx.author.id)
+        if not rows:
+            await self.send_lines(ctx.channel, ['No races found!'])
+            return
+        lines = ['Recent races for {}:'.format(
+            self.trim_member_name(ctx.author.name)
+        )]
+        for time_started, game, goal, place, status, time_taken in rows:
+            if status == STATUS_FINISHED:
+                result = self.round_time(time_taken)
+            elif status == STATUS_FORFEITED:
+                result = 'Forfeited'
+            else:
+                result = 'Did not finish'
+            lines.append(' {} {} - {}: {}. {}'.format(
+                time_started.strftime('%Y-%m-%d'), game, goal, place, result
+            ))
+        await self.send_lines(ctx.channel, lines)
+
+    @commands.command(pass_context=True)
+    async def rating(self, ctx, *, game: str = None):
+        """Returns your rating for each game you raced, or for one game."""
+        if self._ratings is None:
+            await self.send_lines(ctx.channel, ['No race history is kept!'])
+            return
+        ratings = await self._ratings.racer_ratings(ctx.author.id)
+        if game is not None:
+            ratings = [rating for rating in ratings
+                       if rating[0].casefold() == game.casefold()]
+        if not ratings:
+            await self.send_lines(ctx.channel, ['No rated races found!'])
+            return
+        lines = ['Ratings for {}:'.format(
+            self.trim_member_name(ctx.author.name)
+        )]
+        for rated_game, rating, num_races in ratings:
+            lines.append(' {}: {:.0f} ({} races)'.format(
+                rated_game, rating, num_races
+            ))
+        await self.send_lines(ctx.channel, lines)
+
+    @commands.command(pass_context=True)
+    async def ratings(self, ctx, *, game: str):
+        """Returns the highest rated racers of a game."""
+        if self._ratings is None:
+            await self.send_lines(ctx.channel, ['No race history is kept!'])
+            return
+        rows = await self._ratings.top(game)
+        if not rows:
+            await self.send_lines(ctx.channel, ['No rated races found!'])
+            return
+        lines = ['Ratings for {}:'.format(game)]
+        for index, (racer_name, rating, num_races) in enumerate(rows, 1):
+            lines.append('{}. {} {:.0f} ({} races)'.format(
+                index, racer_name, rating, num_races
+            ))
+        await self.send_lines(ctx.channel, lines)
+
+    @commands.command(pass_context=True)
+    async def stats(self, ctx):
+        """Returns the bot's latency and command statistics.
+
+        Only mods can run this command
+        """
+        if not self.is_mod(ctx.author):
+            await self.send_lines(ctx.channel, [
+                'Only members with moderator permissions can view stats.'
+            ])
+            return
+        await self.send_lines(ctx.channel, self.stats_lines())
+
+    def stats_lines(self):
+        """Returns a summary of the metrics"""
+        metrics = self.metrics
+
+        def milliseconds(seconds):
+            return '{:.0f} ms'.format(seconds * 1000)
+
+        def percentiles(histogram):
+            return 'p50 {}, p99 {}, max {}'.format(
+                milliseconds(histogram.quantile(0.5)),
+                milliseconds(histogram.quantile(0.99)),
+                milliseconds(histogram.max)
+            )
+
+        lines = [
+            'Uptime: {}'.format(self.round_time(
+                timedelta(seconds=time.time() - metrics.started)
+            )),
+            'Gateway latency: {}'.format(milliseconds(self.bot.latency)),
+            'Event loop lag: {}'.format(percentiles(metrics.loop_lag)),
+            'Message sends: {} sent, {} errors, {} queued, {}'.format(
+                self._scheduler.sent, self._scheduler.errors,
+                self._scheduler.queue_depth(),
+                percentiles(metrics.send_latency)
+            ),
+            'Races: {}'.format(len(self._races)),
+            'Throttled commands: {}'.format(
+                sum(metrics.command_throttled.values())
+            ),
+            'Commands:'
+        ]
+        for name, histogram in sorted(metrics.commands.items()):
+            lines.append(' {}: {} runs, {} errors, {}'.format(
+                name, histogram.count, metrics.command_errors.get(name, 0),
+                percentiles(histogram)
+            ))
+        return lines
+
+    async def send_lines(self, channel, lines):
+        """Sends lines to a channel, split into as few messages as needed"""
+        await asyncio.gather(*[
+            self._scheduler.send(channel, content)
+            for content in split_message(lines)
+        ])
+
+    @staticmethod
+    def split_game_goal(game_and_goal):
+        """Splits 'game | goal' command arguments into game and goal
+
+        Either part is None if it is not given.
+        """
+        if game_and_goal is None:
+            return None, None
+        game, _, goal = game_and_goal.partition('|')
+        return game.strip() or None, goal.strip() or None
+
+    def output_results(self, race, mention_players):
         """Outputs the results from the race
 
+        Returns the messages to send for the results.
+
         Results format: 1. racerName racerTime racerComments
         racerTime can also be 'Forfeited' if the racer did not finish the race.
         racerTime and racerComments can be empty if the racer did not set an
         end status on the race. Also outputs results in the same format to a
         textfile in comma-delimited rows (with the comments on new lines).
         """
-        racer_not_finished = {}
-        racer_forfeited_dict = {}
-        racer_done_dict = {}
-        for racer in self._racer_dict:
-            if self._racer_dict[racer] is None:
-                racer_not_finished[racer] = ''
-            elif self._racer_dict[racer] == 'Forfeited':
-                racer_forfeited_dict[racer] = 'Forfeited'
+        result_lines, file_lines = self.result_lines(race, mention_players)
+        if file_lines:
+            self._writer.write(race.file_name, ''.join(file_lines))
+        return self.results_messages(race, mention_players, result_lines)
+
+    def results_messages(self, race, mention_players, result_lines=None):
+        """Returns the messages with the results of a race
+
+        Unlike output_results, this does not write the results file.
+        """
+        if result_lines is None:
+            result_lines = self.result_lines(race, mention_players)[0]
+        if not result_lines:
+            return []
+        return split_message([
+            'Race game: {}'.format(race.game),
+            'Race goal: {}'.format(race.goal),
+            'Race results:'
+        ] + result_lines)
+
+    def result_lines(self, race, mention_players):
+        """Returns the results lines and results file lines of a race"""
+        result_lines = []
+        file_lines = []
+        for index, racer in enumerate(race.standings(), 1):
+            if racer.status is RacerStatus.RACING:
+                if mention_players:
+                    racer_name = '<@{}>'.format(racer.id)
+                else:
+                    racer_name = racer.name
+                result_lines.append(self.RESULT_LINE_NO_FINISH_TEMPLATE.format(
+                    idx=index,
+                    racer=racer_name
+                ))
+                file_lines.append(
+                    self.RESULT_FILE_LINE_NO_FINISH_TEMPLATE.format(
+                        idx=index,
+                        racer=racer_name
+                    )
+                )
+                continue
+            if racer.status is RacerStatus.FINISHED:
+                result = self.round_time(racer.time_taken())
             else:
-                racer_done_dict[racer] = self._racer_dict[racer]
-
-        sorted_racer_done = sorted(racer_done_dict.items(),
-                                   key=operator.itemgetter(1))
-
-        results_string = ''
-        file_string = ''
-        index = 1
-        for racer_tuple in sorted_racer_done:
-            racer_time = self.round_time(racer_tuple[1])
-            results_string, file_string = self.format_results(
-                results_string,
-                file_string,
-                racer_tuple[0],
-                racer_time,
-                index,
-                mention_players
-            )
-            index += 1
-        for racer in racer_forfeited_dict:
-            results_string, file_string = self.format_results(
-                results_string,
-                file_string,
+                result = 'Forfeited'
+            result_line, file_line = self.format_results(
                 racer,
-                'Forfeited',
+                result,
                 index,
                 mention_players
             )
-            index += 1
-        for racer in racer_not_finished:
-            if mention_players:
-                racer_name = '<@{}>'.format(racer.id)
-            else:
-                racer_name = self.trim_member_name('{}'.format(racer))
-            results_string = self.RESULT_LINE_NO_FINISH_TEMPLATE.format(
-                prev_results=results_string,
-                idx=index,
-                racer=racer_name
-            )
-            file_string = self.RESULT_FILE_LINE_NO_FINISH_TEMPLATE.format(
-                prev_results=file_string,
-                idx=index,
-                racer=racer_name
-            )
-            index += 1
-
-        output = '{}{}\n{}{}\n{}\n{}'.format(
-            'Race game: ',
-            self._race_game,
-            'Race goal: ',
-            self._race_goal,
-            'Race results:',
-            results_string
-        )
+            result_lines.append(result_line)
+            file_lines.append(file_line)
+        return result_lines, file_lines
 
-        if results_string:
-            await ctx.send(output)
-        if file_string:
-            with io.open(self._race_file_name, 'w+', encoding='utf8') as \
-                    race_file:
-                race_file.write(file_string)
-                race_file.close()
+    @staticmethod
+    def cached_replies(race, render):
+        """Returns the replies of a read-only command on a race
+
+        The replies are rendered once per race version, and reused until the
+        race changes.
+        """
+        cached = race.reply_cache.get(render.__name__)
+        if cached is None or cached[0] != race.version:
+            cached = race.reply_cache[render.__name__] = (race.version,
+                                                          render(race))
+        return cached[1]
+
+    def update_board(self, race, channel):
+        """Queues an edit of the live board of a race after it changed"""
+        if race.created:
+            self._boards.update(race.key, channel,
+                                functools.partial(self.board_content, race))
+
+    def board_content(self, race, ended=False):
+        """Returns the content of the live board of a race
+
+        Racers who do not fit in a single message are left out.
+        """
+        lines = [
+            'Race game: {}'.format(race.game),
+            'Race goal: {}'.format(race.goal)
+        ]
+        if race.started:
+            lines.append('Race results:')
+            lines.extend(self.result_lines(race, False)[0])
+        else:
+            lines.append('Race entrants:')
+            lines.extend(
+                ' {}{}'.format(record.name, ' (ready)' if record.ready else '')
+                for record in race.racers.values()
+            )
+        if ended:
+            lines.append('The race has ended!')
+        messages = split_message(lines, MESSAGE_LIMIT - 4)
+        if len(messages) > 1:
+            return messages[0] + '\n...'
+        return messages[0]
+
+    async def flush(self):
+        """Waits for pending file writes, then stops the background writers"""
+        if self._timers is not None:
+            self._timers.stop()
+        if self._boards is not None:
+            self._boards.stop()
+        self.metrics.stop()
+        if self._metrics_server is not None:
+            await self._metrics_server.stop()
+        self._attachment_cache.close()
+        await self._writer.flush()
+        if self._journal is not None:
+            await self._journal.flush()
+            self._journal.writer.close()
+        if self._history is not None:
+            self._history.close()
+        self._writer.close()
 
     @staticmethod
     def trim_member_name(member_name):
@@ -687,74 +2160,181 @@ class Race(commands.Cog):
         """Rounds duration time down to the second"""
         return str(time_to_round).split('.')[0]
 
-    @staticmethod
-    def is_mod(member):
+    @classmethod
+    def format_delta(cls, delta_ns):
+        """Formats a signed difference in nanoseconds down to the second"""
+        sign = '-' if delta_ns < 0 else '+'
+        return sign + cls.round_time(to_timedelta(abs(delta_ns)))
+
+    def is_mod(self, member):
         """Checks if a member has a mod role.
 
-        Mod roles hardcoded to match #doom mod roles (race mod)
+        Mod role names are configurable per guild, they default to match
+        #doom mod roles (race mod)
         """
-        for role in member.roles:
-            if role.name.lower() == 'race mod':
-                return True
+        return self._roles.is_mod(member)
+
+    @commands.Cog.listener()
+    async def on_guild_role_create(self, role):
+        """Reindexes the roles of a guild when a role is added"""
+        self._roles.invalidate(role.guild)
+
+    @commands.Cog.listener()
+    async def on_guild_role_update(self, before, after):
+        """Reindexes the roles of a guild when a role changes"""
+        self._roles.invalidate(after.guild)
+
+    @commands.Cog.listener()
+    async def on_guild_role_delete(self, role):
+        """Reindexes the roles of a guild when a role is removed"""
+        self._roles.invalidate(role.guild)
 
-        return False
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild):
+        """Forgets the roles of a guild the bot left"""
+        self._roles.invalidate(guild)
 
-    def format_results(self, results_string, file_string, racer, time, index,
-                       mention_players):
-        """Formats results for players who are set as done or forfeited"""
+    def format_results(self, racer, time, index, mention_players):
+        """Formats results for players who are set as done or forfeited
+
+        Returns the results line and the results file line for the racer.
+        """
         if mention_players:
             racer_name = '<@{}>'.format(racer.id)
         else:
-            racer_name = self.trim_member_name('{}'.format(racer))
-        racer_comments = self._racer_comments_dict[racer]
-        results_string = self.RESULT_LINE_TEMPLATE.format(
-            prev_results=results_string,
+            racer_name = racer.name
+        racer_comments = racer.comment
+        result_line = self.RESULT_LINE_TEMPLATE.format(
             idx=index,
             racer=racer_name,
             time=time,
             comments=racer_comments
         )
-        file_string = self.RESULT_FILE_LINE_TEMPLATE.format(
-            prev_results=file_string,
+        file_line = self.RESULT_FILE_LINE_TEMPLATE.format(
             idx=index,
             racer=racer_name,
             time=time,
             comments=racer_comments
         )
 
-        return results_string, file_string
+        return result_line, file_line
 
 
 PREFIXES = ['!', '\N{HEAVY EXCLAMATION MARK SYMBOL}']
 DESCRIPTION = '''Bot for racing and keeping track of race results'''
-bot = commands.Bot(command_prefix=PREFIXES, description=DESCRIPTION)
 
 
-@bot.event
-async def on_ready():
-    """Prints debug info on startup."""
-    print('------')
-    print('Username: ' + bot.user.name)
-    print('User ID: {}'.format(bot.user.id))
-    print('------')
+class RaceBot(commands.AutoShardedBot):
+    """Bot which finishes pending race file writes before closing
+
+    The bot is auto-sharded, it holds every shard unless given the IDs of
+    the shards to hold out of a total shard count.
+    """
+
+    async def on_ready(self):
+        """Prints debug info on startup."""
+        print('------')
+        print('Username: ' + self.user.name)
+        print('User ID: {}'.format(self.user.id))
+        print('Shards: {} of {}'.format(
+            ', '.join(str(shard_id) for shard_id in sorted(self.shards)),
+            self.shard_count
+        ))
+        print('Guilds: {}'.format(len(self.guilds)))
+        if resource is not None:
+            # ru_maxrss is in KiB on Linux
+            print('Peak memory: {} KiB'.format(
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            ))
+        print('------')
+
+    async def on_resumed(self):
+        """Triggered when bot resumes after interruption"""
+        print('Resumed...')
 
+    async def on_command_error(self, ctx, error):
+        """Catches errors and sends messages to channel."""
+        if isinstance(error, commands.MissingRequiredArgument):
+            await ctx.send('Missing required argument for command.')
 
-@bot.event
-async def on_resumed():
-    """Triggered when bot resumes after interruption"""
-    print('Resumed...')
+    async def close(self):
+        """Flushes the race cog's file writes, then closes the bot"""
+        race_cog = self.get_cog('Race')
+        if race_cog is not None:
+            await race_cog.flush()
+        await super().close()
 
 
-@bot.event
-async def on_command_error(error, ctx):
-    """Catches errors and sends messages to channel."""
-    if isinstance(error, commands.MissingRequiredArgument):
-        await bot.send_message(ctx.message.channel,
-                               'Missing required argument for command.')
+def bot_options(config):
+    """Returns the bot options for the configuration
+
+    In low memory mode only guild and guild message events are received, and
+    no members or messages are cached. Command authors come with their roles
+    in the message payload, which is all the race commands need.
+    """
+    if not config['low_memory']:
+        return {}
+    intents = discord.Intents.none()
+    intents.guilds = True
+    intents.guild_messages = True
+    if hasattr(intents, 'message_content'):
+        # Prefix commands need message content on newer gateway versions
+        intents.message_content = True
+    return {
+        'intents': intents,
+        'member_cache_flags': discord.MemberCacheFlags.none(),
+        'chunk_guilds_at_startup': False,
+        'max_messages': None
+    }
+
+
+def read_token(path='token.txt'):
+    """Reads the bot token"""
+    with open(path) as token_file:
+        return token_file.readline().rstrip()
+
+
+def run(config, token, shard_ids=None, shard_count=None, process_index=None):
+    """Runs the bot until it is closed
+
+    When the bot runs as one of several processes, it holds the given shards
+    and keeps its journal and timers in a directory of its own, named after
+    its process index, and serves metrics on the metrics port plus its
+    process index. The race history is shared by all processes.
+    """
+    options = bot_options(config)
+    if shard_ids is not None:
+        options.update(shard_ids=shard_ids, shard_count=shard_count)
+    race_bot = RaceBot(command_prefix=PREFIXES, description=DESCRIPTION,
+                       **options)
+
+    state_directory = '.'
+    metrics_address = None
+    if config['metrics_port']:
+        metrics_address = (config['metrics_host'], config['metrics_port'])
+    if process_index is not None:
+        state_directory = 'process_{}'.format(process_index)
+        os.makedirs(state_directory, exist_ok=True)
+        if metrics_address is not None:
+            metrics_address = (metrics_address[0],
+                               metrics_address[1] + process_index)
+
+    race_writer = BackgroundWriter()
+    race_bot.add_cog(Race(
+        race_bot, message_timestamps=True,
+        journal=RaceJournal(state_directory, writer=race_writer),
+        writer=race_writer, history=RaceHistory(),
+        roles=RoleIndex(config['roles']),
+        timers=TimerService(race_writer, os.path.join(state_directory,
+                                                      TIMERS_FILE_NAME)),
+        idle_timeout=config['idle_timeout_minutes'] * 60,
+        running_idle_timeout=config['running_idle_timeout_minutes'] * 60,
+        live_boards=config['live_boards'],
+        metrics_address=metrics_address,
+        throttles=CommandThrottles(config['throttles'])
+    ))
+    race_bot.run(token)
 
 
 if __name__ == '__main__':
-    with open('token.txt') as token_file:
-        token = token_file.readline()
-    bot.add_cog(Race(bot))
-    bot.run(token.rstrip())
+    run(load_config(), read_token())
@@ -0,0 +1,98 @@
+"""Runs the race bot as several processes on one machine
+
+The shards are dealt out round robin to the processes, and each process runs
+an auto-sharded bot holding its shards. A guild's events only reach the
+process holding its shard, so every race is owned by a single process and
+race state needs no locking across processes. Each process keeps its own
+journal and timers, all of them share the race history database, which is
+in WAL mode so one process writing does not block the others reading.
+
+Processes that exit are restarted. Keep the process count and shard count
+the same across restarts, or end all races first: a process only restores
+the races in its own journal.
+"""
+
+import multiprocessing
+import time
+
+from multiprocessing.connection import wait
+
+from bot_config import load_config
+
+__author__ = '4shockblast'
+
+# Discord allows one shard to identify every five seconds
+IDENTIFY_INTERVAL = 5
+RESTART_DELAY = 10
+SHUTDOWN_TIMEOUT = 30
+
+
+def process_shards(process_index, num_processes, shard_count):
+    """Returns the IDs of the shards held by a process"""
+    return list(range(process_index, shard_count, num_processes))
+
+
+def run_process(process_index, num_processes, shard_count, start_delay):
+    """Runs the bot holding the shards of a process"""
+    # Imported here, so discord.py is only loaded in the bot processes
+    import race_bot
+
+    time.sleep(start_delay)
+    race_bot.run(load_config(), race_bot.read_token(),
+                 process_shards(process_index, num_processes, shard_count),
+                 shard_count, process_index)
+
+
+def start_process(context, process_index, num_processes, shard_count,
+                  start_delay):
+    """Starts a bot process"""
+    process = context.Process(
+        target=run_process, name='race-bot-{}'.format(process_index),
+        args=(process_index, num_processes, shard_count, start_delay)
+    )
+    process.start()
+    return process
+
+
+def main():
+    """Starts the bot processes and restarts those that exit"""
+    config = load_config()
+    num_processes = config['processes']
+    shard_count = config['shard_count'] or num_processes
+    if shard_count < num_processes:
+        raise ValueError('shard_count must be at least the number of '
+                         'processes')
+
+    context = multiprocessing.get_context('spawn')
+    processes = {}
+    for process_index in range(num_processes):
+        # Stagger the logins, so the processes identify one at a time
+        start_delay = (process_index * IDENTIFY_INTERVAL *
+                       len(process_shards(0, num_processes, shard_count)))
+        processes[process_index] = start_process(
+            context, process_index, num_processes, shard_count, start_delay
+        )
+
+    try:
+        while True:
+            sentinels = {process.sentinel: process_index
+                         for process_index, process in processes.items()}
+            for sentinel in wait(list(sentinels)):
+                process_index = sentinels[sentinel]
+                print('Process {} exited with code {}, restarting'.format(
+                    process_index, processes[process_index].exitcode
+                ))
+                processes[process_index] = start_process(
+                    context, process_index, num_processes, shard_count,
+                    RESTART_DELAY
+                )
+    except KeyboardInterrupt:
+        # The processes got the interrupt too and are closing their bots
+        for process in processes.values():
+            process.join(SHUTDOWN_TIMEOUT)
+            if process.is_alive():
+                process.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,328 @@
+"""SQLite store of the results of finished races
+
+Every race that ends after being started is written to the store, including
+forfeits and racers that never finished. Results are indexed on game, goal
+and racer, and on race start time, so personal bests, leaderboards and
+racer histories can be looked up without reading old results files.
+
+All database access happens on a dedicated thread, so the event loop never
+waits on SQLite. The database is in WAL mode and can be shared by several
+bot processes.
+"""
+
+import asyncio
+import sqlite3
+import traceback
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+__author__ = '4shockblast'
+
+HISTORY_FILE_NAME = 'race_history.db'
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+BUSY_TIMEOUT = 30
+
+STATUS_FINISHED = 'finished'
+STATUS_FORFEITED = 'forfeited'
+STATUS_UNFINISHED = 'unfinished'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS races (
+    race_id INTEGER PRIMARY KEY,
+    guild_id INTEGER,
+    channel_id INTEGER NOT NULL,
+    game TEXT COLLATE NOCASE,
+    goal TEXT COLLATE NOCASE,
+    time_started INTEGER NOT NULL,
+    num_racers INTEGER NOT NULL,
+    UNIQUE (channel_id, time_started)
+);
+CREATE TABLE IF NOT EXISTS results (
+    race_id INTEGER NOT NULL REFERENCES races (race_id),
+    racer_id INTEGER NOT NULL,
+    racer_name TEXT NOT NULL,
+    game TEXT COLLATE NOCASE,
+    goal TEXT COLLATE NOCASE,
+    place INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    time_taken INTEGER,
+    comment TEXT NOT NULL DEFAULT '',
+    time_started INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_by_game_goal_racer
+    ON results (game, goal, racer_id, time_taken);
+CREATE INDEX IF NOT EXISTS results_by_racer_time
+    ON results (racer_id, time_started);
+CREATE INDEX IF NOT EXISTS results_by_time ON results (time_started);
+CREATE TABLE IF NOT EXISTS best_segments (
+    game TEXT COLLATE NOCASE,
+    goal TEXT COLLATE NOCASE,
+    racer_id INTEGER NOT NULL,
+    split_name TEXT NOT NULL,
+    segment INTEGER NOT NULL,
+    PRIMARY KEY (game, goal, racer_id, split_name)
+);
+'''
+
+
+def to_microseconds(time_started):
+    """Converts a naive UTC datetime to microseconds since the epoch"""
+    return (time_started - EPOCH) // MICROSECOND
+
+
+def from_microseconds(microseconds):
+    """Converts microseconds since the epoch to a naive UTC datetime"""
+    return EPOCH + timedelta(microseconds=microseconds)
+
+
+class RaceHistory:
+    """History of finished races, kept in an SQLite database"""
+
+    def __init__(self, path=HISTORY_FILE_NAME):
+        """Initialize the store, the database is opened on first use"""
+        self.path = path
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='race-history'
+        )
+        self._connection = None
+
+    def _connect(self):
+        """Returns the database connection, opening it if needed"""
+        if self._connection is None:
+            # Other bot processes can hold the write lock for a moment
+            self._connection = sqlite3.connect(self.path,
+                                               timeout=BUSY_TIMEOUT)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            self._connection.executescript(SCHEMA)
+        return self._connection
+
+    def _call(self, function, args):
+        """Runs a function with the connection, on the database thread"""
+        return function(self._connect(), *args)
+
+    async def _run(self, function, *args):
+        """Runs a database function and waits for its result"""
+        return await asyncio.get_event_loop().run_in_executor(
+            self._executor, self._call, function, args
+        )
+
+    def record_race(self, race):
+        """Queues a finished race to be written to the store
+
+        The race is a dict with the guild_id, channel_id, game, goal and
+        time_started of the race, and a results list of dicts with the
+        racer_id, racer_name, place, status, time_taken and comment of each
+        racer. Results can also hold a segments dict of split names to the
+        time taken since the previous split, the fastest segment of each
+        racer is kept. Races already in the store are left as they are.
+        """
+        future = self._executor.submit(self._call, self._insert_race, (race,))
+        future.add_done_callback(self._report_error)
+
+    def record_races(self, races):
+        """Queues many races to be written in a single transaction
+
+        The races are dicts as for record_race. Returns a concurrent future
+        set to the number of races written, races already in the store are
+        not counted.
+        """
+        future = self._executor.submit(self._call, self._insert_races,
+                                       (races,))
+        future.add_done_callback(self._report_error)
+        return future
+
+    @staticmethod
+    def _report_error(future):
+        """Logs the error of a failed background write"""
+        if future.exception() is not None:
+            print('Writing race history failed:')
+            traceback.print_exception(
+                type(future.exception()), future.exception(),
+                future.exception().__traceback__
+            )
+
+    @classmethod
+    def _insert_race(cls, connection, race):
+        """Writes a race and its results in a single transaction"""
+        with connection:
+            return cls._write_race(connection, race)
+
+    @classmethod
+    def _insert_races(cls, connection, races):
+        """Writes races in a single transaction, returns how many were new"""
+        with connection:
+            return sum(cls._write_race(connection, race) is not None
+                       for race in races)
+
+    @staticmethod
+    def _write_race(connection, race):
+        """Writes a race and its results, returns None if already stored"""
+        time_started = to_microseconds(race['time_started'])
+        cursor = connection.execute(
+            'INSERT OR IGNORE INTO races (guild_id, channel_id, game, '
+            'goal, time_started, num_racers) VALUES (?, ?, ?, ?, ?, ?)',
+            (race['guild_id'], race['channel_id'], race['game'],
+             race['goal'], time_started, len(race['results']))
+        )
+        if not cursor.rowcount:
+            return None
+        race_id = cursor.lastrowid
+        connection.executemany(
+            'INSERT INTO results (race_id, racer_id, racer_name, game, '
+            'goal, place, status, time_taken, comment, time_started) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            [(race_id, result['racer_id'], result['racer_name'],
+              race['game'], race['goal'], result['place'],
+              result['status'],
+              None if result['time_taken'] is None else
+              result['time_taken'] // MICROSECOND,
+              result['comment'], time_started)
+             for result in race['results']]
+        )
+        connection.executemany(
+            'INSERT INTO best_segments (game, goal, racer_id, split_name, '
+            'segment) VALUES (?, ?, ?, ?, ?) '
+            'ON CONFLICT (game, goal, racer_id, split_name) '
+            'DO UPDATE SET segment = MIN(segment, excluded.segment)',
+            [(race['game'], race['goal'], result['racer_id'], split_name,
+              segment // MICROSECOND)
+             for result in race['results']
+             for split_name, segment in result.get('segments', {}).items()]
+        )
+        return race_id
+
+    async def personal_bests(self, racer_id, game=None, goal=None, limit=10):
+        """Returns a racer's best times as (game, goal, time taken) tuples
+
+        Only bests for the given game, or game and goal, are returned if they
+        are given.
+        """
+        query = ('SELECT game, goal, MIN(time_taken) FROM results '
+                 'WHERE racer_id = ? AND time_taken IS NOT NULL')
+        args = [racer_id]
+        if game is not None:
+            query += ' AND game = ?'
+            args.append(game)
+        if goal is not None:
+            query += ' AND goal = ?'
+            args.append(goal)
+        query += ' GROUP BY game, goal ORDER BY game, goal LIMIT ?'
+        args.append(limit)
+        rows = await self._run(self._fetch, query, args)
+        return [(row_game, row_goal, timedelta(microseconds=best))
+                for row_game, row_goal, best in rows]
+
+    async def leaderboard(self, game, goal=None, limit=10):
+        """Returns the best time of each racer of a game, fastest first
+
+        Rows are (racer name, goal, time taken) tuples. Without a goal, each
+        racer's best time for every goal of the game is ranked.
+        """
+        query = ('SELECT racer_name, goal, MIN(time_taken) AS best '
+                 'FROM results WHERE game = ? AND time_taken IS NOT NULL')
+        args = [game]
+        if goal is not None:
+            query += ' AND goal = ?'
+            args.append(goal)
+        query += ' GROUP BY racer_id, goal ORDER BY best LIMIT ?'
+        args.append(limit)
+        rows = await self._run(self._fetch, query, args)
+        return [(racer_name, row_goal, timedelta(microseconds=best))
+                for racer_name, row_goal, best in rows]
+
+    async def history(self, racer_id, limit=10):
+        """Returns a racer's most recent results, newest first
+
+        Rows are (time started, game, goal, place, status, time taken)
+        tuples, time taken is None unless the racer finished.
+        """
+        rows = await self._run(
+            self._fetch,
+            'SELECT time_started, game, goal, place, status, time_taken '
+            'FROM results WHERE racer_id = ? '
+            'ORDER BY time_started DESC LIMIT ?',
+            (racer_id, limit)
+        )
+        return [(from_microseconds(time_started), game, goal, place, status,
+                 None if time_taken is None else
+                 timedelta(microseconds=time_taken))
+                for time_started, game, goal, place, status, time_taken
+                in rows]
+
+    async def best_segments(self, game, goal, racer_ids):
+        """Returns racers' best segment of each split of a game and goal
+
+        The segments are a dict of racer IDs to dicts of split names to
+        timedeltas, racers without segments are left out.
+        """
+        rows = await self._run(
+            self._fetch,
+            'SELECT racer_id, split_name, segment FROM best_segments '
+            'WHERE game = ? AND goal = ?',
+            (game, goal)
+        )
+        racer_ids = set(racer_ids)
+        segments = {}
+        for racer_id, split_name, segment in rows:
+            if racer_id in racer_ids:
+                segments.setdefault(racer_id, {})[split_name] = timedelta(
+                    microseconds=segment
+                )
+        return segments
+
+    async def racer_names(self):
+        """Returns the latest name of every racer, keyed by racer ID"""
+        rows = await self._run(
+            self._fetch,
+            'SELECT racer_id, racer_name, MAX(time_started) FROM results '
+            'GROUP BY racer_id',
+            ()
+        )
+        return {racer_id: racer_name for racer_id, racer_name, _ in rows}
+
+    async def all_results(self):
+        """Returns every stored result, in the order the races were run
+
+        Rows are (race ID, game, racer ID, racer name, place, status) tuples,
+        the results of a race are consecutive and in place order.
+        """
+        return await self._run(
+            self._fetch,
+            'SELECT race_id, game, racer_id, racer_name, place, status '
+            'FROM results ORDER BY time_started, race_id, place',
+            ()
+        )
+
+    async def data_version(self):
+        """Returns a number which changes when another process writes
+
+        Writes through this store do not change it.
+        """
+        rows = await self._run(self._fetch, 'PRAGMA data_version', ())
+        return rows[0][0]
+
+    @staticmethod
+    def _fetch(connection, query, args):
+        """Runs a query and returns all of its rows"""
+        return connection.execute(query, args).fetchall()
+
+    async def flush(self):
+        """Waits until every race queued so far is written"""
+        await asyncio.get_event_loop().run_in_executor(
+            self._executor, lambda: None
+        )
+
+    def close(self):
+        """Finishes pending writes and closes the database"""
+        self._executor.submit(self._close).result()
+        self._executor.shutdown(wait=True)
+
+    def _close(self):
+        """Closes the connection, on the database thread"""
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
@@ -0,0 +1,336 @@
+"""Bulk import of legacy race results files into the race history
+
+Races used to be kept only in the files the bot writes: race_<created>.txt
+with a results row per racer, as written by output_results, and
+raceStartTime_<created>.txt with the race start time. This finds the pairs
+of files in a directory, parses them on a process pool and writes the races
+to the race history in batches, one transaction per batch.
+
+Importing is idempotent: races are keyed by channel and start time, and
+races already in the history are skipped. Results rows that cannot be
+parsed are reported and skipped, files without a single valid row are
+skipped. Races without a start time file are imported with their creation
+time, taken from the file name, as their start time.
+
+The files do not record the game, goal, guild or channel of a race. Racers
+are identified by their mention when the results were written with
+mentions, and named 'user <ID>' if the history does not know their name
+yet. Racers only known by name get the ID the history already has for
+that name, or a negative ID derived from the name, so their results still
+group together.
+
+Example:
+
+    python race_import.py path/to/old/bot --channel-id 1234
+"""
+
+import argparse
+import asyncio
+import io
+import os
+import re
+import time
+import zlib
+
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+
+from race_history import RaceHistory, STATUS_FINISHED, STATUS_FORFEITED, \
+    STATUS_UNFINISHED
+
+__author__ = '4shockblast'
+
+RACE_FILE_PATTERN = re.compile(r'^race_(\d+(?:\.\d+)?)\.txt$')
+START_FILE_TEMPLATE = 'raceStartTime_{}.txt'
+ROW_PATTERN = re.compile(r'^(\d+)\.\|(.*)$')
+TIME_PATTERN = re.compile(
+    r'^(?:(\d+) days?, )?(\d+):(\d\d):(\d\d)(?:\.(\d{1,6}))?$'
+)
+BROKEN_TIME_PATTERN = re.compile(r'^[\d:.]*:[\d:.]*$')
+MENTION_PATTERN = re.compile(r'^<@!?(\d+)>$')
+UNKNOWN_RACER_NAME = 'user {}'
+START_TIME_PREFIX = 'Race time: '
+FORFEITED = 'Forfeited'
+
+
+def parse_time(text):
+    """Parses a time taken as written by str(timedelta), None if invalid"""
+    match = TIME_PATTERN.match(text)
+    if match is None:
+        return None
+    days, hours, minutes, seconds, fraction = match.groups()
+    return timedelta(
+        days=int(days or 0), hours=int(hours), minutes=int(minutes),
+        seconds=int(seconds),
+        microseconds=int((fraction or '0').ljust(6, '0'))
+    )
+
+
+def parse_results(text):
+    """Parses the rows of a results file
+
+    Returns the list of (place, racer, status, time taken, comment) tuples
+    and the list of errors for lines that could not be parsed. The racer is
+    the name or mention as written.
+
+    Finished and forfeited rows are always followed by a comment line, rows
+    of racers without an end status never are. A row with an invalid end
+    status is told apart from a racer whose name holds a | by the comment
+    line following it.
+    """
+    rows = []
+    errors = []
+    lines = text.splitlines()
+    expect_comment = False
+    skip_comment = False
+    for line_number, line in enumerate(lines, 1):
+        match = ROW_PATTERN.match(line)
+        if expect_comment and match is None:
+            # The comment line that follows a finished or forfeited racer
+            place, racer, status, time_taken, _ = rows[-1]
+            rows[-1] = (place, racer, status, time_taken, line)
+            expect_comment = False
+            continue
+        if skip_comment and match is None:
+            skip_comment = False
+            continue
+        expect_comment = False
+        skip_comment = False
+        if match is None:
+            if line.strip():
+                errors.append('line {}: not a results row'.format(
+                    line_number
+                ))
+            continue
+
+        place = int(match.group(1))
+        racer, separator, result = match.group(2).rpartition('|')
+        status = STATUS_FINISHED
+        time_taken = None
+        has_comment = (line_number < len(lines) and
+                       ROW_PATTERN.match(lines[line_number]) is None)
+        if separator and result == FORFEITED:
+            status = STATUS_FORFEITED
+        elif separator and parse_time(result) is not None:
+            time_taken = parse_time(result)
+        elif separator and (has_comment or
+                            BROKEN_TIME_PATTERN.match(result)):
+            errors.append('line {}: invalid time {}'.format(line_number,
+                                                            result))
+            skip_comment = has_comment
+            continue
+        else:
+            # A racer without an end status, the name may hold a |
+            racer = match.group(2)
+            status = STATUS_UNFINISHED
+        if not racer:
+            errors.append('line {}: no racer'.format(line_number))
+            continue
+        rows.append((place, racer, status, time_taken, ''))
+        expect_comment = status != STATUS_UNFINISHED
+    return rows, errors
+
+
+def parse_start_time(text):
+    """Parses a start time file, None if it holds no valid start time"""
+    for line in text.splitlines():
+        if line.startswith(START_TIME_PREFIX):
+            try:
+                return datetime.fromisoformat(
+                    line[len(START_TIME_PREFIX):].strip()
+                )
+            except ValueError:
+                return None
+    return None
+
+
+def read_text(path):
+    """Reads a file, None if it cannot be read"""
+    try:
+        with io.open(path, encoding='utf8', errors='replace') as text_file:
+            return text_file.read()
+    except OSError:
+        return None
+
+
+def parse_race(paths):
+    """Parses a results file and its start time file
+
+    Returns the results file path, a dict with the time_started of the race
+    and its parsed rows, or None if the race cannot be imported, and the
+    list of errors. Runs in the worker processes.
+    """
+    race_path, start_path, created = paths
+    text = read_text(race_path)
+    if text is None:
+        return race_path, None, ['cannot read the file']
+    rows, errors = parse_results(text)
+    if not rows:
+        return race_path, None, errors + ['no results rows']
+
+    time_started = None
+    if start_path is not None:
+        start_text = read_text(start_path)
+        if start_text is not None:
+            time_started = parse_start_time(start_text)
+        if time_started is None:
+            errors.append('no start time in {}'.format(start_path))
+    if time_started is None:
+        # The name holds the naive UTC creation time, taken as local time
+        time_started = datetime.fromtimestamp(created)
+    return race_path, {'time_started': time_started, 'rows': rows}, errors
+
+
+def find_races(directory):
+    """Returns (results path, start time path, creation time) tuples
+
+    The start time path is None if the race has no start time file.
+    """
+    names = set(os.listdir(directory))
+    races = []
+    for name in sorted(names):
+        match = RACE_FILE_PATTERN.match(name)
+        if match is None:
+            continue
+        start_name = START_FILE_TEMPLATE.format(match.group(1))
+        start_path = None
+        if start_name in names:
+            start_path = os.path.join(directory, start_name)
+        races.append((os.path.join(directory, name), start_path,
+                      float(match.group(1))))
+    return races
+
+
+def legacy_racer_id(name):
+    """Returns the negative ID given to a racer only known by name"""
+    return -(zlib.crc32(name.casefold().encode('utf8')) + 1)
+
+
+class RacerResolver:
+    """Resolves the racers of results rows to racer IDs and names"""
+
+    def __init__(self, racer_names):
+        """Initialize from the latest name of each racer, keyed by ID"""
+        self._names = racer_names
+        self._ids = {}
+        for racer_id, racer_name in racer_names.items():
+            self._ids[racer_name.casefold()] = racer_id
+
+    def resolve(self, racer):
+        """Returns the racer ID and name for a racer as written in a file"""
+        match = MENTION_PATTERN.match(racer)
+        if match is not None:
+            # Never store the mention itself, it would ping the racer
+            racer_id = int(match.group(1))
+            return racer_id, self._names.get(
+                racer_id, UNKNOWN_RACER_NAME.format(racer_id)
+            )
+        racer_id = self._ids.get(racer.casefold())
+        if racer_id is None:
+            racer_id = legacy_racer_id(racer)
+        return racer_id, racer
+
+
+def history_race(parsed, resolver, guild_id, channel_id):
+    """Returns a parsed race as a race history record"""
+    results = []
+    for place, racer, status, time_taken, comment in parsed['rows']:
+        racer_id, racer_name = resolver.resolve(racer)
+        results.append({
+            'racer_id': racer_id,
+            'racer_name': racer_name,
+            'place': place,
+            'status': status,
+            'time_taken': time_taken,
+            'comment': comment
+        })
+    return {
+        'guild_id': guild_id,
+        'channel_id': channel_id,
+        'game': None,
+        'goal': None,
+        'time_started': parsed['time_started'],
+        'results': results
+    }
+
+
+def import_races(directory, history, guild_id=None, channel_id=0,
+                 workers=None, batch_size=1000, verbose=False):
+    """Imports the races in a directory into a race history
+
+    Batches are written on the history's database thread while the next
+    batch is parsed. Returns a dict with the number of races found,
+    imported, already in the history and skipped, and of files with errors.
+    """
+    races = find_races(directory)
+    resolver = RacerResolver(asyncio.get_event_loop().run_until_complete(
+        history.racer_names()
+    ))
+    workers = workers or os.cpu_count() or 1
+    stats = {'found': len(races), 'imported': 0, 'existing': 0,
+             'skipped': 0, 'with_errors': 0}
+    writes = []
+    batch = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        chunk_size = max(len(races) // (4 * workers), 1)
+        for race_path, parsed, errors in pool.map(parse_race, races,
+                                                  chunksize=chunk_size):
+            if errors:
+                stats['with_errors'] += 1
+                if verbose:
+                    for error in errors:
+                        print('{}: {}'.format(race_path, error))
+            if parsed is None:
+                stats['skipped'] += 1
+                continue
+            batch.append(history_race(parsed, resolver, guild_id,
+                                      channel_id))
+            if len(batch) >= batch_size:
+                writes.append((len(batch), history.record_races(batch)))
+                batch = []
+    if batch:
+        writes.append((len(batch), history.record_races(batch)))
+
+    for num_races, write in writes:
+        imported = write.result()
+        stats['imported'] += imported
+        stats['existing'] += num_races - imported
+    return stats
+
+
+def main():
+    """Runs the importer from the command line"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('directory',
+                        help='directory holding the race_*.txt files')
+    parser.add_argument('--history', default='race_history.db',
+                        help='race history database to import into')
+    parser.add_argument('--guild-id', type=int,
+                        help='guild the races were run in')
+    parser.add_argument('--channel-id', type=int, default=0,
+                        help='channel the races were run in')
+    parser.add_argument('--workers', type=int,
+                        help='number of parser processes')
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help='races written per transaction')
+    parser.add_argument('--verbose', action='store_true',
+                        help='print the errors of each file')
+    args = parser.parse_args()
+
+    history = RaceHistory(args.history)
+    start = time.perf_counter()
+    try:
+        stats = import_races(args.directory, history, args.guild_id,
+                             args.channel_id, args.workers, args.batch_size,
+                             args.verbose)
+    finally:
+        history.close()
+    print('Found {found} races, imported {imported}, {existing} already '
+          'imported, skipped {skipped}, {with_errors} with errors'.format(
+              **stats
+          ))
+    print('Took {:.2f}s'.format(time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+"""Crash-safe journal of race state changes
+
+Every race state change is appended to a JSON lines journal as it happens.
+Every so often a compact snapshot of all races is written and the journal is
+started over, so restoring races on startup only has to read the snapshot and
+the events journaled since. The files are written by a background writer.
+"""
+
+import io
+import json
+import os
+
+from datetime import datetime, timedelta
+
+from background_writer import BackgroundWriter
+
+__author__ = '4shockblast'
+
+JOURNAL_FILE_NAME = 'race_journal.jsonl'
+SNAPSHOT_FILE_NAME = 'race_snapshot.json'
+
+
+def encode_value(value):
+    """Encodes the datetimes and timedeltas in race state for JSON"""
+    if isinstance(value, datetime):
+        return {'$datetime': value.isoformat()}
+    if isinstance(value, timedelta):
+        return {'$timedelta': value // timedelta(microseconds=1)}
+    raise TypeError('Cannot journal {!r}'.format(value))
+
+
+def decode_object(obj):
+    """Decodes the datetimes and timedeltas written by encode_value"""
+    if '$datetime' in obj:
+        return datetime.fromisoformat(obj['$datetime'])
+    if '$timedelta' in obj:
+        return timedelta(microseconds=obj['$timedelta'])
+    return obj
+
+
+class RaceJournal:
+    """Append-only journal of race events plus periodic snapshots
+
+    Events are numbered. A snapshot records the number of the last event it
+    includes, so events left in the journal by a crash between writing a
+    snapshot and starting the journal over are skipped on replay.
+    """
+
+    def __init__(self, directory='.', snapshot_interval=1000, writer=None):
+        """Initialize a journal kept in the given directory
+
+        A snapshot is taken every snapshot_interval events. Writes go through
+        the given background writer, or a writer of the journal's own.
+        """
+        self.journal_path = os.path.join(directory, JOURNAL_FILE_NAME)
+        self.snapshot_path = os.path.join(directory, SNAPSHOT_FILE_NAME)
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_source = None
+        self.writer = writer if writer is not None else BackgroundWriter()
+        self._sequence = 0
+        self._since_snapshot = 0
+
+    def load(self):
+        """Reads the latest snapshot and the events journaled after it
+
+        Returns the list of snapshotted race dicts and the list of
+        (race key, event, event data) tuples to replay on top of them. This
+        reads the files directly, it is meant to run once on startup.
+        """
+        races = []
+        snapshot_sequence = 0
+        if os.path.exists(self.snapshot_path):
+            with io.open(self.snapshot_path, encoding='utf8') as snapshot:
+                data = json.load(snapshot, object_hook=decode_object)
+            races = data['races']
+            snapshot_sequence = data['sequence']
+        self._sequence = snapshot_sequence
+
+        events = []
+        if os.path.exists(self.journal_path):
+            with io.open(self.journal_path, encoding='utf8') as journal:
+                for line in journal:
+                    try:
+                        entry = json.loads(line, object_hook=decode_object)
+                    except ValueError:
+                        # A crash can leave the last line half written
+                        break
+                    if entry['sequence'] <= snapshot_sequence:
+                        continue
+                    self._sequence = entry['sequence']
+                    events.append((
+                        tuple(entry['race']), entry['event'], entry['data']
+                    ))
+
+        return races, events
+
+    def append(self, key, event, data):
+        """Appends an event for the race with the given key"""
+        self._sequence += 1
+        self.writer.append(self.journal_path, json.dumps({
+            'sequence': self._sequence,
+            'race': key,
+            'event': event,
+            'data': data
+        }, default=encode_value) + '\n')
+
+        self._since_snapshot += 1
+        if (self.snapshot_source is not None and
+                self._since_snapshot >= self.snapshot_interval):
+            self.snapshot(self.snapshot_source())
+
+    def snapshot(self, races):
+        """Writes a snapshot of the given races and starts a new journal
+
+        The races are serialized right away, writing them out is left to the
+        background writer.
+        """
+        data = json.dumps({
+            'sequence': self._sequence,
+            'races': [race.to_dict() for race in races if race.created]
+        }, default=encode_value)
+        self.writer.call(self._replace_snapshot, data)
+        self._since_snapshot = 0
+
+    def _replace_snapshot(self, data):
+        """Replaces the snapshot file and empties the journal"""
+        temp_path = self.snapshot_path + '.tmp'
+        with io.open(temp_path, 'w', encoding='utf8') as snapshot:
+            snapshot.write(data)
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        os.replace(temp_path, self.snapshot_path)
+        io.open(self.journal_path, 'w', encoding='utf8').close()
+
+    async def flush(self):
+        """Waits until all journaled events are written"""
+        await self.writer.flush()
@@ -0,0 +1,253 @@
+"""Metrics of the race bot
+
+Command latencies, command lag, event loop lag and message send timings are
+kept in fixed bucket histograms, so recording a value is a bisect and a few
+additions. Values read from elsewhere, like the gateway latency, are
+registered as gauges or counters and read when the metrics are rendered.
+Metrics are rendered in the Prometheus text format and served over HTTP on a
+local port.
+"""
+
+import asyncio
+import bisect
+import math
+import time
+
+from aiohttp import web
+
+__author__ = '4shockblast'
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0)
+PREFIX = 'racebot_'
+
+
+def format_labels(labels):
+    """Formats a dict of labels in the Prometheus text format"""
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\')
+                         .replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in sorted(labels.items())
+    ) + '}'
+
+
+def format_value(value):
+    """Formats a sample value in the Prometheus text format"""
+    if math.isnan(value):
+        return 'NaN'
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value))
+
+
+class Histogram:
+    """Counts of observed values in fixed buckets, in seconds"""
+
+    __slots__ = ('bounds', 'counts', 'sum', 'count', 'max')
+
+    def __init__(self, bounds=BUCKETS):
+        """Initialize an empty histogram with the given bucket upper bounds"""
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value):
+        """Records a value"""
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, fraction):
+        """Estimates a quantile, interpolating within its bucket"""
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.bounds[index - 1] if index else 0.0
+                upper = (self.bounds[index] if index < len(self.bounds)
+                         else self.max)
+                return min(lower + (upper - lower) * (rank - seen) / count,
+                           self.max)
+            seen += count
+        return self.max
+
+    def samples(self, name, labels):
+        """Yields the sample lines of the histogram"""
+        cumulative = 0
+        for bound, count in zip(self.bounds + (math.inf,), self.counts):
+            cumulative += count
+            yield '{}_bucket{} {}'.format(
+                name, format_labels(dict(labels, le=format_value(bound))),
+                cumulative
+            )
+        yield '{}_sum{} {}'.format(name, format_labels(labels),
+                                   format_value(self.sum))
+        yield '{}_count{} {}'.format(name, format_labels(labels), self.count)
+
+
+class RaceMetrics:
+    """All metrics of the race bot"""
+
+    def __init__(self, lag_interval=0.5, lag_warning=0.25):
+        """Initialize empty metrics
+
+        The event loop lag is sampled every lag_interval seconds once the
+        watchdog is started, and lags over lag_warning seconds are logged.
+        """
+        self.lag_interval = lag_interval
+        self.lag_warning = lag_warning
+        self.started = time.time()
+        self.commands = {}
+        self.command_lag = {}
+        self.command_errors = {}
+        self.command_throttled = {}
+        self.loop_lag = Histogram()
+        self.send_latency = Histogram()
+        self.queue_latency = Histogram()
+        self._readings = []
+        self._watchdog = None
+
+    def observe_command(self, name, seconds, failed=False):
+        """Records the run time of a command and whether it failed"""
+        histogram = self.commands.get(name)
+        if histogram is None:
+            histogram = self.commands[name] = Histogram()
+        histogram.observe(seconds)
+        if failed:
+            self.command_errors[name] = self.command_errors.get(name, 0) + 1
+
+    def observe_throttled(self, name):
+        """Records a command dropped by a throttle"""
+        self.command_throttled[name] = self.command_throttled.get(name, 0) + 1
+
+    def observe_command_lag(self, name, seconds):
+        """Records how long a command waited before its handler ran"""
+        histogram = self.command_lag.get(name)
+        if histogram is None:
+            histogram = self.command_lag[name] = Histogram()
+        histogram.observe(seconds)
+
+    def observe_send(self, send_latency, queue_latency):
+        """Records the API and total latency of a sent message"""
+        self.send_latency.observe(send_latency)
+        self.queue_latency.observe(queue_latency)
+
+    def register(self, name, kind, description, read):
+        """Registers a gauge or counter read when metrics are rendered
+
+        read is called without arguments and returns the current value.
+        """
+        self._readings.append((PREFIX + name, kind, description, read))
+
+    def start(self):
+        """Starts the event loop lag watchdog, does nothing if started"""
+        if self._watchdog is None:
+            self._watchdog = asyncio.ensure_future(self._watch_loop())
+
+    def stop(self):
+        """Stops the event loop lag watchdog"""
+        if self._watchdog is not None:
+            self._watchdog.cancel()
+            self._watchdog = None
+
+    async def _watch_loop(self):
+        """Samples how late the event loop wakes up from a sleep"""
+        loop = asyncio.get_event_loop()
+        while True:
+            expected = loop.time() + self.lag_interval
+            await asyncio.sleep(self.lag_interval)
+            lag = max(loop.time() - expected, 0.0)
+            self.loop_lag.observe(lag)
+            if lag > self.lag_warning:
+                print('Event loop lagged {:.3f}s'.format(lag))
+
+    def render(self):
+        """Returns all metrics in the Prometheus text format"""
+        lines = []
+
+        def histograms(name, description, by_label):
+            lines.append('# HELP {}{} {}'.format(PREFIX, name, description))
+            lines.append('# TYPE {}{} histogram'.format(PREFIX, name))
+            for labels, histogram in by_label:
+                lines.extend(histogram.samples(PREFIX + name, labels))
+
+        histograms('command_seconds', 'Run time of race commands.', [
+            ({'command': name}, histogram)
+            for name, histogram in sorted(self.commands.items())
+        ])
+        histograms('command_lag_seconds',
+                   'Time from a command message to its handler.', [
+                       ({'command': name}, histogram)
+                       for name, histogram in sorted(self.command_lag.items())
+                   ])
+        lines.append('# HELP {}command_errors_total Failed race '
+                     'commands.'.format(PREFIX))
+        lines.append('# TYPE {}command_errors_total counter'.format(PREFIX))
+        for name, errors in sorted(self.command_errors.items()):
+            lines.append('{}command_errors_total{} {}'.format(
+                PREFIX, format_labels({'command': name}), errors
+            ))
+        lines.append('# HELP {}command_throttled_total Race commands dropped '
+                     'by a throttle.'.format(PREFIX))
+        lines.append('# TYPE {}command_throttled_total counter'.format(PREFIX))
+        for name, throttled in sorted(self.command_throttled.items()):
+            lines.append('{}command_throttled_total{} {}'.format(
+                PREFIX, format_labels({'command': name}), throttled
+            ))
+        histograms('event_loop_lag_seconds',
+                   'Lateness of the event loop waking up.',
+                   [({}, self.loop_lag)])
+        histograms('message_send_seconds', 'Discord API time of a send.',
+                   [({}, self.send_latency)])
+        histograms('message_queue_seconds',
+                   'Time from queueing a message to it being sent.',
+                   [({}, self.queue_latency)])
+
+        for name, kind, description, read in self._readings:
+            lines.append('# HELP {} {}'.format(name, description))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            lines.append('{} {}'.format(name, format_value(read())))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsServer:
+    """Serves the metrics over HTTP at /metrics"""
+
+    def __init__(self, metrics, host='127.0.0.1', port=9108):
+        """Initialize the server, it listens once started"""
+        self.metrics = metrics
+        self.host = host
+        self.port = port
+        self._runner = None
+
+    async def start(self):
+        """Starts listening, does nothing if already started"""
+        if self._runner is not None:
+            return
+        app = web.Application()
+        app.router.add_get('/metrics', self._handle_metrics)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        print('Serving metrics on http://{}:{}/metrics'.format(
+            self.host, self.port
+        ))
+
+    async def _handle_metrics(self, _request):
+        """Returns the rendered metrics"""
+        return web.Response(text=self.metrics.render(),
+                            content_type='text/plain', charset='utf-8')
+
+    async def stop(self):
+        """Stops listening"""
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
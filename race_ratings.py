@@ -0,0 +1,295 @@
+"""Elo ratings of racers, one rating per game
+
+A race is rated as a match between every pair of its racers. Finishers beat
+everyone who finished behind them, and forfeited racers and racers who did
+not finish tie with each other behind all finishers. Ratings are updated as
+races end, and can be recomputed over the whole race history at once with
+vectorized NumPy updates.
+"""
+
+import asyncio
+
+import numpy
+
+from race_history import STATUS_FINISHED
+
+__author__ = '4shockblast'
+
+INITIAL_RATING = 1500.0
+K_FACTOR = 32.0
+NO_FINISH_RANK = 1 << 30
+
+
+def result_rank(place, status):
+    """Returns the rank a result is rated with, lower is better"""
+    if status == STATUS_FINISHED:
+        return place
+    return NO_FINISH_RANK
+
+
+def race_deltas(ratings, ranks, k_factor=K_FACTOR):
+    """Returns the rating changes of the racers of a single race
+
+    Ratings and ranks are given in the same racer order. Each racer's change
+    is scaled down by the number of opponents, so a race counts as much as a
+    single match no matter how many racers it had.
+    """
+    ratings = numpy.asarray(ratings, dtype=numpy.float64)
+    ranks = numpy.asarray(ranks)
+    if len(ratings) < 2:
+        return numpy.zeros(len(ratings))
+    expected = 1.0 / (1.0 + 10.0 ** (
+        (ratings[None, :] - ratings[:, None]) / 400.0
+    ))
+    scores = numpy.sign(ranks[None, :] - ranks[:, None]) * 0.5 + 0.5
+    numpy.fill_diagonal(expected, 0.0)
+    numpy.fill_diagonal(scores, 0.0)
+    return (scores - expected).sum(axis=1) * k_factor / (len(ratings) - 1)
+
+
+def history_ratings(race_sizes, slots, ranks, num_slots, k_factor=K_FACTOR,
+                    initial_rating=INITIAL_RATING):
+    """Computes ratings over a whole race history
+
+    Results are given in race order. race_sizes holds the number of results
+    of each race, slots and ranks hold the rating slot and rank of each
+    result. Returns the array of final ratings per slot.
+
+    Races are grouped into waves such that no two races of a wave share a
+    slot, and each slot's races are in order across waves. All races of a
+    wave are then rated together, giving the same ratings as rating the
+    races one by one.
+    """
+    race_sizes = numpy.asarray(race_sizes, dtype=numpy.int64)
+    slots = numpy.asarray(slots, dtype=numpy.int64)
+    ranks = numpy.asarray(ranks, dtype=numpy.int64)
+    ratings = numpy.full(num_slots, initial_rating)
+    if not len(race_sizes):
+        return ratings
+    race_starts = numpy.concatenate(([0], numpy.cumsum(race_sizes)[:-1]))
+
+    last_wave = [-1] * num_slots
+    race_waves = numpy.empty(len(race_sizes), dtype=numpy.int64)
+    slot_list = slots.tolist()
+    for race, (start, size) in enumerate(zip(race_starts.tolist(),
+                                             race_sizes.tolist())):
+        race_slots = slot_list[start:start + size]
+        wave = max([last_wave[slot] for slot in race_slots], default=-1) + 1
+        for slot in race_slots:
+            last_wave[slot] = wave
+        race_waves[race] = wave
+
+    # Every ordered pair of results of the same race
+    firsts, seconds, waves = [], [], []
+    for size in numpy.unique(race_sizes).tolist():
+        if size < 2:
+            continue
+        races = numpy.flatnonzero(race_sizes == size)
+        first, second = numpy.nonzero(~numpy.eye(size, dtype=bool))
+        firsts.append((race_starts[races, None] + first).ravel())
+        seconds.append((race_starts[races, None] + second).ravel())
+        waves.append(numpy.repeat(race_waves[races], len(first)))
+    if not firsts:
+        return ratings
+    first = numpy.concatenate(firsts)
+    second = numpy.concatenate(seconds)
+    wave = numpy.concatenate(waves)
+    order = numpy.lexsort((first, wave))
+    first, second, wave = first[order], second[order], wave[order]
+
+    scores = numpy.sign(ranks[second] - ranks[first]) * 0.5 + 0.5
+    scales = k_factor / numpy.maximum(
+        numpy.repeat(race_sizes, race_sizes) - 1, 1
+    )
+    first_slots = slots[first]
+    second_slots = slots[second]
+    # Pairs of the same result are consecutive and never span two waves
+    run_starts = numpy.flatnonzero(numpy.diff(first, prepend=-1))
+    wave_bounds = numpy.searchsorted(wave, numpy.arange(wave[-1] + 2))
+    run_bounds = numpy.searchsorted(run_starts, wave_bounds)
+
+    for index in range(len(wave_bounds) - 1):
+        low, high = wave_bounds[index], wave_bounds[index + 1]
+        if low == high:
+            continue
+        runs = run_starts[run_bounds[index]:run_bounds[index + 1]]
+        expected = 1.0 / (1.0 + 10.0 ** (
+            (ratings[second_slots[low:high]] -
+             ratings[first_slots[low:high]]) / 400.0
+        ))
+        totals = numpy.add.reduceat(scores[low:high] - expected, runs - low)
+        results = first[runs]
+        ratings[slots[results]] += scales[results] * totals
+    return ratings
+
+
+class RaceRatings:
+    """Cached per game ratings of every racer in the race history"""
+
+    def __init__(self, history, k_factor=K_FACTOR,
+                 initial_rating=INITIAL_RATING):
+        """Initialize the ratings of a race history
+
+        Ratings are computed from the history on first use and kept up to
+        date as races are rated afterwards.
+        """
+        self._history = history
+        self.k_factor = k_factor
+        self.initial_rating = initial_rating
+        self._ratings = {}
+        self._num_races = {}
+        self._game_names = {}
+        self._racer_names = {}
+        self._top = {}
+        self._built = None
+        self._pending = None
+        self._data_version = None
+
+    @staticmethod
+    def game_key(game):
+        """Returns the key ratings of a game are kept under"""
+        return game.casefold()
+
+    async def ensure_built(self):
+        """Computes ratings from the history unless already up to date
+
+        Ratings are computed again if another bot process wrote to the
+        history since they were computed.
+        """
+        built = self._built
+        if built is not None and built.done():
+            data_version = await self._history.data_version()
+            if data_version != self._data_version and self._built is built:
+                self._built = None
+        if self._built is None:
+            self._built = asyncio.ensure_future(self.rebuild())
+        try:
+            await asyncio.shield(self._built)
+        except Exception:
+            self._built = None
+            raise
+
+    async def rebuild(self):
+        """Recomputes all ratings from the race history
+
+        Races rated while the history is being read are held back and
+        applied on top of the recomputed ratings.
+        """
+        try:
+            data_version = await self._history.data_version()
+            self._pending = []
+            rows = await self._history.all_results()
+            computed = await asyncio.get_event_loop().run_in_executor(
+                None, self._rate_history, rows
+            )
+        except Exception:
+            self._pending = None
+            raise
+        (self._ratings, self._num_races, self._game_names,
+         self._racer_names) = computed
+        self._top = {}
+        self._data_version = data_version
+        pending, self._pending = self._pending, None
+        for race in pending:
+            self._rate(race)
+
+    def _rate_history(self, rows):
+        """Computes ratings from history rows, off the event loop"""
+        slot_keys = {}
+        game_names = {}
+        racer_names = {}
+        race_sizes = []
+        slots = []
+        ranks = []
+        last_race_id = None
+        for race_id, game, racer, racer_name, place, status in rows:
+            racer_names[racer] = racer_name
+            if game is None:
+                continue
+            key = self.game_key(game)
+            game_names.setdefault(key, game)
+            if race_id != last_race_id:
+                race_sizes.append(0)
+                last_race_id = race_id
+            race_sizes[-1] += 1
+            slots.append(slot_keys.setdefault((key, racer), len(slot_keys)))
+            ranks.append(result_rank(place, status))
+
+        final_ratings = history_ratings(
+            race_sizes, slots, ranks, len(slot_keys), self.k_factor,
+            self.initial_rating
+        ).tolist()
+        slot_counts = numpy.bincount(
+            numpy.asarray(slots, dtype=numpy.int64)[
+                numpy.repeat(numpy.asarray(race_sizes) > 1, race_sizes)
+            ],
+            minlength=len(slot_keys)
+        ).tolist()
+
+        ratings = {}
+        num_races = {}
+        for (key, racer), slot in slot_keys.items():
+            if not slot_counts[slot]:
+                continue
+            ratings.setdefault(key, {})[racer] = final_ratings[slot]
+            num_races.setdefault(key, {})[racer] = slot_counts[slot]
+        return ratings, num_races, game_names, racer_names
+
+    def rate_race(self, race):
+        """Updates ratings with the results of a finished race
+
+        The race is a race history record. Races that end before ratings
+        have been computed are picked up from the history instead.
+        """
+        if self._pending is not None:
+            self._pending.append(race)
+        elif self._built is not None and self._built.done():
+            self._rate(race)
+
+    def _rate(self, race):
+        """Applies the rating changes of a race"""
+        for result in race['results']:
+            self._racer_names[result['racer_id']] = result['racer_name']
+        if race['game'] is None or len(race['results']) < 2:
+            return
+        key = self.game_key(race['game'])
+        self._game_names.setdefault(key, race['game'])
+        game_ratings = self._ratings.setdefault(key, {})
+        game_races = self._num_races.setdefault(key, {})
+        racers = [result['racer_id'] for result in race['results']]
+        deltas = race_deltas(
+            [game_ratings.get(racer, self.initial_rating) for racer in racers],
+            [result_rank(result['place'], result['status'])
+             for result in race['results']],
+            self.k_factor
+        ).tolist()
+        for racer, delta in zip(racers, deltas):
+            game_ratings[racer] = (
+                game_ratings.get(racer, self.initial_rating) + delta
+            )
+            game_races[racer] = game_races.get(racer, 0) + 1
+        self._top.pop(key, None)
+
+    async def racer_ratings(self, racer):
+        """Returns a racer's (game, rating, races) tuples, best first"""
+        await self.ensure_built()
+        ratings = [(self._game_names[key], game_ratings[racer],
+                    self._num_races[key][racer])
+                   for key, game_ratings in self._ratings.items()
+                   if racer in game_ratings]
+        ratings.sort(key=lambda rating: -rating[1])
+        return ratings
+
+    async def top(self, game, limit=10):
+        """Returns the (racer name, rating, races) tuples of a game's best"""
+        await self.ensure_built()
+        key = self.game_key(game)
+        if key not in self._top:
+            game_ratings = self._ratings.get(key, {})
+            self._top[key] = sorted(
+                ((self._racer_names[racer], rating,
+                  self._num_races[key][racer])
+                 for racer, rating in game_ratings.items()),
+                key=lambda rating: -rating[1]
+            )
+        return self._top[key][:limit]
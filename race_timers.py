@@ -0,0 +1,223 @@
+"""Timer service for scheduled race actions
+
+All timers live in a single heap ordered by due time and are fired by a
+single task, which sleeps until the earliest timer is due or a new timer
+goes in front of it. Cancelled timers are left in the heap and skipped when
+popped, the heap is rebuilt once most of it is cancelled. The schedule is
+saved through a background writer whenever it changes and loaded again on
+startup.
+"""
+
+import asyncio
+import heapq
+import io
+import itertools
+import json
+import os
+import time
+import traceback
+
+__author__ = '4shockblast'
+
+TIMERS_FILE_NAME = 'race_timers.json'
+
+
+class Timer:
+    """A scheduled action on the race of a channel"""
+
+    __slots__ = ('id', 'kind', 'due', 'key', 'data', 'cancelled')
+
+    def __init__(self, timer_id, kind, due, key, data):
+        """Initialize a timer due at the given epoch time in seconds"""
+        self.id = timer_id
+        self.kind = kind
+        self.due = due
+        self.key = key
+        self.data = data
+        self.cancelled = False
+
+    def to_dict(self):
+        """Returns the timer as a dict for the saved schedule"""
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'due': self.due,
+            'key': list(self.key),
+            'data': self.data
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """Restores a timer from the saved schedule"""
+        return cls(data['id'], data['kind'], data['due'], tuple(data['key']),
+                   data['data'])
+
+
+class TimerService:
+    """Fires timers of registered kinds when they are due"""
+
+    def __init__(self, writer, path=TIMERS_FILE_NAME):
+        """Initialize an empty schedule saved to the given path"""
+        self._writer = writer
+        self.path = path
+        self._heap = []
+        self._timers = {}
+        self._race_timers = {}
+        self._handlers = {}
+        self._ids = itertools.count(1)
+        self._num_cancelled = 0
+        self._wakeup = None
+        self._task = None
+        self._save_pending = False
+
+    def __len__(self):
+        return len(self._timers)
+
+    def register(self, kind, handler):
+        """Sets the function called with each timer of a kind when it fires"""
+        self._handlers[kind] = handler
+
+    def load(self):
+        """Loads the saved schedule
+
+        This reads the file directly, it is meant to run once on startup.
+        Timers that came due while the bot was down fire once the service
+        is started.
+        """
+        if not os.path.exists(self.path):
+            return
+        with io.open(self.path, encoding='utf8') as timers_file:
+            timers = [Timer.from_dict(data) for data in json.load(timers_file)]
+        for timer in timers:
+            self._add(timer)
+        if timers:
+            self._ids = itertools.count(max(timer.id for timer in timers) + 1)
+
+    def start(self):
+        """Starts firing timers, does nothing if already started"""
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.ensure_future(self._run())
+
+    def schedule(self, kind, due, key, **data):
+        """Schedules a timer for a race at an epoch time in seconds"""
+        timer = Timer(next(self._ids), kind, due, key, data)
+        self._add(timer)
+        if self._wakeup is not None and self._heap[0][2] is timer:
+            self._wakeup.set()
+        self._save()
+        return timer
+
+    def _add(self, timer):
+        """Adds a timer to the heap and the lookup tables"""
+        heapq.heappush(self._heap, (timer.due, timer.id, timer))
+        self._timers[timer.id] = timer
+        self._race_timers.setdefault(timer.key, set()).add(timer.id)
+
+    def _remove(self, timer):
+        """Removes a timer from the lookup tables"""
+        del self._timers[timer.id]
+        race_timers = self._race_timers[timer.key]
+        race_timers.discard(timer.id)
+        if not race_timers:
+            del self._race_timers[timer.key]
+
+    def cancel(self, timer):
+        """Cancels a pending timer"""
+        if timer.cancelled or timer.id not in self._timers:
+            return
+        timer.cancelled = True
+        self._remove(timer)
+        self._num_cancelled += 1
+        if self._num_cancelled > len(self._heap) // 2:
+            self._heap = [entry for entry in self._heap
+                          if not entry[2].cancelled]
+            heapq.heapify(self._heap)
+            self._num_cancelled = 0
+        self._save()
+
+    def timers_for(self, key, kinds=None):
+        """Returns the pending timers of a race, soonest first"""
+        timers = [self._timers[timer_id]
+                  for timer_id in self._race_timers.get(key, ())]
+        if kinds is not None:
+            timers = [timer for timer in timers if timer.kind in kinds]
+        timers.sort(key=lambda timer: (timer.due, timer.id))
+        return timers
+
+    def cancel_race(self, key, kinds=None):
+        """Cancels the pending timers of a race, or only those of some kinds
+
+        Returns the number of timers cancelled.
+        """
+        timers = self.timers_for(key, kinds)
+        for timer in timers:
+            self.cancel(timer)
+        return len(timers)
+
+    async def _run(self):
+        """Fires due timers, then sleeps until the next one is due"""
+        while True:
+            self._wakeup.clear()
+            now = time.time()
+            fired = False
+            while self._heap and self._heap[0][0] <= now:
+                _, _, timer = heapq.heappop(self._heap)
+                if timer.cancelled:
+                    self._num_cancelled -= 1
+                    continue
+                self._remove(timer)
+                self._fire(timer)
+                fired = True
+            if fired:
+                self._save()
+
+            timeout = None
+            if self._heap:
+                timeout = self._heap[0][0] - now
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _fire(self, timer):
+        """Runs the handler of a timer, logging its errors"""
+        handler = self._handlers.get(timer.kind)
+        if handler is None:
+            print('No handler for {} timers'.format(timer.kind))
+            return
+        try:
+            handler(timer)
+        except Exception:
+            print('{} timer failed:'.format(timer.kind))
+            traceback.print_exc()
+
+    def _save(self):
+        """Saves the schedule once the current batch of changes is done"""
+        if self._save_pending:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        self._save_pending = True
+        if loop is None:
+            self._write_schedule()
+        else:
+            loop.call_soon(self._write_schedule)
+
+    def _write_schedule(self):
+        """Hands the current schedule to the background writer"""
+        if not self._save_pending:
+            return
+        self._save_pending = False
+        self._writer.replace(self.path, json.dumps([
+            timer.to_dict() for timer in self._timers.values()
+        ]))
+
+    def stop(self):
+        """Stops firing timers and saves any unsaved changes"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self._write_schedule()
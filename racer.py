@@ -0,0 +1,116 @@
+"""Per racer state of a race
+
+Racers are kept as compact records keyed by user ID. Times are integer
+nanoseconds, start times since the epoch and times taken since the racer's
+start. Split times are kept in an array indexed by the race's split index,
+with NO_SPLIT for splits the racer has not logged.
+"""
+
+import enum
+
+from array import array
+from datetime import datetime, timedelta
+
+from race_history import STATUS_FINISHED, STATUS_FORFEITED, \
+    STATUS_UNFINISHED
+
+__author__ = '4shockblast'
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+NO_SPLIT = -1
+
+
+def to_nanoseconds(duration):
+    """Converts a timedelta to integer nanoseconds"""
+    return duration // MICROSECOND * 1000
+
+
+def to_timedelta(nanoseconds):
+    """Converts integer nanoseconds to a timedelta, down to the microsecond"""
+    return timedelta(microseconds=nanoseconds // 1000)
+
+
+def timestamp_nanoseconds(moment):
+    """Converts a naive UTC datetime to nanoseconds since the epoch"""
+    return to_nanoseconds(moment - EPOCH)
+
+
+class RacerStatus(enum.Enum):
+    """End status of a racer, valued as in the race history"""
+    RACING = STATUS_UNFINISHED
+    FINISHED = STATUS_FINISHED
+    FORFEITED = STATUS_FORFEITED
+
+
+class Racer:
+    """State of a single racer in a race"""
+
+    __slots__ = ('id', 'name', 'status', 'ready', 'start_ns', 'time_ns',
+                 'comment', 'splits')
+
+    def __init__(self, racer_id, name):
+        """Initialize a racer who has joined but is not ready"""
+        self.id = racer_id
+        self.name = name
+        self.status = RacerStatus.RACING
+        self.ready = False
+        self.start_ns = None
+        self.time_ns = None
+        self.comment = ''
+        self.splits = None
+
+    def time_taken(self):
+        """Returns the time taken of a finished racer as a timedelta"""
+        return to_timedelta(self.time_ns)
+
+    def split_time(self, index):
+        """Returns the time of a split in nanoseconds, None if not logged"""
+        if self.splits is None or index >= len(self.splits):
+            return None
+        time_ns = self.splits[index]
+        return None if time_ns == NO_SPLIT else time_ns
+
+    def set_split(self, index, time_ns):
+        """Sets the time of a split in nanoseconds"""
+        if self.splits is None:
+            self.splits = array('q')
+        if index >= len(self.splits):
+            self.splits.extend([NO_SPLIT] * (index + 1 - len(self.splits)))
+        self.splits[index] = time_ns
+
+    def previous_split_time(self, index):
+        """Returns the time of the last logged split before a split
+
+        This is 0, the racer's start, if no earlier split was logged.
+        """
+        for previous in range(min(index, len(self.splits or ())) - 1, -1, -1):
+            if self.splits[previous] != NO_SPLIT:
+                return self.splits[previous]
+        return 0
+
+    def to_dict(self):
+        """Returns the racer as a dict for snapshots"""
+        return {
+            'id': self.id,
+            'name': self.name,
+            'status': self.status.value,
+            'ready': self.ready,
+            'start_ns': self.start_ns,
+            'time_ns': self.time_ns,
+            'comment': self.comment,
+            'splits': list(self.splits or ())
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """Restores a racer from a snapshot dict"""
+        racer = cls(data['id'], data['name'])
+        racer.status = RacerStatus(data['status'])
+        racer.ready = data['ready']
+        racer.start_ns = data['start_ns']
+        racer.time_ns = data['time_ns']
+        racer.comment = data['comment']
+        if data.get('splits'):
+            racer.splits = array('q', data['splits'])
+        return racer
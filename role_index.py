@@ -0,0 +1,90 @@
+"""Per guild index of the roles the race commands check
+
+The mod roles and the racer role of a guild are looked up by name once, and
+the index is dropped whenever a role of the guild is created, changed or
+deleted, so permission checks are set lookups on role IDs.
+"""
+
+__author__ = '4shockblast'
+
+
+class GuildRoles:
+    """Mod role IDs and the racer role of a single guild"""
+
+    __slots__ = ('mod_role_ids', 'racer_role')
+
+    def __init__(self, mod_role_ids, racer_role):
+        """Initialize the roles of a guild"""
+        self.mod_role_ids = mod_role_ids
+        self.racer_role = racer_role
+
+
+class RoleIndex:
+    """Resolves mod and racer roles by their configured names"""
+
+    def __init__(self, config=None):
+        """Initialize the index from the roles config
+
+        The config holds the default mod role names, compared ignoring case,
+        and racer role name, and per guild overrides of either keyed by guild
+        ID, e.g. {"mod": ["race mod"], "racer": "racer",
+        "guilds": {"1234": {"mod": ["organizer"]}}}.
+        """
+        config = config if config is not None else {}
+        self._mod_names = frozenset(
+            name.lower() for name in config.get('mod', ['race mod'])
+        )
+        self._racer_name = config.get('racer', 'racer')
+        self._guild_config = {
+            int(guild_id): guild_config
+            for guild_id, guild_config in config.get('guilds', {}).items()
+        }
+        self._guilds = {}
+
+    def _names(self, guild_id):
+        """Returns the mod role names and racer role name of a guild"""
+        guild_config = self._guild_config.get(guild_id)
+        if guild_config is None:
+            return self._mod_names, self._racer_name
+        mod_names = self._mod_names
+        if 'mod' in guild_config:
+            mod_names = frozenset(name.lower() for name in guild_config['mod'])
+        return mod_names, guild_config.get('racer', self._racer_name)
+
+    def roles(self, guild):
+        """Returns the indexed roles of a guild, indexing them if needed"""
+        guild_roles = self._guilds.get(guild.id)
+        if guild_roles is None:
+            mod_names, racer_name = self._names(guild.id)
+            mod_role_ids = set()
+            racer_role = None
+            for role in guild.roles:
+                if role.name.lower() in mod_names:
+                    mod_role_ids.add(role.id)
+                if role.name == racer_name:
+                    racer_role = role
+            guild_roles = self._guilds[guild.id] = GuildRoles(
+                frozenset(mod_role_ids), racer_role
+            )
+        return guild_roles
+
+    def is_mod(self, member):
+        """Checks if a member has one of the mod roles of their guild"""
+        guild = getattr(member, 'guild', None)
+        if guild is None:
+            return False
+        mod_role_ids = self.roles(guild).mod_role_ids
+        for role in member.roles:
+            if role.id in mod_role_ids:
+                return True
+        return False
+
+    def racer_role(self, guild):
+        """Returns the racer role of a guild, None if it has none"""
+        if guild is None:
+            return None
+        return self.roles(guild).racer_role
+
+    def invalidate(self, guild):
+        """Drops the indexed roles of a guild after its roles changed"""
+        self._guilds.pop(guild.id, None)